@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+""" benchmark-build.py
+
+    Times parse-excel-file.py, get-library-docs.py and
+    create-library-index.py on made up libraries of different sizes
+    (1k, 10k and 100k documents by default) and records the peak
+    memory (RSS) used by each.
+
+    For each size a scratch folder is set up with its own
+    library-config.ini, a spreadsheet with the three config rows and
+    the row of column labels followed by the documents (with
+    multi-option columns and long abstracts), and a source tree of
+    document files in nested folders. Each script is run in the
+    scratch folder as a separate process, so the peak RSS is for that
+    stage alone. Nothing in the real library or outputs folder is
+    changed.
+
+    The results are saved as JSON (see --results). Give --compare the
+    results saved from an earlier commit to log how much each stage
+    has changed.
+
+    The script requires the structlog library to be installed
+    (used for logging).
+"""
+import argparse
+import configparser
+import importlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from openpyxl import Workbook
+
+import confighelper
+import libhelper
+from confighelper import access_types, status_types
+
+parse_excel = importlib.import_module("parse-excel-file")
+
+SCRIPTS_PATH = Path(__file__).resolve().parent
+
+# the scripts in the order they are run, with their arguments
+STAGES = [
+    ("parse", "parse-excel-file.py", []),
+    ("docs", "get-library-docs.py", []),
+    ("index", "create-library-index.py", ["--full"]),
+]
+
+# the columns of the real spreadsheet and their config flags
+COLUMNS = [
+    "ID",
+    "Region",
+    "Catchment",
+    "State",
+    "Habitat_type",
+    "Category",
+    "Topic",
+    "Access_Rights",
+    "Project_ID",
+    "Authors",
+    "Year",
+    "Title",
+    "Abstract_Description",
+    "Keywords",
+    "JournalOrPublisher",
+    "Volume",
+    "Issue",
+    "DOI",
+    "URL",
+    "File_name",
+    "Icon",
+    "Status",
+]
+FILTER_FIELDS = {"Catchment", "State", "Habitat_type", "Access_Rights", "Year"}
+SEARCH_FIELDS = {
+    "Catchment",
+    "State",
+    "Habitat_type",
+    "Topic",
+    "Keywords",
+    "Authors",
+    "Title",
+    "Abstract_Description",
+}
+HIDDEN_FIELDS = {"Project_ID", "Keywords", "Status"}
+
+# values for the made up documents
+REGIONS = ["Top End", "Gulf", "Kimberley", "Cape York"]
+CATCHMENTS = ["Daly", "Fitzroy", "Ord", "Mitchell", "Gilbert", "Northern Australia"]
+STATES = ["NT", "QLD", "WA"]
+HABITATS = ["Terrestrial", "Marine", "Freshwater", "Riparian", "Estuarine"]
+CATEGORIES = ["Journal_Article", "Report", "Factsheet", "Thesis"]
+TOPICS = ["Catchment management", "Riparian management", "Water quality", "Fish"]
+WORDS = (
+    "water river catchment flow fish habitat wetland groundwater rainfall "
+    "season dry wet flood estuary sediment nutrient vegetation survey "
+    "monitoring indigenous management irrigation agriculture biodiversity "
+    "species population recharge aquifer savanna climate Água"
+).split()
+
+
+def write_library_config(scratch_path, src_path, dest_path):
+    # Use the real config with the document folders in the scratch folder
+    config = configparser.ConfigParser()
+    config.optionxform = str  # keep the case of the keys
+    config.read(SCRIPTS_PATH.joinpath("library-config.ini"))
+    config["Library-docs"]["srcPath"] = str(src_path)
+    config["Library-docs"]["destPath"] = str(dest_path)
+    with open(scratch_path.joinpath("library-config.ini"), "w") as fd:
+        config.write(fd)
+
+
+def make_row(rng, doc_num, abstract_words):
+    access = rng.choices(
+        [access_types.open, access_types.publisher, access_types.physical_library],
+        [6, 3, 1],
+    )[0]
+    year = rng.randint(1970, 2024)
+    author = "Author{}, {}.".format(doc_num % 997, chr(65 + doc_num % 26))
+    category = rng.choice(CATEGORIES)
+    filename = None
+    if access == access_types.open:
+        filename = "{:06d}-{}-{}-{}.pdf".format(doc_num, author[:-4], year, category)
+    return {
+        "ID": "{:06d}".format(doc_num),
+        "Region": ", ".join(rng.sample(REGIONS, rng.randint(1, 2))),
+        "Catchment": ", ".join(rng.sample(CATCHMENTS, rng.randint(1, 3))),
+        "State": ", ".join(rng.sample(STATES, rng.randint(1, 2))),
+        "Habitat_type": ", ".join(rng.sample(HABITATS, rng.randint(1, 2))),
+        "Category": category,
+        "Topic": rng.choice(TOPICS),
+        "Access_Rights": access,
+        "Authors": author,
+        "Year": year,
+        "Title": " ".join(rng.choices(WORDS, k=rng.randint(4, 12))).capitalize(),
+        "Abstract_Description": " ".join(rng.choices(WORDS, k=abstract_words)),
+        "Keywords": "; ".join(rng.sample(WORDS, 3)),
+        "JournalOrPublisher": "Journal of {}".format(rng.choice(WORDS)),
+        "DOI": "10.1071/{:06d}".format(doc_num),
+        "URL": (
+            "https://example.org/{}".format(doc_num)
+            if access == access_types.publisher
+            else None
+        ),
+        "File_name": filename,
+        "Status": rng.choices([status_types.active, status_types.deleted], [19, 1])[0],
+    }
+
+
+def make_library(scratch_path, num_docs, num_extra_files, abstract_words, seed):
+    # Write the spreadsheet and the source tree, most of the open access
+    # documents have a file plus there are num_extra_files that aren't
+    # in the spreadsheet. Returns the number of files in the source tree.
+    rng = random.Random(seed)
+    src_path = scratch_path.joinpath("src")
+    dest_path = scratch_path.joinpath("dest")
+    dest_path.mkdir()
+    scratch_path.joinpath("inputs").mkdir()
+    scratch_path.joinpath("outputs").mkdir()
+    write_library_config(scratch_path, src_path, dest_path)
+
+    def write_src_file(file_num, filename):
+        folder = src_path.joinpath(
+            "{:02d}".format(file_num % 40), "{:d}".format(file_num % 7)
+        )
+        folder.mkdir(parents=True, exist_ok=True)
+        folder.joinpath(filename).write_bytes(
+            b"%PDF-1.4\n" + filename.encode("utf-8")
+        )
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(parse_excel.SHEET_NAME)
+    flag_fields = [FILTER_FIELDS, SEARCH_FIELDS, set(COLUMNS) - HIDDEN_FIELDS]
+    for flag, fields in zip(parse_excel.CONFIG_FLAGS, flag_fields):
+        no_flag = flag.replace("_yes", "_no")
+        sheet.append([flag if column in fields else no_flag for column in COLUMNS])
+    sheet.append(COLUMNS)
+
+    num_files = 0
+    for doc_num in range(num_docs):
+        row = make_row(rng, doc_num, abstract_words)
+        sheet.append([row.get(column) for column in COLUMNS])
+        if row["File_name"] and rng.random() < 0.95:
+            write_src_file(doc_num, row["File_name"])
+            num_files += 1
+    workbook.save(scratch_path.joinpath("inputs", "library-index.xlsx"))
+
+    for file_num in range(num_extra_files):
+        write_src_file(file_num, "extra-{:06d}.pdf".format(file_num))
+    return num_files + num_extra_files
+
+
+def run_stage(scratch_path, script, args):
+    # Run the script in the scratch folder, returns its exit code, the
+    # elapsed and CPU time and the peak RSS in MiB
+    env = dict(os.environ)
+    # use the scratch config even if LIBRARY_CONFIG is set
+    env[confighelper.CONFIG_ENV_VAR] = str(
+        scratch_path.joinpath(confighelper.DEFAULT_CONFIG_FILE)
+    )
+    with open(scratch_path.joinpath("benchmark.log"), "a") as log_file:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, str(SCRIPTS_PATH.joinpath(script))] + args,
+            cwd=scratch_path,
+            env=env,
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+        )
+        # wait4 gives the resource usage of just this process
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return (
+        process.returncode,
+        elapsed,
+        usage.ru_utime + usage.ru_stime,
+        libhelper.get_rss_mib(usage),
+    )
+
+
+def benchmark_library(log, num_docs, num_extra_files, abstract_words, seed):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scratch_path = Path(tmp_dir)
+        start = time.perf_counter()
+        num_files = make_library(
+            scratch_path, num_docs, num_extra_files, abstract_words, seed
+        )
+        log.info(
+            "Made library",
+            docs=num_docs,
+            files=num_files,
+            seconds=round(time.perf_counter() - start, 1),
+        )
+
+        for stage, script, args in STAGES:
+            exit_code, elapsed, cpu_time, peak_rss = run_stage(
+                scratch_path, script, args
+            )
+            if exit_code != 0:
+                output = scratch_path.joinpath("benchmark.log").read_text()
+                log.error(
+                    "Stage failed",
+                    stage=stage,
+                    docs=num_docs,
+                    exit_code=exit_code,
+                    output=output[-2000:],
+                )
+                break
+            result = {
+                "docs": num_docs,
+                "files": num_files,
+                "stage": stage,
+                "seconds": round(elapsed, 3),
+                "cpu_seconds": round(cpu_time, 3),
+                "peak_rss_mib": round(peak_rss, 1),
+            }
+            log.info("Stage benchmark", **result)
+            results.append(result)
+    return results
+
+
+def get_commit():
+    process = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        cwd=SCRIPTS_PATH,
+        capture_output=True,
+        text=True,
+    )
+    return process.stdout.strip() if process.returncode == 0 else None
+
+
+def compare_results(log, results, old_results):
+    # Log the change in time and peak RSS of each stage against the
+    # same stage and size in old_results
+    old_stages = {
+        (result["docs"], result["stage"]): result for result in old_results["results"]
+    }
+    for result in results["results"]:
+        old_result = old_stages.get((result["docs"], result["stage"]))
+        if old_result is None:
+            continue
+        log.info(
+            "Compared with earlier results",
+            commit=old_results.get("commit"),
+            docs=result["docs"],
+            stage=result["stage"],
+            seconds_ratio=round(
+                result["seconds"] / max(old_result["seconds"], 1e-3), 2
+            ),
+            rss_ratio=round(result["peak_rss_mib"] / old_result["peak_rss_mib"], 2),
+        )
+
+
+if __name__ == "__main__":
+    # create parser
+    parser = argparse.ArgumentParser()
+
+    # add arguments to the parser
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+        help="number of documents in each made up library (default %(default)s)",
+    )
+    parser.add_argument(
+        "--extra-files",
+        type=int,
+        help="files in the source tree that aren't in the spreadsheet "
+        "(default a tenth of the number of documents)",
+    )
+    parser.add_argument(
+        "--abstract-words",
+        type=int,
+        default=200,
+        help="number of words in each abstract (default %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=1,
+        help="seed for the made up libraries (default %(default)s)",
+    )
+    parser.add_argument(
+        "--results",
+        default="benchmark-results.json",
+        help="file to save the results in (default %(default)s)",
+    )
+    parser.add_argument(
+        "--compare",
+        help="results file from an earlier run to compare the results with",
+    )
+    libhelper.add_log_level_argument(parser)
+
+    # parse the command line arguments
+    args = parser.parse_args()
+    log = libhelper.get_logger(args.log_level)
+
+    results = {
+        "version": 1,
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "abstract_words": args.abstract_words,
+        "seed": args.seed,
+        "results": [],
+    }
+    for num_docs in args.sizes:
+        num_extra_files = args.extra_files
+        if num_extra_files is None:
+            num_extra_files = num_docs // 10
+        results["results"].extend(
+            benchmark_library(
+                log, num_docs, num_extra_files, args.abstract_words, args.seed
+            )
+        )
+
+    Path(args.results).write_text(json.dumps(results, indent=1), encoding="utf-8")
+    log.info("Saved benchmark results", file=args.results)
+
+    if args.compare:
+        old_results = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        compare_results(log, results, old_results)
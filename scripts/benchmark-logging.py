@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+""" benchmark-logging.py
+
+    Measures the cost per row of the logging in the per-row loops of
+    get-library-docs.py and create-library-index.py at the INFO and
+    DEBUG log levels.
+
+    The document copy (as a dry-run) and split_multi_option_values are
+    run over a made up library of --rows documents, with the log output
+    thrown away so only the cost of making the log entries is counted.
+    Nothing in the real library or outputs folder is changed.
+
+    The script requires the structlog library to be installed
+    (used for logging).
+"""
+import argparse
+import importlib
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+import structlog
+
+import libhelper
+from confighelper import access_types, label, status_types
+
+library_docs = importlib.import_module("get-library-docs")
+library_index = importlib.import_module("create-library-index")
+
+
+def make_library(src_path, num_rows):
+    # Make num_rows open access documents, each with a small file
+    rows = []
+    for row_num in range(num_rows):
+        filename = "doc-{:06d}.pdf".format(row_num)
+        src_path.joinpath(filename).write_bytes(b"%PDF-1.4\n")
+        rows.append(
+            {
+                label.id: "{:06d}".format(row_num),
+                label.access: access_types.open,
+                label.status: status_types.active,
+                label.filename: filename,
+            }
+        )
+    return rows
+
+
+def make_lib_data(num_rows):
+    return pd.DataFrame(
+        {
+            column: ["Daly, Ord , Fitzroy"] * num_rows
+            for column in library_index.MULTI_OPTION_COLS
+        }
+    )
+
+
+def time_per_row(log_level, num_rows, run):
+    # Run with log entries at log_level and above going to /dev/null,
+    # returns the time per row in microseconds
+    with open(os.devnull, "w") as devnull:
+        structlog.configure(
+            wrapper_class=structlog.make_filtering_bound_logger(
+                getattr(logging, log_level)
+            ),
+            logger_factory=structlog.PrintLoggerFactory(file=devnull),
+        )
+        log = structlog.get_logger()
+        start = time.perf_counter()
+        run(log)
+        elapsed = time.perf_counter() - start
+    return elapsed / num_rows * 1e6
+
+
+if __name__ == "__main__":
+    # create parser
+    parser = argparse.ArgumentParser()
+
+    # add arguments to the parser
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=2000,
+        help="number of documents in the made up library (default %(default)s)",
+    )
+
+    # parse the command line arguments
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        src_path = Path(tmp_dir, "src")
+        dest_path = Path(tmp_dir, "dest")
+        src_path.mkdir()
+        dest_path.mkdir()
+
+        # point the copy at the scratch folders
+        library_docs.docs = library_docs.docs._replace(
+            src_path=src_path, dest_path=dest_path
+        )
+        library_docs.files = library_docs.files._replace(
+            docs_manifest=Path(tmp_dir, "manifest.json")
+        )
+        rows = make_library(src_path, args.rows)
+        src_file_list = {
+            row[label.filename]: src_path / row[label.filename] for row in rows
+        }
+
+        benchmarks = [
+            (
+                "copy_library_docs",
+                lambda log: library_docs.copy_library_docs(
+                    log, True, rows, src_file_list, workers=1
+                ),
+            ),
+            (
+                "split_multi_option_values",
+                lambda log: library_index.split_multi_option_values(
+                    log, make_lib_data(args.rows)
+                ),
+            ),
+        ]
+
+        results = {}
+        for name, run in benchmarks:
+            time_per_row("ERROR", args.rows, run)  # warm up
+            for log_level in ["INFO", "DEBUG"]:
+                results[name, log_level] = time_per_row(log_level, args.rows, run)
+
+    structlog.reset_defaults()  # log the results to the console
+    log = libhelper.get_logger()
+    for (name, log_level), usec_per_row in results.items():
+        log.info(
+            "Time per row",
+            function=name,
+            log_level=log_level,
+            rows=args.rows,
+            usec=round(usec_per_row, 1),
+        )
@@ -0,0 +1,567 @@
+#!/usr/bin/env python3
+""" build-library.py
+
+    Runs the whole rebuild in one process:
+
+      1. parse    - read the library-index spreadsheet (parse-excel-file.py)
+      2. docs     - copy the open access documents (get-library-docs.py)
+      3. index    - create library-index.json and query-config.json
+                    (create-library-index.py), and the doc pages with
+                    --pages
+      4. compress - write the .gz and .br copies of the website files
+
+    The spreadsheet is read once and every stage works on the same
+    table in memory, so the csv files in outputs/ are only written
+    when --write-csv is given (handy for debugging). The spreadsheet is
+    only read if it has changed since the cache of it was written (see
+    cachehelper.py), otherwise the cache is read. The time taken
+    by each stage is logged at the end, along with a table of the time,
+    CPU time, peak memory and rows in and out of each step, which is
+    also saved in build-report.json. --profile saves a cProfile file for
+    each step in outputs/profile/.
+
+    With --watch the script keeps running after the build and rebuilds
+    whatever a change affects (see watchhelper.py), keeping the
+    spreadsheet data and the list of source files in memory. A change
+    to the spreadsheet re-runs the stages after parse, a new or changed
+    file in the source folder is copied on its own and the index is
+    only rebuilt if the file is new to the library. The website files
+    are only compressed once nothing has changed for
+    COMPRESS_DELAY_SECONDS (or watching stops), and a rebuild that
+    fails is logged and the changes after it are still rebuilt. With
+    --prune a rebuild only prunes the library if the source folder is
+    there and isn't empty.
+
+    The script requires the structlog library to be installed
+    (used for logging). --watch uses the watchdog library if it is
+    installed and polls for changes if not, the cache needs the pyarrow
+    library.
+"""
+import importlib
+import argparse
+import fnmatch
+import os
+import queue
+import time
+import unicodedata
+import libhelper
+import watchhelper
+from confighelper import docs, files, label
+
+# the stage scripts have dashes in their names so can't be imported
+# with a normal import statement
+parse_excel = importlib.import_module("parse-excel-file")
+library_docs = importlib.import_module("get-library-docs")
+library_index = importlib.import_module("create-library-index")
+
+# the stages of the build, the steps inside them are timed as well
+BUILD_STAGES = ["parse", "docs", "index", "compress"]
+
+# with --watch, compress the website files once nothing has changed for
+# this long rather than after every rebuild
+COMPRESS_DELAY_SECONDS = 5.0
+
+
+def parse_library(log, is_dry_run, report, write_csv=False, full=False):
+    # The parse stage, returns the rows and the config rows
+    with libhelper.stage_timer(log, "parse", report) as stage:
+        log.info("Reading spreadsheet", file=str(files.excel_file))
+        lib_data, config_data = parse_excel.read_excel_data_cached(
+            log, is_dry_run, files.excel_file, files.libindex_cache, full
+        )
+        log.info("Initial # rows loaded", count=lib_data.index.size)
+        stage["rows_out"] = lib_data.index.size
+        if write_csv:
+            parse_excel.write_excel_data(
+                lib_data, config_data, parse_excel.get_output_files()
+            )
+            log.info("Wrote csv files", path=str(files.libindex_csv.parent))
+            if not is_dry_run and files.libindex_cache.exists():
+                # the cache has the same rows as the csv files, keep it
+                # newer so the stage scripts still read it
+                os.utime(files.libindex_cache)
+    return lib_data, config_data
+
+
+def build_index(
+    log,
+    is_dry_run,
+    lib_data,
+    config_data,
+    report,
+    sharded=False,
+    size_budget=None,
+    full=False,
+    full_text=False,
+    text_workers=library_index.texthelper.DEFAULT_WORKERS,
+    check_urls=False,
+    url_ttl=library_index.urlhelper.DEFAULT_TTL_HOURS,
+    pages=False,
+    page_workers=library_index.pagehelper.DEFAULT_WORKERS,
+    compress=True,
+):
+    # The index and compress stages (unless compress is False), returns
+    # False if the website files are over the size budget
+    with libhelper.stage_timer(log, "index", report, lib_data.index.size):
+        library_index.create_library_files(
+            log,
+            is_dry_run,
+            library_index.prepare_library_data(lib_data),
+            filter_config=config_data["Filter_yes"],
+            search_config=config_data["Search_yes"],
+            display_config=config_data["FullDisplay_yes"],
+            sort_config=config_data[parse_excel.SORT_CONFIG],
+            sharded=sharded,
+            full=full,
+            report=report,
+            full_text=full_text,
+            text_workers=text_workers,
+            check_urls=check_urls,
+            url_ttl=url_ttl,
+            pages=pages,
+            page_workers=page_workers,
+        )
+
+    if not compress:
+        return True
+    return compress_library(log, is_dry_run, report, sharded, size_budget)
+
+
+def compress_library(log, is_dry_run, report, sharded=False, size_budget=None):
+    # The compress stage, returns False if the website files are over
+    # the size budget
+    with libhelper.stage_timer(log, "compress", report):
+        return library_index.compress_website_files(
+            log, is_dry_run, library_index.get_website_files(sharded), size_budget
+        )
+
+
+def build_library(
+    log,
+    is_dry_run,
+    write_csv=False,
+    prune=False,
+    workers=library_docs.DEFAULT_WORKERS,
+    rescan=False,
+    sharded=False,
+    size_budget=None,
+    full=False,
+    report=None,
+    full_text=False,
+    text_workers=library_index.texthelper.DEFAULT_WORKERS,
+    check_urls=False,
+    url_ttl=library_index.urlhelper.DEFAULT_TTL_HOURS,
+    pages=False,
+    page_workers=library_index.pagehelper.DEFAULT_WORKERS,
+    state=None,
+):
+    # Run every stage. The spreadsheet data and the source file list
+    # are kept in the state dictionary if one is given (for --watch).
+    if report is None:
+        report = libhelper.new_report()
+
+    lib_data, config_data = parse_library(log, is_dry_run, report, write_csv, full)
+
+    with libhelper.stage_timer(log, "docs", report, lib_data.index.size) as stage:
+        log.info("Copying files from", path=str(docs.src_path))
+        log.info("Copying files to", path=str(docs.dest_path))
+        with libhelper.stage_timer(log, "get_filename_path_dict", report) as inner:
+            src_file_list = library_docs.get_filename_path_dict(
+                log,
+                docs.src_path,
+                docs.file_pattern,
+                cache_path=files.src_dir_index,
+                rescan=rescan,
+                is_dry_run=is_dry_run,
+            )
+            inner["rows_out"] = len(src_file_list)
+        with libhelper.stage_timer(
+            log, "copy_library_docs", report, lib_data.index.size
+        ) as inner:
+            doc_stats = library_docs.copy_library_docs(
+                log,
+                is_dry_run,
+                lib_data.to_dict("records"),
+                src_file_list,
+                prune=prune,
+                workers=workers,
+            )
+            inner["rows_out"] = library_docs.get_num_library_files(doc_stats)
+        stage["rows_out"] = inner["rows_out"]
+
+    is_within_budget = build_index(
+        log,
+        is_dry_run,
+        lib_data,
+        config_data,
+        report,
+        sharded=sharded,
+        size_budget=size_budget,
+        full=full,
+        full_text=full_text,
+        text_workers=text_workers,
+        check_urls=check_urls,
+        url_ttl=url_ttl,
+        pages=pages,
+        page_workers=page_workers,
+    )
+
+    timings = {
+        stage["stage"]: stage["seconds"]
+        for stage in report["stages"]
+        if stage["stage"] in BUILD_STAGES
+    }
+    log.info("Build complete", seconds=round(sum(timings.values()), 3), **timings)
+    if state is not None:
+        state.update(
+            lib_data=lib_data, config_data=config_data, src_file_list=src_file_list
+        )
+    return report, is_within_budget
+
+
+def update_src_file_list(src_file_list, paths):
+    # Add the files in paths that are in the source folder to the source
+    # file list (by name, like get_filename_path_dict) and remove the
+    # ones that are gone. Returns the names of the files.
+    name_pattern = docs.file_pattern.rsplit("/", 1)[-1]
+    src_keys = set()
+    for path in paths:
+        src_key = unicodedata.normalize(library_docs.UNICODE_FORM, path.name)
+        if path.is_file() and fnmatch.fnmatch(path.name, name_pattern):
+            src_file_list[src_key] = path
+        elif src_file_list.get(src_key) == path:
+            del src_file_list[src_key]
+        src_keys.add(src_key)
+    return src_keys
+
+
+def is_src_present(log):
+    # True if the source folder is there and has something in it. The
+    # source file list kept while watching doesn't notice a share that
+    # drops out (which can leave an empty folder behind), so this looks
+    # at the folder itself.
+    try:
+        with os.scandir(docs.src_path) as entries:
+            if next(entries, None) is not None:
+                return True
+    except OSError:
+        pass
+    log.error("Source folder is missing or empty", path=str(docs.src_path))
+    return False
+
+
+def rebuild_changes(log, is_dry_run, paths, state, options):
+    # Re-run only the stages that the changed paths affect, using the
+    # spreadsheet data and source file list kept in state: a change to
+    # the spreadsheet rebuilds everything after it, a change to a file
+    # in the source folder copies that file and rebuilds the index only
+    # if the file is new to the library (or its text is searched). The
+    # website files aren't compressed, returns True if they need to be.
+    start = time.perf_counter()
+    report = libhelper.new_report()
+    src_paths = [path for path in paths if path.is_relative_to(docs.src_path)]
+    is_sheet_changed = files.excel_file in paths
+    if not src_paths and not is_sheet_changed:
+        return False
+    src_keys = update_src_file_list(state["src_file_list"], src_paths)
+
+    if is_sheet_changed:
+        try:
+            state["lib_data"], state["config_data"] = parse_library(
+                log, is_dry_run, report, options["write_csv"]
+            )
+        except Exception as ex:
+            # most likely saved again while it was being read, the next
+            # save triggers another rebuild
+            log.error("Couldn't read the spreadsheet", error=str(ex))
+            return False
+    lib_data = state["lib_data"]
+
+    with libhelper.stage_timer(log, "docs", report, lib_data.index.size) as stage:
+        if is_sheet_changed:
+            doc_stats = library_docs.copy_library_docs(
+                log,
+                is_dry_run,
+                lib_data.to_dict("records"),
+                state["src_file_list"],
+                prune=options["prune"] and is_src_present(log),
+                workers=options["workers"],
+            )
+            stage["rows_out"] = library_docs.get_num_library_files(doc_stats)
+        else:
+            src_names = lib_data[label.filename].map(
+                lambda filename: unicodedata.normalize(
+                    library_docs.UNICODE_FORM, filename
+                )
+            )
+            file_states = library_docs.sync_doc_files(
+                log,
+                is_dry_run,
+                lib_data[src_names.isin(src_keys)].to_dict("records"),
+                state["src_file_list"],
+            )
+            stage["rows_out"] = sum(file_states.values())
+
+    is_index_changed = (
+        state.get("is_index_stale", False)
+        or is_sheet_changed
+        or file_states["new"]
+        or (options["full_text"] and file_states["changed"])
+    )
+    if is_index_changed:
+        # stays set if the build fails, so the next change rebuilds it
+        state["is_index_stale"] = True
+        build_index(
+            log,
+            is_dry_run,
+            lib_data,
+            state["config_data"],
+            report,
+            sharded=options["sharded"],
+            size_budget=options["size_budget"],
+            full_text=options["full_text"],
+            text_workers=options["text_workers"],
+            check_urls=options["check_urls"],
+            url_ttl=options["url_ttl"],
+            pages=options["pages"],
+            page_workers=options["page_workers"],
+            compress=False,
+        )
+        state["is_index_stale"] = False
+    log.info(
+        "Rebuilt the changes",
+        spreadsheet=is_sheet_changed,
+        files=len(src_paths),
+        stages=[stage["stage"] for stage in report["stages"]],
+        seconds=round(time.perf_counter() - start, 3),
+    )
+    return is_index_changed
+
+
+def watch_library(
+    log,
+    is_dry_run,
+    state,
+    options,
+    poll=False,
+    poll_interval=watchhelper.DEFAULT_POLL_SECONDS,
+):
+    # Rebuild whatever a change to the spreadsheet or the files in the
+    # source folder affects, until interrupted (Ctrl-C)
+    changes = queue.Queue()
+    if poll or watchhelper.Observer is None:
+        if not poll:
+            log.warning("watchdog isn't installed, polling for changes instead")
+        stop = watchhelper.start_poller(
+            changes, files.excel_file, docs.src_path, poll_interval
+        )
+        stop_watching = stop.set
+        log.info(
+            "Polling for changes",
+            spreadsheet=str(files.excel_file),
+            path=str(docs.src_path),
+            interval=poll_interval,
+        )
+    else:
+        observer = watchhelper.start_observer(changes, files.excel_file, docs.src_path)
+        stop_watching = observer.stop
+        log.info(
+            "Watching for changes",
+            spreadsheet=str(files.excel_file),
+            path=str(docs.src_path),
+        )
+
+    is_compress_due = False
+    try:
+        while True:
+            paths = watchhelper.get_changes(
+                changes, timeout=COMPRESS_DELAY_SECONDS if is_compress_due else None
+            )
+            if paths is None:
+                # nothing has changed for a while
+                compress_library(
+                    log,
+                    is_dry_run,
+                    libhelper.new_report(),
+                    options["sharded"],
+                    options["size_budget"],
+                )
+                is_compress_due = False
+                continue
+            try:
+                if rebuild_changes(log, is_dry_run, paths, state, options):
+                    is_compress_due = True
+            except Exception as ex:
+                # e.g. a bad row or a file that is locked, keep watching
+                # and rebuild again on the next change
+                log.error(
+                    "Couldn't rebuild the changes",
+                    error="{}: {}".format(type(ex).__name__, ex),
+                    paths=sorted(str(path) for path in paths),
+                )
+                is_compress_due = True
+    except KeyboardInterrupt:
+        log.info("Stopped watching for changes")
+    finally:
+        stop_watching()
+    if is_compress_due:
+        compress_library(
+            log,
+            is_dry_run,
+            libhelper.new_report(),
+            options["sharded"],
+            options["size_budget"],
+        )
+
+
+if __name__ == "__main__":
+    # create parser
+    parser = argparse.ArgumentParser()
+
+    # add arguments to the parser
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="don't make any changes but give me some stats on what would happen",
+    )
+    parser.add_argument(
+        "--write-csv",
+        action="store_true",
+        help="also write the intermediate csv files to outputs/ for debugging",
+    )
+
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="remove files from the library that are no longer listed in the index",
+    )
+
+    parser.add_argument(
+        "--rescan",
+        action="store_true",
+        help="list every folder in the source path instead of only the changed ones",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=library_docs.DEFAULT_WORKERS,
+        help="number of files to copy at the same time (default %(default)s)",
+    )
+
+    parser.add_argument(
+        "--sharded",
+        action="store_true",
+        help="also split the library index into cards and details shards",
+    )
+    parser.add_argument(
+        "--size-budget",
+        type=float,
+        help="fail if the gzipped website files add up to more than this many KiB",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="read the spreadsheet and rebuild the index even if nothing has "
+        "changed since the last run",
+    )
+
+    parser.add_argument(
+        "--full-text",
+        action="store_true",
+        help="add the text of the open access PDFs to the search index",
+    )
+    parser.add_argument(
+        "--text-workers",
+        type=int,
+        default=library_index.texthelper.DEFAULT_WORKERS,
+        help="number of PDFs to read the text of at the same time "
+        "(default %(default)s)",
+    )
+
+    parser.add_argument(
+        "--check-urls",
+        action="store_true",
+        help="check the publisher URLs and drop the docs whose URL is gone",
+    )
+    parser.add_argument(
+        "--url-ttl",
+        type=float,
+        default=library_index.urlhelper.DEFAULT_TTL_HOURS,
+        help="hours before a checked URL is checked again (default %(default)s)",
+    )
+
+    parser.add_argument(
+        "--pages",
+        action="store_true",
+        help="also write a static page for each doc and the sitemap",
+    )
+    parser.add_argument(
+        "--page-workers",
+        type=int,
+        default=library_index.pagehelper.DEFAULT_WORKERS,
+        help="number of processes rendering the doc pages (default %(default)s)",
+    )
+
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running and rebuild whatever a change to the spreadsheet or "
+        "the source folder affects",
+    )
+    parser.add_argument(
+        "--poll",
+        action="store_true",
+        help="with --watch, look for changes every --poll-interval seconds "
+        "instead of being told about them (e.g. for network shares)",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=watchhelper.DEFAULT_POLL_SECONDS,
+        help="seconds between looks for changes (default %(default)s)",
+    )
+
+    libhelper.add_report_arguments(parser)
+    libhelper.add_log_level_argument(parser)
+
+    # parse the command line arguments
+    args = parser.parse_args()
+    log = libhelper.get_logger(args.log_level)
+    report = libhelper.new_report(files.profile_dir if args.profile else None)
+    is_dry_run = args.dry_run
+    if is_dry_run:
+        log.info("This is a dry-run, no changes will be made")
+
+    state = {}
+    report, is_within_budget = build_library(
+        log,
+        is_dry_run,
+        write_csv=args.write_csv,
+        prune=args.prune,
+        workers=args.workers,
+        rescan=args.rescan,
+        sharded=args.sharded,
+        size_budget=args.size_budget,
+        full=args.full,
+        report=report,
+        full_text=args.full_text,
+        text_workers=args.text_workers,
+        check_urls=args.check_urls,
+        url_ttl=args.url_ttl,
+        pages=args.pages,
+        page_workers=args.page_workers,
+        state=state,
+    )
+    libhelper.finish_report(log, is_dry_run, report, files.build_report)
+    if args.watch:
+        # the rebuilds use the same options as the first build
+        watch_library(
+            log,
+            is_dry_run,
+            state,
+            vars(args),
+            poll=args.poll,
+            poll_interval=args.poll_interval,
+        )
+    elif not is_within_budget:
+        exit(1)
@@ -0,0 +1,149 @@
+""" cachehelper.py
+
+    Reads and writes the columnar cache of the parsed spreadsheet,
+    outputs/library-index.parquet, that parse-excel-file.py writes next
+    to the csv files.
+
+    Each column of the sheet is a string column (dictionary encoded, so
+    the many repeats in columns like Access_Rights or Region are stored
+    once) and empty cells are empty strings, the same as the csv files.
+    The file is written in row groups as the sheet is read, so it
+    doesn't need the whole sheet in memory. The schema metadata has
+    the sha256 of the workbook it was made from and the config rows:
+
+      {
+        "version": 1,
+        "workbook_sha256": sha256 of the xlsx file,
+        "config": {
+          config flag: [True/False for each column],
+          "Sort": [the sort definition in each column]
+        }
+      }
+
+    so a stage can tell whether the workbook has changed since, and read
+    just the columns it needs (memory mapped) rather than the whole csv
+    file.
+
+    Needs the pyarrow library, without it no cache is written and the
+    csv files are read instead.
+"""
+import json
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional, the csv files are used without it
+    pa = None
+
+CACHE_VERSION = 1
+
+# the key for the library metadata in the schema metadata
+METADATA_KEY = b"library"
+
+# rows in each row group
+BATCH_ROWS = 10000
+
+
+def write_sheet_cache(cache_path, col_labels, config_rows, rows, sha256):
+    # Write the rows (lists of strings) to the cache in row groups of
+    # BATCH_ROWS, with the config rows (a list of values for each
+    # column by name) and the sha256 of the workbook. Writes to a
+    # temporary file first so the cache is never half written. Returns
+    # the number of rows.
+    metadata = {
+        "version": CACHE_VERSION,
+        "workbook_sha256": sha256,
+        "config": config_rows,
+    }
+    schema = pa.schema(
+        [pa.field(col_label, pa.string()) for col_label in col_labels],
+        metadata={METADATA_KEY: json.dumps(metadata)},
+    )
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    num_rows = 0
+    with pq.ParquetWriter(tmp_path, schema, use_dictionary=True) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == BATCH_ROWS:
+                writer.write_batch(get_record_batch(schema, batch))
+                num_rows += len(batch)
+                batch = []
+        if batch or not num_rows:
+            writer.write_batch(get_record_batch(schema, batch))
+            num_rows += len(batch)
+    os.replace(tmp_path, cache_path)
+    return num_rows
+
+
+def get_record_batch(schema, rows):
+    columns = zip(*rows) if rows else [[] for _ in schema]
+    return pa.RecordBatch.from_arrays(
+        [pa.array(column, pa.string()) for column in columns], schema=schema
+    )
+
+
+def write_lib_data_cache(cache_path, lib_data, config_data, sha256):
+    # Write the data from parse-excel-file.read_excel_data to the cache
+    config_rows = {name: data.iloc[0].tolist() for name, data in config_data.items()}
+    write_sheet_cache(
+        cache_path,
+        list(lib_data.columns),
+        config_rows,
+        lib_data.itertuples(index=False, name=None),
+        sha256,
+    )
+
+
+def read_cache_metadata(cache_path):
+    # The library metadata of the cache, or None if there isn't a cache
+    # (or pyarrow isn't installed)
+    if pa is None or not cache_path.exists():
+        return None
+    try:
+        schema = pq.read_schema(cache_path, memory_map=True)
+        metadata = json.loads(schema.metadata[METADATA_KEY])
+    except (OSError, KeyError, TypeError, ValueError, pa.ArrowException):
+        return None
+    if metadata.get("version") != CACHE_VERSION:
+        return None
+    return metadata
+
+
+def is_cache_current(cache_path, csv_path):
+    # True if the cache can be read instead of csv_path, i.e. it was
+    # written after the csv file (the csv file can also be written
+    # without it, e.g. by parse-excel-file.py --two-pass)
+    return read_cache_metadata(cache_path) is not None and (
+        not csv_path.exists()
+        or cache_path.stat().st_mtime_ns >= csv_path.stat().st_mtime_ns
+    )
+
+
+def read_lib_data(cache_path, columns=None):
+    # The rows from the cache as strings (empty cells are empty strings),
+    # only reading the given columns
+    table = pq.read_table(cache_path, columns=columns, memory_map=True)
+    return table.to_pandas()
+
+
+def iter_lib_data(cache_path, batch_rows=BATCH_ROWS, columns=None):
+    # The rows from the cache batch_rows at a time, like read_lib_data
+    parquet_file = pq.ParquetFile(cache_path, memory_map=True)
+    for batch in parquet_file.iter_batches(batch_size=batch_rows, columns=columns):
+        yield batch.to_pandas()
+
+
+def read_sheet_cache(cache_path):
+    # The rows and config rows from the cache, the same as
+    # parse-excel-file.read_excel_data returns them
+    metadata = read_cache_metadata(cache_path)
+    lib_data = read_lib_data(cache_path)
+    config_data = {
+        name: pd.DataFrame([values], columns=lib_data.columns)
+        for name, values in metadata["config"].items()
+    }
+    return lib_data, config_data
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+""" check-search-index.py
+
+    Runs each query given on the command line against the prebuilt
+    search index (search-index.json) and against a plain scan of
+    library-index.json like the website does now, and reports the
+    docs that only one of them found.
+
+    The index matches whole words from their start (so "riv" finds
+    "river" but "ver" doesn't) and ignores accents, the scan matches
+    any part of the text, so some differences are expected.
+
+    The script requires the structlog library to be installed
+    (used for logging).
+"""
+import argparse
+import json
+
+import libhelper
+import searchhelper
+from confighelper import files, label
+
+if __name__ == "__main__":
+    # create parser
+    parser = argparse.ArgumentParser()
+
+    # add arguments to the parser
+    parser.add_argument("queries", nargs="+", help="search text to check")
+    libhelper.add_log_level_argument(parser)
+
+    # parse the command line arguments
+    args = parser.parse_args()
+    log = libhelper.get_logger(args.log_level)
+
+    records = json.loads(files.libindex_json.read_text(encoding="utf-8"))
+    search_index = json.loads(files.search_index.read_text(encoding="utf-8"))
+    search_fields = json.loads(files.query_config.read_text(encoding="utf-8"))[
+        "searchableFields"
+    ]
+
+    for query in args.queries:
+        index_matches = set(searchhelper.search(search_index, query))
+        scan_matches = set(searchhelper.scan_search(records, search_fields, query))
+        log.info(
+            "Search results",
+            query=query,
+            index=len(index_matches),
+            scan=len(scan_matches),
+            same=index_matches == scan_matches,
+        )
+        for ordinal in sorted(index_matches - scan_matches):
+            log.info("Only found by index", query=query, id=records[ordinal][label.id])
+        for ordinal in sorted(scan_matches - index_matches):
+            log.info("Only found by scan", query=query, id=records[ordinal][label.id])
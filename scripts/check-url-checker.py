@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+""" check-url-checker.py
+
+    Checks urlhelper.py against a local stand-in web server, so the
+    URL check can be tried without going out to the publishers' sites.
+    The server answers with a 200, a 404, a 410, a 503, redirects to
+    those, a 405 to HEAD (but not GET) and a response slower than the
+    timeout, and each URL's state is compared with the expected one.
+
+    It also checks that URLs waiting for a free connection aren't timed
+    out: QUEUED_URLS slow but good URLs on several hosts (the server on
+    several ports) are checked with only a few connections, so most of
+    them wait longer than the timeout before they start.
+
+    Exits with status 1 if any URL has the wrong state. The script
+    requires the structlog and aiohttp libraries to be installed.
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+from aiohttp import web
+
+import libhelper
+import urlhelper
+
+# seconds the checks wait for each request
+TIMEOUT = 1.0
+
+# the slow URLs take longer than the timeout, the queued ones less
+SLOW_SECONDS = TIMEOUT + 1
+QUEUED_SECONDS = TIMEOUT / 2
+
+# ports the server listens on, each is a host to the checker
+NUM_HOSTS = 4
+QUEUED_URLS = 16
+QUEUED_CONCURRENCY = 2
+
+# path and expected state of each URL
+EXPECTED_STATES = {
+    "/ok": "ok",
+    "/not-found": "dead",
+    "/gone": "dead",
+    "/unavailable": "error",
+    "/redirect-ok": "ok",
+    "/redirect-gone": "dead",
+    "/no-head": "ok",
+    "/slow": "unreachable",
+}
+
+
+async def handle_request(request):
+    path = request.path
+    if path == "/ok":
+        return web.Response(text="ok")
+    if path == "/not-found":
+        return web.Response(status=404)
+    if path == "/gone":
+        return web.Response(status=410)
+    if path == "/unavailable":
+        return web.Response(status=503)
+    if path == "/redirect-ok":
+        raise web.HTTPFound("/ok")
+    if path == "/redirect-gone":
+        raise web.HTTPMovedPermanently("/gone")
+    if path == "/no-head":
+        if request.method == "HEAD":
+            return web.Response(status=405)
+        return web.Response(text="ok")
+    if path == "/slow":
+        await asyncio.sleep(SLOW_SECONDS)
+        return web.Response(text="ok")
+    if path.startswith("/queued/"):
+        await asyncio.sleep(QUEUED_SECONDS)
+        return web.Response(text="ok")
+    return web.Response(status=500)
+
+
+async def start_server():
+    # Start the server on NUM_HOSTS free ports, returns the runner and
+    # the base URL of each port
+    app = web.Application()
+    app.router.add_route("*", "/{path:.*}", handle_request)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    base_urls = []
+    for _ in range(NUM_HOSTS):
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        base_urls.append(f"http://127.0.0.1:{port}")
+    return runner, base_urls
+
+
+async def run_checks(log):
+    # Returns the number of URLs with the wrong state
+    runner, base_urls = await start_server()
+    num_wrong = 0
+    try:
+        urls = {base_urls[0] + path: state for path, state in EXPECTED_STATES.items()}
+        results = await urlhelper.check_urls(list(urls), timeout=TIMEOUT)
+        for url, expected in urls.items():
+            state = urlhelper.get_url_state(results[url])
+            if state != expected:
+                num_wrong += 1
+            log.info(
+                "URL checked",
+                url=url,
+                state=state,
+                expected=expected,
+                status=results[url]["status"],
+                method=results[url]["method"],
+                error=results[url]["error"],
+            )
+
+        queued_urls = [
+            f"{base_urls[number % NUM_HOSTS]}/queued/{number}"
+            for number in range(QUEUED_URLS)
+        ]
+        start = time.perf_counter()
+        results = await urlhelper.check_urls(
+            queued_urls, concurrency=QUEUED_CONCURRENCY, timeout=TIMEOUT
+        )
+        states = [urlhelper.get_url_state(result) for result in results.values()]
+        num_wrong += sum(state != "ok" for state in states)
+        log.info(
+            "Queued URLs checked",
+            urls=len(queued_urls),
+            ok=states.count("ok"),
+            seconds=round(time.perf_counter() - start, 2),
+            timeout=TIMEOUT,
+        )
+    finally:
+        await runner.cleanup()
+    return num_wrong
+
+
+def check_retry_ttl(log):
+    # The results that may not last expire after RETRY_TTL_HOURS, the
+    # others after the TTL. Returns the number that are wrong.
+    now = time.time()
+    checked = now - (urlhelper.RETRY_TTL_HOURS + 1) * 3600
+    num_wrong = 0
+    for status, expected in [(200, False), (404, False), (503, True), (None, True)]:
+        result = {"status": status, "method": "GET", "error": None, "checked": checked}
+        is_expired = urlhelper.is_result_expired(
+            result, now, urlhelper.DEFAULT_TTL_HOURS
+        )
+        if is_expired != expected:
+            num_wrong += 1
+        log.info("Cache expiry", status=status, expired=is_expired, expected=expected)
+    return num_wrong
+
+
+if __name__ == "__main__":
+    # create parser
+    parser = argparse.ArgumentParser()
+    libhelper.add_log_level_argument(parser)
+
+    # parse the command line arguments
+    args = parser.parse_args()
+    log = libhelper.get_logger(args.log_level)
+
+    num_wrong = asyncio.run(run_checks(log)) + check_retry_ttl(log)
+    if num_wrong:
+        log.error("The URL check got some URLs wrong", count=num_wrong)
+        sys.exit(1)
+    log.info("The URL check got every URL right")
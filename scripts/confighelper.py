@@ -3,43 +3,183 @@
 # This file contains the configurable items for specific
 # digital library source data.
 #
+# The config is read from library-config.ini the first time one of
+# docs, label, access_types, status_types, icons, urls or files is
+# used (not when this module is imported) and then kept. The file is
+# library-config.ini in the current folder, or the file named by the
+# LIBRARY_CONFIG environment variable, or the file given to
+# use_config(). The loaded config is a LibraryConfig namedtuple that
+# can be pickled, so it can be handed to pool workers with
+# use_config() as their initializer.
+#
 
 import configparser
+import os
 from collections import namedtuple
 from pathlib import Path
 
-config = {}
+DEFAULT_CONFIG_FILE = "library-config.ini"
+CONFIG_ENV_VAR = "LIBRARY_CONFIG"
+
+# the keys each section of library-config.ini has to have
+REQUIRED_KEYS = {
+    "Library-docs": ["filePattern", "srcPath", "destPath"],
+    "Column-labels": [
+        "id",
+        "access",
+        "filename",
+        "publishedURL",
+        "displayURL",
+        "displayIcon",
+        "status",
+    ],
+    "Access-values": ["open", "physicalLibrary", "publisher"],
+    "Status-values": ["active", "deleted"],
+    "Icons": ["webpage", "download", "support", "library"],
+    "URLs": ["physicalLibrary", "contactUs", "download"],
+}
+
+# the config types are defined here (not in the get_* functions) so
+# they can be pickled
+Docs = namedtuple("Docs", ["file_pattern", "src_path", "dest_path", "pages_path"])
+Labels = namedtuple(
+    "Labels",
+    [
+        "id",
+        "access",
+        "filename",
+        "publishedURL",
+        "displayURL",
+        "displayIcon",
+        "status",
+    ],
+)
+AccessValues = namedtuple("AccessValues", ["open", "physical_library", "publisher"])
+StatusValues = namedtuple("StatusValues", ["active", "deleted"])
+Icons = namedtuple("Icons", ["webpage", "download", "support", "library"])
+URLs = namedtuple(
+    "URLs", ["physical_library", "contact_us", "download", "doc_pages", "site"]
+)
+LocalPaths = namedtuple(
+    "LocalPaths",
+    [
+        "doc_display_config",
+        "search_config",
+        "filter_config",
+        "query_config",
+        "excel_file",
+        "libindex_csv",
+        "libindex_json",
+        "docs_manifest",
+        "src_dir_index",
+        "rejected_csv",
+        "rejected_json",
+        "search_index",
+        "facet_index",
+        "sort_config",
+        "sort_index",
+        "libindex_shards",
+        "fingerprints",
+        "libindex_delta",
+        "build_report",
+        "profile_dir",
+        "doc_text_cache",
+        "duplicates_report",
+        "url_cache",
+        "url_check",
+        "libindex_cache",
+        "libindex_ndjson",
+        "doc_pages",
+    ],
+)
+LibraryConfig = namedtuple(
+    "LibraryConfig",
+    ["docs", "label", "access_types", "status_types", "icons", "urls", "files"],
+)
+
+# the config file given to use_config() and the loaded config
+config_path = None
+library_config = None
+
+
+class ConfigError(Exception):
+    pass
+
 
+def get_config_path():
+    if config_path is not None:
+        return Path(config_path)
+    return Path(os.environ.get(CONFIG_ENV_VAR, DEFAULT_CONFIG_FILE))
 
-def load_config():
+
+def load_config(path=None):
+    # Read the config file and check it has every required key, so a
+    # missing key is reported once here rather than as a KeyError
+    # wherever it is first used
+    path = Path(path) if path is not None else get_config_path()
     config = configparser.ConfigParser()
-    config.read("library-config.ini")
+    if not config.read(path, encoding="utf-8"):
+        raise ConfigError(
+            "Config file {} not found (set {} or run from the folder with {})".format(
+                path.resolve(), CONFIG_ENV_VAR, DEFAULT_CONFIG_FILE
+            )
+        )
+    missing = [
+        "[{}] {}".format(section, key)
+        for section, keys in REQUIRED_KEYS.items()
+        for key in keys
+        if not config.has_option(section, key)
+    ]
+    if missing:
+        raise ConfigError(
+            "Config file {} is missing: {}".format(path.resolve(), ", ".join(missing))
+        )
     return config
 
 
+def build_config(config):
+    return LibraryConfig(
+        docs=get_docs_config(config),
+        label=get_label_config(config),
+        access_types=get_access_values(config),
+        status_types=get_status_values(config),
+        icons=get_icons(config),
+        urls=get_urls(config),
+        files=get_internal_files(),
+    )
+
+
+def get_config():
+    # The LibraryConfig, loaded the first time it's needed
+    global library_config
+    if library_config is None:
+        library_config = build_config(load_config())
+    return library_config
+
+
+def use_config(config):
+    # Use another config file (a path) or an already loaded LibraryConfig
+    # (e.g. pickled from the parent process) from now on
+    global config_path, library_config
+    if isinstance(config, LibraryConfig):
+        library_config = config
+    else:
+        config_path = config
+        library_config = None
+
+
 def get_docs_config(config):
-    docs_config = namedtuple("Docs", ["file_pattern", "src_path", "dest_path"])
-    return docs_config(
+    return Docs(
         file_pattern=config["Library-docs"]["filePattern"],
         src_path=Path(config["Library-docs"]["srcPath"]).resolve(),
         dest_path=Path(config["Library-docs"]["destPath"]),
+        # optional, older config files don't have the doc pages settings
+        pages_path=Path(config["Library-docs"].get("pagesPath", "../public/docs/")),
     )
 
 
 def get_label_config(config):
-    label_config = namedtuple(
-        "Labels",
-        [
-            "id",
-            "access",
-            "filename",
-            "publishedURL",
-            "displayURL",
-            "displayIcon",
-            "status",
-        ],
-    )
-    return label_config(
+    return Labels(
         id=config["Column-labels"]["id"],
         access=config["Column-labels"]["access"],
         filename=config["Column-labels"]["filename"],
@@ -51,10 +191,7 @@ def get_label_config(config):
 
 
 def get_access_values(config):
-    access_config = namedtuple(
-        "AccessValues", ["open", "physical_library", "publisher"]
-    )
-    return access_config(
+    return AccessValues(
         open=config["Access-values"]["open"],
         physical_library=config["Access-values"]["physicalLibrary"],
         publisher=config["Access-values"]["publisher"],
@@ -62,16 +199,14 @@ def get_access_values(config):
 
 
 def get_status_values(config):
-    status_values = namedtuple("StatusValues", ["active", "deleted"])
-    return status_values(
+    return StatusValues(
         active=config["Status-values"]["active"],
         deleted=config["Status-values"]["deleted"],
     )
 
 
 def get_icons(config):
-    icons = namedtuple("Icons", ["webpage", "download", "support", "library"])
-    return icons(
+    return Icons(
         webpage=config["Icons"]["webpage"],
         download=config["Icons"]["download"],
         support=config["Icons"]["support"],
@@ -80,30 +215,19 @@ def get_icons(config):
 
 
 def get_urls(config):
-    urls = namedtuple("URLs", ["physical_library", "contact_us", "download"])
-    return urls(
+    return URLs(
         physical_library=config["URLs"]["physicalLibrary"],
         contact_us=config["URLs"]["contactUs"],
         download=config["URLs"]["download"],
+        doc_pages=config["URLs"].get("docPages", "/docs/"),
+        site=config["URLs"].get("site", "").rstrip("/"),
     )
 
 
 def get_internal_files():
     # these are hard-coded file paths, for internal processing
     # use only so they don't need to be configurable.
-    local_paths = namedtuple(
-        "LocalPaths",
-        [
-            "doc_display_config",
-            "search_config",
-            "filter_config",
-            "query_config",
-            "excel_file",
-            "libindex_csv",
-            "libindex_json",
-        ],
-    )
-    return local_paths(
+    return LocalPaths(
         doc_display_config=Path("outputs/doc-display-config.csv").resolve(),
         search_config=Path("outputs/search-config.csv").resolve(),
         filter_config=Path("outputs/filter-config.csv").resolve(),
@@ -111,15 +235,56 @@ def get_internal_files():
         excel_file=Path("inputs/library-index.xlsx").resolve(),
         libindex_csv=Path("outputs/library-index.csv").resolve(),
         libindex_json=Path("outputs/library-index.json").resolve(),
+        docs_manifest=Path("outputs/library-docs-manifest.json").resolve(),
+        src_dir_index=Path("outputs/source-dir-index.json").resolve(),
+        rejected_csv=Path("outputs/rejected-rows.csv").resolve(),
+        rejected_json=Path("outputs/rejected-rows.json").resolve(),
+        search_index=Path("outputs/search-index.json").resolve(),
+        facet_index=Path("outputs/facet-index.json").resolve(),
+        sort_config=Path("outputs/sort-config.csv").resolve(),
+        sort_index=Path("outputs/sort-index.json").resolve(),
+        libindex_shards=Path("outputs/library-index").resolve(),
+        fingerprints=Path("outputs/doc-fingerprints.json").resolve(),
+        libindex_delta=Path("outputs/library-index-delta.json").resolve(),
+        build_report=Path("outputs/build-report.json").resolve(),
+        profile_dir=Path("outputs/profile").resolve(),
+        doc_text_cache=Path("outputs/doc-text").resolve(),
+        duplicates_report=Path("outputs/duplicate-docs.json").resolve(),
+        url_cache=Path("outputs/url-cache.json").resolve(),
+        url_check=Path("outputs/url-check.csv").resolve(),
+        libindex_cache=Path("outputs/library-index.parquet").resolve(),
+        libindex_ndjson=Path("outputs/library-index.ndjson").resolve(),
+        doc_pages=Path("outputs/doc-pages.json").resolve(),
     )
 
 
-# load config info for use
-config = load_config()
-docs = get_docs_config(config)
-label = get_label_config(config)
-access_types = get_access_values(config)
-status_types = get_status_values(config)
-icons = get_icons(config)
-urls = get_urls(config)
-files = get_internal_files()
+class LazySection:
+    # Stands in for one of the parts of the config (e.g. docs) so it can
+    # be imported before the config is loaded, the config is loaded the
+    # first time one of its values is used
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(getattr(get_config(), self._name), attr)
+
+    def __repr__(self):
+        return repr(getattr(get_config(), self._name))
+
+    def __iter__(self):
+        return iter(getattr(get_config(), self._name))
+
+    def __reduce__(self):
+        # pickled as the loaded values, not as a reference to the file
+        return getattr, (get_config(), self._name)
+
+
+# the parts of the config for use
+docs = LazySection("docs")
+label = LazySection("label")
+access_types = LazySection("access_types")
+status_types = LazySection("status_types")
+icons = LazySection("icons")
+urls = LazySection("urls")
+files = LazySection("files")
@@ -3,22 +3,88 @@
 
     This reads the library-index spreadsheet and generates a
     library-index.json file from the information in the spreadsheet.
+    It also writes the query config and a prebuilt search index, facet
+    index and sort index for the website.
+
+    With --sharded the library index is also split into shards in
+    outputs/library-index/: one "cards" shard with the fields needed to
+    list and filter the docs, and "details" shards with the rest of the
+    fields (abstracts etc) for DETAIL_SHARD_SIZE docs at a time, so they
+    can be fetched when a doc is opened. Each shard is named after the
+    hash of its contents and manifest.json lists them, so the website
+    can cache the shards forever.
+
+    The JSON files are minified, fields that are "NO VALUE" are left
+    out of the docs (apart from the filter fields) and a .gz and .br
+    copy of each file is written for the web server. The sizes are
+    logged and --size-budget fails the run if the gzipped files add up
+    to more than the budget.
+
+    A fingerprint of the settings and config is kept in
+    outputs/doc-fingerprints.json along with a hash of each spreadsheet
+    row and of each doc in the library index, by ID. If nothing has
+    changed since the last run there is nothing to rebuild. If only
+    some rows have been added, changed or removed, only those rows are
+    filtered and tidied up, and the library index, rejected rows,
+    search index and facet index from the last run are patched with
+    their docs (the sort index and shards are made again from the
+    patched docs). Everything is rebuilt if the settings or config
+    have changed, the rows have been moved around or the IDs aren't
+    unique, a shard or doc page is missing or doesn't have the hash its
+    manifest lists, and with --full. Files whose contents haven't changed
+    aren't rewritten, and library-index-delta.json lists the IDs of
+    the docs added, updated and removed by the run.
+
+    The time, CPU time, peak memory and rows in and out of each step
+    are logged as a table at the end and saved in build-report.json
+    (replacing the steps of the same name from an earlier run and
+    keeping those of the other scripts), --profile also saves a
+    cProfile file for each step.
+
+    With --full-text the text of the open access PDFs in the library is
+    added to the search index (see texthelper.py).
+
+    With --check-urls the publisher URLs are checked (see urlhelper.py),
+    docs whose URL is gone (404 or 410) are rejected and the state of
+    each doc's URL is written to outputs/url-check.csv.
+
+    With --pages a static HTML page is written for each doc, along with
+    a sitemap of them (see pagehelper.py). Only the pages of docs that
+    have changed are written again.
+
+    For very large libraries --stream reads the rows --chunk-rows at a
+    time and writes the docs to library-index.json as each chunk is
+    filtered (to a temporary file that replaces it at the end), so the
+    memory used stays the same however many docs there are. Only the
+    library index, the query config and the rejected rows are written,
+    as the prebuilt indexes and the shards need all of the docs at
+    once. --ndjson writes library-index.ndjson instead, one doc per
+    line.
 
     The paths and names of files are all defined in constants at
     the top of the file, as are the column names for the csv file.
 
     The script requires the structlog library to be installed
-    (used for logging).
+    (used for logging). The .br files are only written if the Brotli
+    library is installed, --full-text needs the pypdf library and
+    --check-urls needs the aiohttp library.
 """
+import numpy as np
 import pandas as pd
+import collections
+import contextlib
+import hashlib
 import json
 import os
-import csv
 import re
-import logging
-import structlog
+import csv
 import argparse
+import cachehelper
 import libhelper
+import pagehelper
+import searchhelper
+import texthelper
+import urlhelper
 from confighelper import (
     docs,
     label,
@@ -33,36 +99,97 @@ from confighelper import (
 # TODO - move into a new row in the spreadsheet like the search and filter flags
 MULTI_OPTION_COLS = ["Catchment", "State", "Habitat_type", "Region"]
 
+NO_VALUE = searchhelper.NO_VALUE
+
+# bump to make the next run rebuild everything after changing how
+# the website files are made
+FINGERPRINT_VERSION = 2
+
+# number of docs in each details shard
+DETAIL_SHARD_SIZE = 200
+
+# rows read at a time with --stream
+DEFAULT_CHUNK_ROWS = 10000
+
+# the sortings used when the spreadsheet doesn't have a sort row
+DEFAULT_SORTINGS = {
+    "name_asc": {
+        "field": "Title",
+        "order": "asc",
+    },
+    "year_name_asc": {
+        "field": ["Year", "Title"],
+        "order": ["desc", "asc"],
+    },
+}
+
+# a sort definition in a cell of the sort row, e.g. Sort_name_asc:1:asc
+SORT_TOKEN_PATTERN = re.compile(
+    r"Sort_(?P<name>\w+):(?P<position>\d+):(?P<order>asc|desc)"
+)
+
 is_dry_run = False
 
 
-def split_multi_option_values(lib_data):
-    # Split the multi-option columns in to lists of strings
-    # hopefully this won't break the lib_docs.to_json function
+def split_multi_option_values(log, lib_data):
+    # Split the multi-option columns in to their tokens
 
     #   For the keys in MULTI_OPTION_COLS, the value of the item for that key is
     #   a string containing 1 or more tokens separated by commas.
-    #   Extract the tokens and replace the value with an array of strings
-    #   where each string is a token.
+    #   The tokens are kept in a long-form table for each column, a
+    #   categorical Series with one entry per (doc, token) indexed by the
+    #   doc's row label, and the column itself is made categorical. So
+    #   the memory used grows with the number of distinct values rather
+    #   than with a list per doc. create_library_index turns the tokens
+    #   back into an array of strings for each doc.
     #
+    multi_options = {}
     for column in MULTI_OPTION_COLS:
         log.debug(
-            "split_multi_option_values: splitting {}\n  orig\n{} \nsplit values{}".format(
-                column, lib_data[column], lib_data[column].str.split(",")
-            )
+            "split_multi_option_values: splitting", column=column, orig=lib_data[column]
+        )
+        multi_options[column] = (
+            lib_data[column].str.split(",").explode().str.strip().astype("category")
         )
-        lib_data[column] = (
-            lib_data[column]
-            .str.split(",")
-            .apply(lambda x: [item.strip() for item in x])
+        lib_data[column] = lib_data[column].astype("category")
+        log.debug(
+            "split_multi_option_values: split",
+            column=column,
+            values=multi_options[column],
         )
-        log.debug("split_multi_option_values: lib_data[{}]\n".format(lib_data[column]))
 
-    return lib_data
+    return lib_data, multi_options
 
 
-def create_library_index(log, is_dry_run, lib_data):
-    log.info("Creating library_index for website, {}".format(files.libindex_json))
+def get_records(lib_data, keep_fields=()):
+    # The docs as dictionaries, leaving out the fields that are
+    # "NO VALUE" unless they are in keep_fields (the filters still need
+    # them so docs without a value can be picked)
+    return [
+        {
+            key: value
+            for key, value in record.items()
+            if key in keep_fields or value != NO_VALUE
+        }
+        for record in lib_data.to_dict("records")
+    ]
+
+
+def get_records_json(lib_data, keep_fields=()):
+    # The docs as a minified JSON array (see get_records)
+    return json.dumps(
+        get_records(lib_data, keep_fields), ensure_ascii=False, separators=(",", ":")
+    )
+
+
+def set_display_fields(lib_data, multi_options):
+    # Turn the multi-option fields back into lists and set the link and
+    # icon of each doc for the website
+
+    # the website expects an array of strings for the multi-option fields
+    for column, values in multi_options.items():
+        if column in lib_data.columns:
+            lib_data[column] = values.groupby(level=0, sort=False).agg(list)
 
     # set label.url value for access via a physical library
     lib_data.loc[
@@ -88,122 +215,456 @@ def create_library_index(log, is_dry_run, lib_data):
         lib_data[label.access] == access_types.publisher, label.displayIcon
     ] = icons.webpage
 
+    return lib_data
+
+
+def create_library_index(log, is_dry_run, lib_data, multi_options, keep_fields=()):
+    log.info("Creating library_index for website", file=str(files.libindex_json))
+    lib_data = set_display_fields(lib_data, multi_options)
+
     # convert the list of dictionary items to json string format
-    json_lib_data = lib_data.to_json(orient="records")
-    log.info("Documents in library, final count: {}".format(lib_data.index.size))
+    records = get_records(lib_data, keep_fields)
+    write_library_index(log, is_dry_run, records)
+
+    return lib_data, records
+
+
+def write_library_index(log, is_dry_run, records):
+    json_lib_data = json.dumps(records, ensure_ascii=False, separators=(",", ":"))
+    log.info("Documents in library, final count", count=len(records))
 
     if not is_dry_run:
         # write library-index file for the website to use
-        json_array_output_file = files.libindex_json.open(mode="w", encoding="utf-8")
-        json_array_output_file.write(json_lib_data)
+        is_changed = libhelper.write_text_if_changed(files.libindex_json, json_lib_data)
+        log.info("Wrote JSON file", file=str(files.libindex_json), changed=is_changed)
+
+
+def get_doc_id(record):
+    # the ID is left out of a doc if it is "NO VALUE"
+    return record.get(label.id, NO_VALUE)
+
+
+def patch_records(old_records, records, drop_ids, row_ids):
+    # The docs from the last run with those of drop_ids (the rows that
+    # have changed or gone) replaced by records, the docs of the rows
+    # that have changed, in the same order as the rows (row_ids are the
+    # IDs of all of the rows in order). Returns the docs, the new
+    # ordinal of each old doc (-1 if it has gone) and the ordinal of
+    # each of records.
+    row_positions = {doc_id: position for position, doc_id in enumerate(row_ids)}
+    old_ordinals = [
+        ordinal
+        for ordinal, record in enumerate(old_records)
+        if get_doc_id(record) not in drop_ids
+    ]
+    docs = [old_records[ordinal] for ordinal in old_ordinals] + records
+    positions = np.array(
+        [row_positions[get_doc_id(record)] for record in docs], dtype=np.int64
+    )
+    order = np.argsort(positions, kind="stable")
+    new_ordinals = np.empty(positions.size, dtype=np.int64)
+    new_ordinals[order] = np.arange(positions.size)
+
+    ordinal_map = np.full(len(old_records), -1, dtype=np.int64)
+    ordinal_map[old_ordinals] = new_ordinals[: len(old_ordinals)]
+    return (
+        [docs[position] for position in order],
+        ordinal_map,
+        new_ordinals[len(old_ordinals) :],
+    )
 
-        log.info("Wrote JSON file to {}".format(files.libindex_json))
 
-    return lib_data
+def get_card_fields(lib_data, filter_fields, sortings):
+    # The fields for the cards shard, in the same order as lib_data. The
+    # title, ID, link and icon are always in it, as well as the filter
+    # and sort fields.
+    card_fields = {"Title", label.id, label.displayURL, label.displayIcon}
+    card_fields.update(filter_fields)
+    for sorting in sortings.values():
+        fields = sorting["field"]
+        card_fields.update([fields] if isinstance(fields, str) else fields)
+    return [column for column in lib_data.columns if column in card_fields]
+
+
+def is_shard_intact(shard_file, sha256):
+    # True if the shard is there and its contents have the hash it is
+    # listed with
+    return shard_file.is_file() and libhelper.get_file_hash(shard_file) == sha256
 
 
-def get_searchable_fields(log):
-    data = pd.read_csv(files.search_config)
+def create_sharded_index(log, is_dry_run, lib_data, card_fields):
+    # Split the library index into the cards shard and the details
+    # shards and write the manifest. The details shards have the ID as
+    # well so a doc can be matched up with its card.
+    detail_fields = [label.id] + [
+        column for column in lib_data.columns if column not in card_fields
+    ]
+    # the columns are picked out once, each shard is a slice of them
+    details = lib_data[detail_fields]
+    shards = [("cards", lib_data[card_fields], 0)]
+    for first in range(0, lib_data.index.size, DETAIL_SHARD_SIZE):
+        shards.append(
+            ("details", details.iloc[first : first + DETAIL_SHARD_SIZE], first)
+        )
+
+    shard_path = files.libindex_shards
+    manifest = {
+        "version": 1,
+        "num_docs": lib_data.index.size,
+        "card_fields": card_fields,
+        "detail_fields": detail_fields,
+        "detail_shard_size": DETAIL_SHARD_SIZE,
+        "cards": None,
+        "details": [],
+    }
+    if not is_dry_run:
+        shard_path.mkdir(parents=True, exist_ok=True)
+
+    for prefix, shard_data, first in shards:
+        # each shard is named after the hash of its contents, so a shard
+        # that is already there with that hash doesn't need writing again
+        json_data = get_records_json(shard_data, card_fields)
+        sha256 = hashlib.sha256(json_data.encode("utf-8")).hexdigest()
+        shard_name = "{}-{}.json".format(prefix, sha256[:16])
+        shard_file = shard_path.joinpath(shard_name)
+        if not is_dry_run and not is_shard_intact(shard_file, sha256):
+            shard_file.write_text(json_data, encoding="utf-8")
+        shard = {"file": shard_name, "sha256": sha256, "bytes": len(json_data)}
+        if prefix == "cards":
+            manifest["cards"] = shard
+        else:
+            manifest["details"].append(
+                dict(shard, first=first, count=shard_data.index.size)
+            )
+
+    log.info(
+        "Sharded library index",
+        card_fields=card_fields,
+        cards_bytes=manifest["cards"]["bytes"],
+        detail_shards=len(manifest["details"]),
+        detail_bytes=sum(shard["bytes"] for shard in manifest["details"]),
+    )
+    if is_dry_run:
+        return manifest
+
+    # Write the manifest to a temporary file first so the website never
+    # sees a half written one, then remove the shards no longer in it
+    manifest_file = shard_path.joinpath("manifest.json")
+    tmp_file = shard_path.joinpath("manifest.json.tmp")
+    manifest_json = json.dumps(manifest, indent=1)
+    if not manifest_file.exists() or manifest_file.read_text("utf-8") != manifest_json:
+        tmp_file.write_text(manifest_json, encoding="utf-8")
+        os.replace(tmp_file, manifest_file)
+
+    shard_names = {manifest["cards"]["file"]} | {
+        shard["file"] for shard in manifest["details"]
+    }
+    num_removed = 0
+    for shard_file in shard_path.glob("*-*.json*"):
+        # includes the compressed copies of the shards
+        if shard_file.name.partition(".json")[0] + ".json" not in shard_names:
+            shard_file.unlink()
+            num_removed += 1
+    log.info(
+        "Wrote sharded library index",
+        file=str(manifest_file),
+        shards=len(shard_names),
+        removed=num_removed,
+    )
+    return manifest
+
+
+def create_search_index(
+    log, is_dry_run, lib_data, search_fields, bodies=None, patch=None
+):
+    # Write the prebuilt full-text search index for the docs in
+    # lib_data, so the website doesn't have to index them on every page
+    # load. See searchhelper.py for the format. With patch, the ordinal
+    # map and new ordinals from patch_records, lib_data is only the docs
+    # of the rows that have changed and the search index from the last
+    # run is patched with them.
+    search_index = searchhelper.build_search_index(lib_data, search_fields, bodies)
+    if patch is not None:
+        old_index = json.loads(files.search_index.read_text(encoding="utf-8"))
+        search_index = searchhelper.patch_search_index(old_index, search_index, *patch)
+    log.info(
+        "Built search index",
+        fields=search_index["fields"],
+        terms=len(search_index["terms"]),
+    )
+
+    if not is_dry_run:
+        is_changed = libhelper.write_text_if_changed(
+            files.search_index, json.dumps(search_index, separators=(",", ":"))
+        )
+        log.info(
+            "Wrote search index", file=str(files.search_index), changed=is_changed
+        )
+
+
+def get_searchable_fields(log, data=None):
+    if data is None:
+        data = pd.read_csv(files.search_config)
     search_fields = data.columns[data.iloc[0]].to_list()
-    log.info("The searchable fields for libary are: {}".format(search_fields))
+    log.info("The searchable fields for library", fields=search_fields)
     return search_fields
 
 
-def get_filter_list(log):
-    data = pd.read_csv(files.filter_config)
+def get_filter_list(log, data=None):
+    if data is None:
+        data = pd.read_csv(files.filter_config)
     filter_items = data.columns[data.iloc[0]].to_list()
-    log.info("The filter fields for library are: {}".format(filter_items))
+    log.info("The filter fields for library", fields=filter_items)
     return filter_items
 
 
-def remove_private_details(log, lib_data):
+def get_sortings(log, data=None):
+    # Each cell of the sort row lists the sorts that use that column as
+    # comma separated Sort_<name>:<position>:<asc|desc> tokens, e.g. the
+    # Year column has "Sort_year_name_asc:1:desc" and the Title column
+    # has "Sort_name_asc:1:asc, Sort_year_name_asc:2:asc". A sort on
+    # more than one column sorts on them in order of position.
+    if data is None:
+        if not files.sort_config.exists():
+            log.info("No sort config file, using the default sortings")
+            return DEFAULT_SORTINGS
+        data = pd.read_csv(files.sort_config, dtype="str", keep_default_na=False)
+
+    sort_fields = {}
+    cells = data.iloc[0].items() if not data.empty else []
+    for field, cell in cells:
+        for token in cell.split(","):
+            token = token.strip()
+            if not token or token == "Sort_no":
+                continue
+            match = SORT_TOKEN_PATTERN.fullmatch(token)
+            if match is None:
+                log.warning("Ignored sort definition", field=field, value=token)
+                continue
+            sort_fields.setdefault(match["name"], []).append(
+                (int(match["position"]), field, match["order"])
+            )
+
+    if not sort_fields:
+        log.info("No sortings in the spreadsheet, using the default sortings")
+        return DEFAULT_SORTINGS
+
+    sortings = {}
+    for name, fields in sort_fields.items():
+        fields.sort(key=lambda sort_field: sort_field[0])
+        if len(fields) == 1:
+            _, field, order = fields[0]
+            sortings[name] = {"field": field, "order": order}
+        else:
+            sortings[name] = {
+                "field": [field for _, field, _ in fields],
+                "order": [order for _, _, order in fields],
+            }
+    log.info("The sortings for library", sortings=list(sortings))
+    return sortings
+
+
+def get_private_columns(public_labels):
+    # The columns that are set to False in the display config
+    return public_labels.columns[~public_labels.iloc[0]].to_list()
+
+
+def remove_private_details(log, lib_data, public_labels=None):
     # Read in the appropriate config file and drop any columns
     # from lib_data that are set to False in the config file
 
-    public_labels = pd.read_csv(files.doc_display_config)
-    col_list = public_labels.columns[~public_labels.iloc[0]].to_list()
+    if public_labels is None:
+        public_labels = pd.read_csv(files.doc_display_config)
+    col_list = get_private_columns(public_labels)
     lib_data = lib_data.drop(columns=col_list)
-    log.info("Dropped {} columns".format(col_list))
+    log.info("Dropped columns", columns=col_list)
 
     return lib_data
 
 
-def remove_invalid_access_rows(log, lib_data):
-    # Get a list of docs with an invalid access type
-    problem_docs = lib_data[
-        ~lib_data[label.access].isin(access_types._asdict().values())
-    ]
-    # log a warning message for these problem docs
-    for index, row in problem_docs.iterrows():
-        log.warning(
-            "ID {} | Invalid access value, {} ".format(index, row[label.access])
-        )
+def get_validation_rules(lib_data, dead_urls=None, doc_list=None, collision_ids=()):
+    # Each rule is a boolean mask of the rows that break it and the
+    # column whose value is reported for those rows. dead_urls are the
+    # publisher URLs that are gone, if they have been checked, and
+    # collision_ids the rows whose file name is another row's (see
+    # load_name_collisions).
 
-    # log.debug("remove_invalid_access_rows: problem_docs\n{}".format(problem_docs))
-
-    # Drop any docs with invalid access values
-    lib_data = lib_data.drop(index=problem_docs.index.to_list())
-    log.info(
-        "Number of docs dropped due invalid access types is {}".format(
-            problem_docs.index.size
+    # Get the list of files for the library.
+    if doc_list is None:
+        doc_list = os.listdir(docs.dest_path)
+    access = lib_data[label.access]
+
+    rules = {
+        # docs with an invalid access type
+        "invalid_access": (
+            ~access.isin(access_types._asdict().values()),
+            label.access,
+        ),
+        # open access docs that don't have a file in the library
+        "open_access_no_file": (
+            (access == access_types.open) & ~lib_data[label.filename].isin(doc_list),
+            label.filename,
+        ),
+        # open access docs whose file name is another doc's once
+        # normalised, the file in the library is the other doc's
+        "file_name_collision": (
+            (access == access_types.open) & lib_data[label.id].isin(collision_ids),
+            label.filename,
+        ),
+        # external access docs that don't have a URL in the lib data (the
+        # empty cells are "NO VALUE" by now)
+        "publisher_no_url": (
+            (access == access_types.publisher)
+            & lib_data[label.publishedURL].isin(["", NO_VALUE]),
+            label.publishedURL,
+        ),
+    }
+    if dead_urls is not None:
+        # external access docs whose URL is gone
+        rules["publisher_dead_url"] = (
+            (access == access_types.publisher)
+            & lib_data[label.publishedURL].isin(dead_urls),
+            label.publishedURL,
         )
-    )
+    return rules
 
-    return lib_data
 
+def remove_invalid_rows(log, is_dry_run, lib_data, dead_urls=None, collision_ids=()):
+    # Check every row against all of the validation rules at once, write
+    # the rows that break a rule to the rejected rows files (one row
+    # per ID and rule, with the offending value) and drop them.
+    rules = get_validation_rules(lib_data, dead_urls, collision_ids=collision_ids)
+    rejected, is_rejected = get_rejected_rows(lib_data, rules)
 
-def remove_openaccess_nofilename_rows(log, lib_data):
-    # Remove all rows where access is open and filename is empty
+    for rule, (mask, _) in rules.items():
+        log.info("Number of docs dropped by rule", rule=rule, count=int(mask.sum()))
 
-    # Get the list of files for the library.
-    doc_list = os.listdir(docs.dest_path)
+    write_rejected_rows(log, is_dry_run, rejected)
+    return lib_data[~is_rejected]
 
-    # Get a list of the open access docs that don't have a file in the library
-    problem_docs = lib_data[
-        (lib_data[label.access] == access_types.open)
-        & (~lib_data[label.filename].isin(doc_list))
-    ]
-    # log a warning message for these problem docs
-    for index, doc in problem_docs.iterrows():
-        log.warning(
-            "ID {} | {} access document file is missing, {}".format(
-                index, access_types.open, doc[label.filename]
-            )
+
+def write_rejected_rows(log, is_dry_run, rejected):
+    if not is_dry_run:
+        rejected.to_csv(files.rejected_csv, index=False, encoding="utf-8")
+        files.rejected_json.write_text(
+            rejected.to_json(orient="records"), encoding="utf-8"
+        )
+        log.info(
+            "Wrote rejected rows",
+            count=rejected.index.size,
+            files=[str(files.rejected_csv), str(files.rejected_json)],
         )
 
-    # Drop any open access documents that we don't have a copy of the document for
-    lib_data = lib_data.drop(index=problem_docs.index.to_list())
-    log.info(
-        "Number of docs dropped due to access is {} but no file found is {}".format(
-            access_types.open, problem_docs.index.size
+
+def patch_rejected_rows(log, is_dry_run, lib_data, rules, drop_ids, row_ids):
+    # Write the rejected rows from the last run with those of drop_ids
+    # (the rows that have changed or gone) replaced by the rows of
+    # lib_data that break the rules, in the same order as
+    # get_rejected_rows: by rule then by row (row_ids are the IDs of all
+    # of the rows in order). Returns the rows of lib_data that don't
+    # break any of the rules.
+    rejected, is_rejected = get_rejected_rows(lib_data, rules)
+    for rule, (mask, _) in rules.items():
+        log.info(
+            "Number of changed docs dropped by rule", rule=rule, count=int(mask.sum())
         )
+
+    old_rejected = pd.read_csv(files.rejected_csv, dtype="str", keep_default_na=False)
+    old_rejected = old_rejected[~old_rejected[label.id].isin(drop_ids)]
+    rejected = pd.concat([old_rejected, rejected], ignore_index=True)
+    rule_positions = {rule: position for position, rule in enumerate(rules)}
+    row_positions = {doc_id: position for position, doc_id in enumerate(row_ids)}
+    order = pd.DataFrame(
+        {
+            "rule": rejected["rule"].map(rule_positions),
+            "row": rejected[label.id].map(row_positions),
+        }
+    ).sort_values(["rule", "row"])
+    write_rejected_rows(
+        log, is_dry_run, rejected.loc[order.index].reset_index(drop=True)
+    )
+    return lib_data[~is_rejected]
+
+
+def get_rejected_rows(lib_data, rules):
+    # The rows that break the rules (one row per ID and rule, with the
+    # offending value) and a mask of the rows that break any of them
+    rejected = pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    label.id: lib_data.loc[mask, label.id],
+                    "rule": rule,
+                    "value": lib_data.loc[mask, column],
+                }
+            )
+            for rule, (mask, column) in rules.items()
+        ],
+        ignore_index=True,
     )
+    is_rejected = pd.concat([mask for mask, _ in rules.values()], axis=1).any(axis=1)
+    return rejected, is_rejected
 
-    return lib_data
+
+def load_name_collisions():
+    # The IDs of the rows that get-library-docs.py didn't copy because
+    # their file name is the same as another row's once normalised
+    if not files.duplicates_report.exists():
+        return []
+    duplicates = json.loads(files.duplicates_report.read_text(encoding="utf-8"))
+    return sorted(collision["id"] for collision in duplicates["name_collisions"])
 
 
-def remove_publisheraccess_nourl_rows(log, lib_data):
-    # Get a list of the external access docs that don't have a URL in the lib data
-    problem_docs = lib_data[
+def check_publisher_urls(log, is_dry_run, lib_data, ttl_hours):
+    # Check the URLs of the active external access docs and write the
+    # state of each doc's URL to the url check file. Returns the URLs
+    # that are gone.
+    rows = lib_data[
         (lib_data[label.access] == access_types.publisher)
-        & (lib_data[label.publishedURL] == "")
+        & ~lib_data[label.publishedURL].isin(["", NO_VALUE])
     ]
-    # log a warning message for these problem docs
-    for index, doc in problem_docs.iterrows():
+    if label.status in rows.columns:
+        rows = rows[rows[label.status] == status_types.active]
+    results = urlhelper.check_publisher_urls(
+        log, is_dry_run, rows[label.publishedURL].tolist(), files.url_cache, ttl_hours
+    )
+    if not results:
+        return None  # not checked
+
+    row_results = [results[url] for url in rows[label.publishedURL]]
+    url_check = pd.DataFrame(
+        {
+            label.id: rows[label.id],
+            "url": rows[label.publishedURL],
+            "state": [urlhelper.get_url_state(result) for result in row_results],
+            "status": pd.array(
+                [result["status"] for result in row_results], dtype="Int64"
+            ),
+            "method": [result["method"] for result in row_results],
+            "error": [result["error"] for result in row_results],
+            "checked": pd.to_datetime(
+                [result["checked"] for result in row_results], unit="s", utc=True
+            ),
+        }
+    )
+    for _, row in url_check[url_check["state"] != "ok"].iterrows():
         log.warning(
-            "ID {} | Doc with {} access {} value is empty".format(
-                index, access_types.publisher, label.publishedURL
-            )
+            "Publisher URL doesn't work",
+            id=row[label.id],
+            url=row["url"],
+            state=row["state"],
+            status=row["status"],
+            error=row["error"],
         )
+    log.info("Publisher URL states", **url_check["state"].value_counts().to_dict())
 
-    # Drop any open access documents that we don't have a copy of the document for
-    lib_data = lib_data.drop(index=problem_docs.index.to_list())
-    log.info(
-        "Number of docs dropped due to being {} but having no URL is {}".format(
-            access_types.publisher, problem_docs.index.size
-        )
+    if not is_dry_run:
+        url_check.to_csv(files.url_check, index=False, encoding="utf-8")
+        log.info("Wrote publisher URL states", file=str(files.url_check))
+
+    return sorted(
+        url for url, result in results.items() if urlhelper.is_url_dead(result)
     )
-    return lib_data
 
 
 def remove_nonactive_rows(log, lib_data):
@@ -212,86 +673,883 @@ def remove_nonactive_rows(log, lib_data):
     initial_num_docs = lib_data.index.size
     if label.status in lib_data.columns:
         lib_data = lib_data[lib_data.Status == status_types.active]
-        log.info("Extracted only the {} records to process".format(status_types.active))
+        log.info("Extracted only the records to process", status=status_types.active)
 
     log.info(
-        "Number of docs dropped due to Status not set to {} is {}".format(
-            status_types.active, initial_num_docs - lib_data.index.size
-        )
+        "Number of docs dropped due to Status",
+        status=status_types.active,
+        count=initial_num_docs - lib_data.index.size,
     )
 
     return lib_data
 
 
-def create_query_config(log, lib_data, search_fields, filter_fields):
-    # TODO Sorting config is still hard-coded, need to fix this at some point
+def create_facet_index(log, is_dry_run, facet_index):
+    # Write the docs for every value of each filter field, so the
+    # website can apply the filters without looking at every doc.
+    # See searchhelper.py for the format.
+    if not is_dry_run:
+        is_changed = libhelper.write_text_if_changed(
+            files.facet_index, json.dumps(facet_index, separators=(",", ":"))
+        )
+        log.info("Wrote facet index", file=str(files.facet_index), changed=is_changed)
+
+
+def create_sort_index(log, is_dry_run, lib_data, sortings):
+    # Write the doc ordinals in order for each sorting, so the website
+    # can sort results by picking them out of the presorted list.
+    # See searchhelper.py for the format.
+    sort_index = searchhelper.build_sort_index(lib_data, sortings)
+    log.info("Built sort index", sortings=list(sort_index["sortings"]))
+
+    if not is_dry_run:
+        is_changed = libhelper.write_text_if_changed(
+            files.sort_index, json.dumps(sort_index, separators=(",", ":"))
+        )
+        log.info("Wrote sort index", file=str(files.sort_index), changed=is_changed)
+
+
+def create_query_config(log, facet_index, search_fields, filter_fields, sortings):
+    # facet_index can also be the facet stats from the streaming mode
+    # (see get_facet_stats), only the values of each facet are used
     log.debug("about to start create_query_config function")
-    log.info("Search fields {}".format(search_fields))
-    log.info("Filter fields {}".format(filter_fields))
+    log.info("Search fields", fields=search_fields)
+    log.info("Filter fields", fields=filter_fields)
 
     # build aggregations structure as a Dictionary
     filters = {}
     for field in filter_fields:
-        if field not in lib_data.columns:
-            continue  # skip on to the next filter field
-
-        field_id = re.sub(
-            r"[^A-Za-z0-9]", "_", field
-        )  # replace spaces etc with underscores
+        field_id = searchhelper.get_field_id(field)
+        if field_id not in facet_index["facets"]:
+            continue  # not in lib_data, skip on to the next filter field
 
         log.debug(
-            "create_query_config: field {}. Is this a multi-option field? {}".format(
-                field, field in MULTI_OPTION_COLS
-            )
+            "create_query_config: field",
+            field=field,
+            is_multi_option=field in MULTI_OPTION_COLS,
         )
-        if field in MULTI_OPTION_COLS:
-            unique_filters = set(x for sublist in lib_data[field] for x in sublist)
-        else:
-            unique_filters = lib_data[field].unique().tolist()
+        unique_filters = facet_index["facets"][field_id]["values"]
 
         log.debug(
-            "create_query_string: field {}, field_id {}, unique_filters: {}".format(
-                field, field_id, unique_filters
-            )
+            "create_query_config: unique filters",
+            field=field,
+            field_id=field_id,
+            unique_filters=unique_filters,
         )
         filters[field_id] = {"title": field, "size": len(unique_filters)}
-        # log.debug(
-        #     "create_query_string: filters[{}]: {}".format(field_id, filters[field_id])
-        # )
+        # log.debug("create_query_config", field_id=field_id, filter=filters[field_id])
 
     query_config = {
-        "sortings": {
-            "name_asc": {
-                "field": "Title",
-                "order": "asc",
-            },
-            "year_name_asc": {
-                "field": ["Year", "Title"],
-                "order": ["desc", "asc"],
-            },
-        },
+        "sortings": sortings,
         "searchableFields": search_fields,
         "aggregations": filters,
     }
 
-    log.debug("create_query_config: query_config({})".format(query_config))
+    log.debug("create_query_config", query_config=query_config)
 
     # Create/overwrite query_config json file
     # See confighelper.py for file names
-    config_file = files.query_config.write_text(
-        json.dumps(query_config), encoding="utf-8"
+    is_changed = libhelper.write_text_if_changed(
+        files.query_config, json.dumps(query_config, separators=(",", ":"))
     )
 
-    log.info("Query config into written to {}".format(files.query_config))
+    log.info("Query config written", file=str(files.query_config), changed=is_changed)
 
 
-if __name__ == "__main__":
-    # Specify level of entries to log
-    structlog.configure(
-        wrapper_class=structlog.make_filtering_bound_logger(logging.INFO),
+def read_library_data(log):
+    # Every column goes into the outputs, so the whole cache is read
+    if cachehelper.is_cache_current(files.libindex_cache, files.libindex_csv):
+        log.info("Loading cache file", file=str(files.libindex_cache))
+        return prepare_library_data(cachehelper.read_lib_data(files.libindex_cache))
+
+    log.info("Loading csv file", file=str(files.libindex_csv))
+
+    # Read in data from the library-index.csv file and ensure that
+    # there are no leading or trailing spaces on the contents
+    lib_data = pd.read_csv(
+        files.libindex_csv, dtype="str", skipinitialspace=True
+    ).fillna(NO_VALUE)
+    return lib_data
+
+
+def prepare_library_data(lib_data):
+    # Tidy up data that is already in memory (empty cells are empty
+    # strings) the same way read_library_data does when reading it in
+    lib_data = lib_data.replace(r"^ +", "", regex=True)
+    return lib_data.replace("", NO_VALUE)
+
+
+def get_row_hashes(data):
+    # A 64 bit hash of each row as hex, the multi-option fields are
+    # joined back up if they have been split into lists
+    data = data.copy()
+    for column in MULTI_OPTION_COLS:
+        if column in data.columns:
+            data[column] = data[column].map(
+                lambda value: ",".join(value) if isinstance(value, list) else value
+            )
+    return pd.util.hash_pandas_object(data, index=False).map("{:016x}".format)
+
+
+def get_input_hashes(lib_data, dead_urls=None, collision_ids=(), full_text=False):
+    # The hash of each row along with everything else that decides what
+    # becomes of it: whether its file is in the library (and the sha256
+    # of the file with full_text, as its text is searched), whether its
+    # file name collides with another row's (see load_name_collisions)
+    # and whether its publisher URL is gone
+    state = lib_data.copy()
+    state["_in_library"] = lib_data[label.filename].isin(os.listdir(docs.dest_path))
+    state["_collision"] = lib_data[label.id].isin(collision_ids)
+    if dead_urls is not None:
+        state["_dead_url"] = lib_data[label.publishedURL].isin(dead_urls)
+    if full_text:
+        is_open = lib_data[label.access] == access_types.open
+        doc_files = lib_data.loc[is_open, label.filename].map(
+            libhelper.get_normalised_filename
+        )
+        file_hashes = texthelper.get_doc_hashes(sorted(set(doc_files)))
+        state["_file_hash"] = doc_files.map(file_hashes).reindex(lib_data.index)
+        state["_file_hash"] = state["_file_hash"].fillna("")
+    return get_row_hashes(state)
+
+
+def get_settings_hash(lib_data, configs, sharded, full_text, check_urls, pages):
+    # A hash of everything other than the rows that the website files
+    # are made from: the config rows, the settings in
+    # library-config.ini, the columns, the options and where the doc
+    # pages go with pages
+    sha256 = hashlib.sha256()
+    settings = (FINGERPRINT_VERSION, sharded, full_text, check_urls)
+    settings += (list(lib_data.columns), label, access_types, status_types, icons, urls)
+    if pages:
+        settings += ("pages", str(docs.pages_path))
+    sha256.update(repr(settings).encode("utf-8"))
+    for config in configs:
+        if config is not None:
+            sha256.update(config.to_csv(index=False).encode("utf-8"))
+    return sha256.hexdigest()
+
+
+def get_build_hash(settings_hash, input_hashes):
+    # A hash of everything that the website files are made from (see
+    # get_settings_hash and get_input_hashes)
+    sha256 = hashlib.sha256(settings_hash.encode("utf-8"))
+    sha256.update("".join(input_hashes).encode("utf-8"))
+    return sha256.hexdigest()
+
+
+def get_row_states(lib_data, input_hashes):
+    # The input hash of each row by ID, in the same order as the rows,
+    # or None if the IDs aren't unique
+    row_ids = lib_data[label.id]
+    if row_ids.duplicated().any():
+        return None
+    return dict(zip(row_ids, input_hashes))
+
+
+def load_fingerprints():
+    if not files.fingerprints.exists():
+        return {}
+    fingerprints = json.loads(files.fingerprints.read_text(encoding="utf-8"))
+    if fingerprints.get("version") != FINGERPRINT_VERSION:
+        return {}
+    return fingerprints
+
+
+def get_build_files(sharded, pages=False):
+    # The files made from the rows that have to be there to skip or
+    # patch the build
+    paths = get_website_files()
+    if sharded:
+        paths.append(files.libindex_shards.joinpath("manifest.json"))
+    if pages:
+        paths.append(files.doc_pages)
+    return paths
+
+
+def are_shards_intact():
+    # True if every shard in the shards manifest is there and hasn't
+    # been changed since it was written
+    manifest_path = files.libindex_shards.joinpath("manifest.json")
+    if not manifest_path.exists():
+        return False
+    manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+    return all(
+        is_shard_intact(files.libindex_shards.joinpath(shard["file"]), shard["sha256"])
+        for shard in [manifest["cards"]] + manifest["details"]
+    )
+
+
+def are_build_files_intact(sharded, pages=False):
+    # True if the website files are there, and with sharded or pages
+    # the shards or pages their manifests list are there and unchanged
+    return (
+        all(path.exists() for path in get_build_files(sharded, pages))
+        and (not sharded or are_shards_intact())
+        and (not pages or pagehelper.are_pages_intact())
+    )
+
+
+def is_up_to_date(fingerprints, build_hash, sharded, pages=False):
+    # True if the website files were made from the same data last time
+    # and are still there
+    return fingerprints.get("build") == build_hash and are_build_files_intact(
+        sharded, pages
+    )
+
+
+def can_patch(fingerprints, settings_hash, rows, sharded, pages=False):
+    # True if the files from the last run can be patched with the rows
+    # that have changed (see update_library_files): they were made with
+    # the same settings and config and the rows have unique IDs, then
+    # and now
+    return (
+        fingerprints.get("settings") == settings_hash
+        and fingerprints.get("rows") is not None
+        and rows is not None
+        and files.rejected_csv.exists()
+        and are_build_files_intact(sharded, pages)
+    )
+
+
+def save_fingerprints(log, is_dry_run, fingerprints, new_fingerprints):
+    # Work out which docs have been added, updated or removed since the
+    # last run from the hash of each doc, then save the new fingerprints
+    # and the changes. The fingerprints have the build and settings
+    # hashes, the columns of the docs, the input hash of each row and
+    # the hash of each doc by ID.
+    old_hashes = fingerprints.get("docs", {})
+    doc_hashes = new_fingerprints["docs"]
+    delta = {
+        "version": FINGERPRINT_VERSION,
+        "from_build": fingerprints.get("build"),
+        "to_build": new_fingerprints["build"],
+        "added": sorted(doc_hashes.keys() - old_hashes.keys()),
+        "updated": sorted(
+            doc_id
+            for doc_id in doc_hashes.keys() & old_hashes.keys()
+            if doc_hashes[doc_id] != old_hashes[doc_id]
+        ),
+        "removed": sorted(old_hashes.keys() - doc_hashes.keys()),
+    }
+    log.info(
+        "Library index changes",
+        added=len(delta["added"]),
+        updated=len(delta["updated"]),
+        removed=len(delta["removed"]),
     )
-    log = structlog.get_logger()
 
+    if not is_dry_run:
+        libhelper.write_text_if_changed(
+            files.libindex_delta, json.dumps(delta, indent=1)
+        )
+        fingerprints = dict(new_fingerprints, version=FINGERPRINT_VERSION)
+        files.fingerprints.write_text(json.dumps(fingerprints), encoding="utf-8")
+        log.info("Wrote library index changes", file=str(files.libindex_delta))
+
+    return delta
+
+
+def get_records_frame(records, columns):
+    # The docs from library-index.json as a table, with the fields that
+    # were left out (see get_records) back as "NO VALUE"
+    return pd.DataFrame(records, columns=columns).fillna(NO_VALUE)
+
+
+def update_library_files(
+    log,
+    is_dry_run,
+    lib_data,
+    fingerprints,
+    new_fingerprints,
+    display_config,
+    search_fields,
+    filter_fields,
+    sortings,
+    report,
+    sharded=False,
+    full_text=False,
+    text_workers=texthelper.DEFAULT_WORKERS,
+    dead_urls=None,
+    collision_ids=(),
+    pages=False,
+    page_workers=pagehelper.DEFAULT_WORKERS,
+):
+    # Patch the files from the last run with the rows that have been
+    # added, changed or removed since, found from the input hash of each
+    # row by ID (see get_input_hashes). Only the rows that have been
+    # added or changed go through the steps, then their docs replace the
+    # docs of those rows in the library index, the rejected rows, the
+    # search index, the facet index and the doc pages. The sort index
+    # and the shards are made again from the patched docs, as any doc
+    # can move in them. Returns the IDs of the docs added, updated and
+    # removed, or None if the rows that haven't changed are in a
+    # different order, as their docs can't just be moved up or down in
+    # the indexes then, or library-index.json isn't the one from the
+    # last run.
+    old_rows = fingerprints["rows"]
+    rows = new_fingerprints["rows"]
+    changed_ids = {
+        doc_id
+        for doc_id, input_hash in rows.items()
+        if old_rows.get(doc_id) != input_hash
+    }
+    drop_ids = changed_ids | (old_rows.keys() - rows.keys())
+    log.info(
+        "Rows changed since the last run",
+        changed=len(changed_ids),
+        removed=len(drop_ids) - len(changed_ids),
+    )
+
+    row_ids = list(rows)
+    row_positions = {doc_id: position for position, doc_id in enumerate(row_ids)}
+    old_records = json.loads(files.libindex_json.read_text(encoding="utf-8"))
+    old_ids = [get_doc_id(record) for record in old_records]
+    if set(old_ids) != fingerprints["docs"].keys():
+        return None  # not the library index the fingerprints are for
+    kept_positions = [
+        row_positions[doc_id] for doc_id in old_ids if doc_id not in drop_ids
+    ]
+    if any(b < a for a, b in zip(kept_positions, kept_positions[1:])):
+        return None
+
+    num_docs = len(changed_ids)
+    # the library file of each open access row, for the text of the docs
+    row_files = lib_data.loc[
+        lib_data[label.access] == access_types.open, [label.id, label.filename]
+    ]
+    lib_data = lib_data[lib_data[label.id].isin(changed_ids)]
+    with libhelper.stage_timer(log, "remove_nonactive_rows", report, num_docs) as stage:
+        lib_data = remove_nonactive_rows(log, lib_data)
+        stage["rows_out"] = num_docs = lib_data.index.size
+    with libhelper.stage_timer(log, "remove_invalid_rows", report, num_docs) as stage:
+        rules = get_validation_rules(lib_data, dead_urls, collision_ids=collision_ids)
+        lib_data = patch_rejected_rows(
+            log, is_dry_run, lib_data, rules, drop_ids, row_ids
+        )
+        stage["rows_out"] = num_docs = lib_data.index.size
+    is_open = lib_data[label.access] == access_types.open
+    doc_files = lib_data.loc[is_open, label.filename].map(
+        libhelper.get_normalised_filename
+    )
+    with libhelper.stage_timer(
+        log, "split_multi_option_values", report, num_docs
+    ) as stage:
+        lib_data, multi_options = split_multi_option_values(log, lib_data)
+        stage["rows_out"] = sum(values.size for values in multi_options.values())
+    with libhelper.stage_timer(
+        log, "remove_private_details", report, num_docs
+    ) as stage:
+        lib_data = remove_private_details(log, lib_data, display_config)
+        stage["rows_out"] = num_docs
+
+    with libhelper.stage_timer(log, "patch_library_index", report, num_docs) as stage:
+        lib_data = set_display_fields(lib_data, multi_options)
+        records, ordinal_map, new_ordinals = patch_records(
+            old_records, get_records(lib_data, filter_fields), drop_ids, row_ids
+        )
+        del old_records
+        write_library_index(log, is_dry_run, records)
+        stage["rows_out"] = len(records)
+    doc_hashes = dict(fingerprints["docs"])
+    doc_hashes.update(zip(lib_data[label.id], get_row_hashes(lib_data)))
+    doc_hashes = {
+        get_doc_id(record): doc_hashes[get_doc_id(record)] for record in records
+    }
+    if pages:
+        with libhelper.stage_timer(
+            log, "create_doc_pages", report, len(records)
+        ) as stage:
+            page_stats = pagehelper.create_doc_pages(
+                log, is_dry_run, records, doc_hashes, page_workers
+            )
+            stage["rows_out"] = page_stats["written"]
+    with libhelper.stage_timer(log, "patch_facet_index", report, num_docs) as stage:
+        facet_index = searchhelper.patch_facet_index(
+            json.loads(files.facet_index.read_text(encoding="utf-8")),
+            searchhelper.build_facet_index(lib_data, multi_options, filter_fields),
+            ordinal_map,
+            new_ordinals,
+        )
+        stage["rows_out"] = sum(
+            len(facet["values"]) for facet in facet_index["facets"].values()
+        )
+    with libhelper.stage_timer(log, "create_query_config", report, num_docs):
+        create_query_config(log, facet_index, search_fields, filter_fields, sortings)
+    bodies = None
+    if full_text:
+        with libhelper.stage_timer(
+            log, "extract_doc_bodies", report, doc_files.size
+        ) as stage:
+            # only the changed docs' files, then the cached text of the
+            # files of all of the docs is kept
+            doc_bodies = texthelper.extract_doc_bodies(
+                log, is_dry_run, doc_files.tolist(), text_workers, prune=False
+            )
+            if not is_dry_run:
+                is_doc = row_files[label.id].isin(doc_hashes.keys())
+                texthelper.remove_unused_text(
+                    texthelper.get_pdf_hashes(
+                        row_files.loc[is_doc, label.filename].map(
+                            libhelper.get_normalised_filename
+                        )
+                    )
+                )
+            bodies = doc_files.map(doc_bodies).reindex(lib_data.index).fillna("")
+            bodies = bodies.tolist()
+            stage["rows_out"] = len(doc_bodies)
+    with libhelper.stage_timer(log, "patch_search_index", report, num_docs):
+        create_search_index(
+            log,
+            is_dry_run,
+            lib_data,
+            search_fields,
+            bodies,
+            patch=(ordinal_map, new_ordinals),
+        )
+    with libhelper.stage_timer(log, "create_facet_index", report, num_docs):
+        create_facet_index(log, is_dry_run, facet_index)
+
+    num_docs = len(records)
+    lib_data = get_records_frame(records, fingerprints["columns"])
+    with libhelper.stage_timer(log, "create_sort_index", report, num_docs):
+        create_sort_index(log, is_dry_run, lib_data, sortings)
+    if sharded:
+        with libhelper.stage_timer(log, "create_sharded_index", report, num_docs):
+            card_fields = get_card_fields(lib_data, filter_fields, sortings)
+            create_sharded_index(log, is_dry_run, lib_data, card_fields)
+
+    with libhelper.stage_timer(log, "save_fingerprints", report, num_docs):
+        new_fingerprints["columns"] = fingerprints["columns"]
+        new_fingerprints["docs"] = doc_hashes
+        delta = save_fingerprints(log, is_dry_run, fingerprints, new_fingerprints)
+    return delta
+
+
+def create_library_files(
+    log,
+    is_dry_run,
+    lib_data,
+    filter_config=None,
+    search_config=None,
+    display_config=None,
+    sort_config=None,
+    sharded=False,
+    full=False,
+    report=None,
+    full_text=False,
+    text_workers=texthelper.DEFAULT_WORKERS,
+    check_urls=False,
+    url_ttl=urlhelper.DEFAULT_TTL_HOURS,
+    pages=False,
+    page_workers=pagehelper.DEFAULT_WORKERS,
+):
+    # Filter and tidy up lib_data then write the library index and the
+    # query config. The config data is read from the config csv files
+    # unless it is passed in. Nothing is rebuilt if lib_data and the
+    # config are the same as last time, and if only some of the rows
+    # have changed the files from the last run are patched with them
+    # (see update_library_files), unless full is True. Returns the IDs
+    # of the docs added, updated and removed. The stats for each
+    # step are added to report (see libhelper.stage_timer). With
+    # full_text the text of the PDFs is added to the search index, with
+    # check_urls the docs whose publisher URL is gone are dropped (the
+    # URLs are checked again after url_ttl hours), with pages a static
+    # page is written for each doc (see pagehelper.py).
+    if report is None:
+        report = libhelper.new_report()
+    num_docs = lib_data.index.size
+    if filter_config is None:
+        filter_config = pd.read_csv(files.filter_config)
+    if search_config is None:
+        search_config = pd.read_csv(files.search_config)
+    if display_config is None:
+        display_config = pd.read_csv(files.doc_display_config)
+    if sort_config is None and files.sort_config.exists():
+        sort_config = pd.read_csv(files.sort_config, dtype="str", keep_default_na=False)
+
+    dead_urls = None
+    if check_urls:
+        with libhelper.stage_timer(
+            log, "check_publisher_urls", report, num_docs
+        ) as stage:
+            dead_urls = check_publisher_urls(log, is_dry_run, lib_data, url_ttl)
+            stage["rows_out"] = len(dead_urls or [])
+
+    configs = [filter_config, search_config, display_config, sort_config]
+    collision_ids = load_name_collisions()
+    with libhelper.stage_timer(log, "check_fingerprints", report, num_docs):
+        settings_hash = get_settings_hash(
+            lib_data, configs, sharded, full_text, dead_urls is not None, pages
+        )
+        input_hashes = get_input_hashes(lib_data, dead_urls, collision_ids, full_text)
+        build_hash = get_build_hash(settings_hash, input_hashes)
+        rows = get_row_states(lib_data, input_hashes)
+        fingerprints = load_fingerprints()
+        is_unchanged = not full and is_up_to_date(
+            fingerprints, build_hash, sharded, pages
+        )
+    if is_unchanged:
+        log.info("Nothing has changed since the last run", build=build_hash[:16])
+        return save_fingerprints(log, is_dry_run, fingerprints, fingerprints)
+
+    new_fingerprints = {
+        "build": build_hash,
+        "settings": settings_hash,
+        "columns": None,
+        "rows": rows,
+        "docs": None,
+    }
+    search_fields = get_searchable_fields(log, search_config)
+    filter_fields = get_filter_list(log, filter_config)
+    sortings = get_sortings(log, sort_config)
+    if not full and can_patch(fingerprints, settings_hash, rows, sharded, pages):
+        delta = update_library_files(
+            log,
+            is_dry_run,
+            lib_data,
+            fingerprints,
+            new_fingerprints,
+            display_config,
+            search_fields,
+            filter_fields,
+            sortings,
+            report,
+            sharded=sharded,
+            full_text=full_text,
+            text_workers=text_workers,
+            dead_urls=dead_urls,
+            collision_ids=collision_ids,
+            pages=pages,
+            page_workers=page_workers,
+        )
+        if delta is not None:
+            return delta
+        log.info("The rows have moved since the last run, rebuilding everything")
+
+    with libhelper.stage_timer(log, "remove_nonactive_rows", report, num_docs) as stage:
+        lib_data = remove_nonactive_rows(log, lib_data)
+        stage["rows_out"] = num_docs = lib_data.index.size
+    with libhelper.stage_timer(log, "remove_invalid_rows", report, num_docs) as stage:
+        lib_data = remove_invalid_rows(
+            log, is_dry_run, lib_data, dead_urls, collision_ids
+        )
+        stage["rows_out"] = num_docs = lib_data.index.size
+    # the library file of each open access doc, before File_name can be
+    # dropped as a private detail
+    is_open = lib_data[label.access] == access_types.open
+    doc_files = lib_data.loc[is_open, label.filename].map(
+        libhelper.get_normalised_filename
+    )
+    with libhelper.stage_timer(
+        log, "split_multi_option_values", report, num_docs
+    ) as stage:
+        lib_data, multi_options = split_multi_option_values(log, lib_data)
+        stage["rows_out"] = sum(values.size for values in multi_options.values())
+    # must call remove_nonactive_rows last in case it removes a
+    # column needed for other processing
+    with libhelper.stage_timer(
+        log, "remove_private_details", report, num_docs
+    ) as stage:
+        lib_data = remove_private_details(log, lib_data, display_config)
+        stage["rows_out"] = num_docs
+
+    with libhelper.stage_timer(log, "create_library_index", report, num_docs) as stage:
+        lib_data, records = create_library_index(
+            log, is_dry_run, lib_data, multi_options, keep_fields=filter_fields
+        )
+        stage["rows_out"] = num_docs
+    doc_hashes = None
+    if pages:
+        with libhelper.stage_timer(
+            log, "create_doc_pages", report, num_docs
+        ) as stage:
+            doc_hashes = dict(zip(lib_data[label.id], get_row_hashes(lib_data)))
+            page_stats = pagehelper.create_doc_pages(
+                log, is_dry_run, records, doc_hashes, page_workers
+            )
+            stage["rows_out"] = page_stats["written"]
+    del records
+    with libhelper.stage_timer(log, "build_facet_index", report, num_docs) as stage:
+        facet_index = searchhelper.build_facet_index(
+            lib_data, multi_options, filter_fields
+        )
+        stage["rows_out"] = sum(
+            len(facet["values"]) for facet in facet_index["facets"].values()
+        )
+    with libhelper.stage_timer(log, "create_query_config", report, num_docs):
+        create_query_config(log, facet_index, search_fields, filter_fields, sortings)
+    bodies = None
+    if full_text:
+        with libhelper.stage_timer(
+            log, "extract_doc_bodies", report, doc_files.size
+        ) as stage:
+            doc_bodies = texthelper.extract_doc_bodies(
+                log, is_dry_run, doc_files.tolist(), text_workers
+            )
+            # in the same order as lib_data
+            bodies = doc_files.map(doc_bodies).reindex(lib_data.index).fillna("")
+            bodies = bodies.tolist()
+            stage["rows_out"] = len(doc_bodies)
+    with libhelper.stage_timer(log, "create_search_index", report, num_docs):
+        create_search_index(log, is_dry_run, lib_data, search_fields, bodies)
+    with libhelper.stage_timer(log, "create_facet_index", report, num_docs):
+        create_facet_index(log, is_dry_run, facet_index)
+    with libhelper.stage_timer(log, "create_sort_index", report, num_docs):
+        create_sort_index(log, is_dry_run, lib_data, sortings)
+    if sharded:
+        with libhelper.stage_timer(log, "create_sharded_index", report, num_docs):
+            card_fields = get_card_fields(lib_data, filter_fields, sortings)
+            create_sharded_index(log, is_dry_run, lib_data, card_fields)
+
+    with libhelper.stage_timer(log, "save_fingerprints", report, num_docs):
+        if doc_hashes is None:
+            doc_hashes = dict(zip(lib_data[label.id], get_row_hashes(lib_data)))
+        new_fingerprints["columns"] = list(lib_data.columns)
+        new_fingerprints["docs"] = doc_hashes
+        delta = save_fingerprints(log, is_dry_run, fingerprints, new_fingerprints)
+    return delta
+
+
+def iter_library_chunks(log, chunk_rows=DEFAULT_CHUNK_ROWS):
+    # Read the rows chunk_rows at a time, from the cache if it is up to
+    # date, the same way as read_library_data
+    if cachehelper.is_cache_current(files.libindex_cache, files.libindex_csv):
+        log.info("Loading cache file", file=str(files.libindex_cache))
+        for chunk in cachehelper.iter_lib_data(files.libindex_cache, chunk_rows):
+            yield prepare_library_data(chunk)
+        return
+
+    log.info("Loading csv file", file=str(files.libindex_csv))
+    with pd.read_csv(
+        files.libindex_csv, dtype="str", skipinitialspace=True, chunksize=chunk_rows
+    ) as reader:
+        for chunk in reader:
+            yield chunk.fillna(NO_VALUE)
+
+
+def add_facet_counts(facet_counts, lib_data, multi_options, filter_fields):
+    # Add the number of docs with each value of the filter fields to
+    # facet_counts (a Counter for each field), each token of the
+    # multi-option fields is a separate value as in build_facet_index
+    for field in filter_fields:
+        if field not in lib_data.columns:
+            continue  # skip on to the next filter field
+
+        if field in multi_options:
+            values = multi_options[field]
+            values = pd.DataFrame(
+                {"doc": values.index, "value": values.to_numpy(dtype=object)}
+            ).drop_duplicates()["value"]
+        else:
+            values = lib_data[field].astype(object)
+        facet_counts.setdefault(field, collections.Counter()).update(
+            values.value_counts().to_dict()
+        )
+
+
+def get_facet_stats(facet_counts, num_docs):
+    # The values and counts of the filter fields in the same form as
+    # the facet index, without the postings
+    facets = {}
+    for field, counts in facet_counts.items():
+        values = sorted(counts)
+        facets[searchhelper.get_field_id(field)] = {
+            "title": field,
+            "values": values,
+            "counts": [counts[value] for value in values],
+        }
+    return {"num_docs": num_docs, "facets": facets}
+
+
+def open_output(stack, is_dry_run, path):
+    # Open path to write a bit at a time (see libhelper.open_if_changed)
+    # in the exit stack, nothing is written in a dry-run. Returns the
+    # file and the result dict.
+    if is_dry_run:
+        return stack.enter_context(open(os.devnull, "w")), {"changed": False}
+    return stack.enter_context(libhelper.open_if_changed(path))
+
+
+def remove_stale_index_files(log, is_dry_run):
+    # Remove the search, facet and sort indexes, the shards and their
+    # .gz and .br copies so that they aren't served with a library index
+    # they weren't made from, the query service builds the indexes from
+    # the docs when they are missing
+    paths = [files.search_index, files.facet_index, files.sort_index]
+    if files.libindex_shards.is_dir():
+        paths.extend(files.libindex_shards.glob("*.json"))
+    num_removed = 0
+    for path in sorted(paths):
+        for stale_path in [
+            path,
+            path.with_name(path.name + ".gz"),
+            path.with_name(path.name + ".br"),
+        ]:
+            if not stale_path.is_file():
+                continue
+            if not is_dry_run:
+                stale_path.unlink()
+            log.info("Removed index file not made from the docs", file=str(stale_path))
+            num_removed += 1
+    return num_removed
+
+
+def create_library_files_streaming(
+    log, is_dry_run, chunk_rows=DEFAULT_CHUNK_ROWS, ndjson=False, report=None
+):
+    # Like create_library_files, but the rows are read, filtered and
+    # written chunk_rows at a time so the memory used doesn't grow with
+    # the number of docs. Only the library index (a JSON array, or one
+    # doc per line in library-index.ndjson with ndjson), the query
+    # config and the rejected rows are written, the search, facet and
+    # sort indexes and the shards need all of the docs at once so the
+    # ones left from an earlier build are removed. The fingerprints are
+    # removed so that the next run without streaming rebuilds
+    # everything. Returns the number of docs written.
+    if report is None:
+        report = libhelper.new_report()
+    filter_config = pd.read_csv(files.filter_config)
+    search_config = pd.read_csv(files.search_config)
+    display_config = pd.read_csv(files.doc_display_config)
+    sort_config = None
+    if files.sort_config.exists():
+        sort_config = pd.read_csv(files.sort_config, dtype="str", keep_default_na=False)
+    search_fields = get_searchable_fields(log, search_config)
+    filter_fields = get_filter_list(log, filter_config)
+    sortings = get_sortings(log, sort_config)
+    private_columns = get_private_columns(display_config)
+    doc_list = os.listdir(docs.dest_path)
+    collision_ids = load_name_collisions()
+    index_path = files.libindex_ndjson if ndjson else files.libindex_json
+    log.info("Streaming library_index for website", file=str(index_path))
+
+    num_rows = num_nonactive = num_rejected = num_docs = 0
+    rule_counts = collections.Counter()
+    facet_counts = {}
+    with libhelper.stage_timer(
+        log, "stream_library_index", report
+    ) as stage, contextlib.ExitStack() as stack:
+        index_fd, index_result = open_output(stack, is_dry_run, index_path)
+        rejected_csv_fd, _ = open_output(stack, is_dry_run, files.rejected_csv)
+        rejected_json_fd, _ = open_output(stack, is_dry_run, files.rejected_json)
+        if not ndjson:
+            index_fd.write("[")
+        rejected_json_fd.write("[")
+
+        for chunk_num, lib_data in enumerate(iter_library_chunks(log, chunk_rows)):
+            num_rows += lib_data.index.size
+            if label.status in lib_data.columns:
+                is_active = lib_data[label.status] == status_types.active
+                num_nonactive += int((~is_active).sum())
+                lib_data = lib_data[is_active]
+
+            rules = get_validation_rules(
+                lib_data, doc_list=doc_list, collision_ids=collision_ids
+            )
+            rejected, is_rejected = get_rejected_rows(lib_data, rules)
+            rule_counts.update(
+                {rule: int(mask.sum()) for rule, (mask, _) in rules.items()}
+            )
+            rejected.to_csv(rejected_csv_fd, index=False, header=chunk_num == 0)
+            if rejected.index.size:
+                if num_rejected:
+                    rejected_json_fd.write(",")
+                rejected_json_fd.write(rejected.to_json(orient="records")[1:-1])
+                num_rejected += rejected.index.size
+            lib_data = lib_data[~is_rejected]
+
+            lib_data, multi_options = split_multi_option_values(log, lib_data)
+            lib_data = lib_data.drop(columns=private_columns)
+            lib_data = set_display_fields(lib_data, multi_options)
+            add_facet_counts(facet_counts, lib_data, multi_options, filter_fields)
+
+            for record in get_records(lib_data, filter_fields):
+                record_json = json.dumps(
+                    record, ensure_ascii=False, separators=(",", ":")
+                )
+                if ndjson:
+                    index_fd.write(record_json + "\n")
+                else:
+                    index_fd.write(("," if num_docs else "") + record_json)
+                num_docs += 1
+
+        if not ndjson:
+            index_fd.write("]")
+        rejected_json_fd.write("]")
+        stage["rows_in"] = num_rows
+        stage["rows_out"] = num_docs
+
+    log.info(
+        "Number of docs dropped due to Status",
+        status=status_types.active,
+        count=num_nonactive,
+    )
+    for rule, count in rule_counts.items():
+        log.info("Number of docs dropped by rule", rule=rule, count=count)
+    log.info("Documents in library, final count", count=num_docs)
+    if not is_dry_run:
+        log.info(
+            "Wrote JSON file", file=str(index_path), changed=index_result["changed"]
+        )
+        log.info(
+            "Wrote rejected rows",
+            count=num_rejected,
+            files=[str(files.rejected_csv), str(files.rejected_json)],
+        )
+
+    with libhelper.stage_timer(log, "create_query_config", report, num_docs):
+        facet_stats = get_facet_stats(facet_counts, num_docs)
+        create_query_config(log, facet_stats, search_fields, filter_fields, sortings)
+
+    # the other website files weren't made from these docs
+    remove_stale_index_files(log, is_dry_run)
+    if not is_dry_run:
+        files.fingerprints.unlink(missing_ok=True)
+    return num_docs
+
+
+def get_website_files(sharded=False):
+    # The files written for the website
+    paths = [
+        files.libindex_json,
+        files.query_config,
+        files.search_index,
+        files.facet_index,
+        files.sort_index,
+    ]
+    if sharded:
+        paths.extend(sorted(files.libindex_shards.glob("*.json")))
+    return paths
+
+
+def compress_website_files(log, is_dry_run, paths, size_budget=None):
+    # Write the .gz and .br copies of the files and log their sizes.
+    # Returns False if the gzipped files add up to more than size_budget
+    # (in KiB).
+    if is_dry_run:
+        log.info("Dry-run, files not compressed")
+        return True
+
+    total = {}
+    for path in paths:
+        sizes = libhelper.compress_file(path)
+        log.info("File size", file=path.name, **sizes)
+        for key, size in sizes.items():
+            total[key] = total.get(key, 0) + size
+    log.info("Total size", files=len(paths), **total)
+
+    if size_budget is not None and total.get("gzip", 0) > size_budget * 1024:
+        log.error(
+            "Size budget exceeded",
+            gzip_kib=round(total["gzip"] / 1024, 1),
+            budget_kib=size_budget,
+        )
+        return False
+    return True
+
+
+if __name__ == "__main__":
     # create parser
     parser = argparse.ArgumentParser()
 
@@ -301,32 +1559,130 @@ if __name__ == "__main__":
         action="store_true",
         help="don't make any changes but give me some stats on what would happen",
     )
+    parser.add_argument(
+        "--sharded",
+        action="store_true",
+        help="also split the library index into cards and details shards",
+    )
+    parser.add_argument(
+        "--size-budget",
+        type=float,
+        help="fail if the gzipped website files add up to more than this many KiB",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="rebuild everything even if nothing has changed since the last run",
+    )
+    parser.add_argument(
+        "--full-text",
+        action="store_true",
+        help="add the text of the open access PDFs to the search index",
+    )
+    parser.add_argument(
+        "--text-workers",
+        type=int,
+        default=texthelper.DEFAULT_WORKERS,
+        help="number of PDFs to read the text of at the same time "
+        "(default %(default)s)",
+    )
+    parser.add_argument(
+        "--check-urls",
+        action="store_true",
+        help="check the publisher URLs and drop the docs whose URL is gone",
+    )
+    parser.add_argument(
+        "--url-ttl",
+        type=float,
+        default=urlhelper.DEFAULT_TTL_HOURS,
+        help="hours before a checked URL is checked again (default %(default)s)",
+    )
+    parser.add_argument(
+        "--pages",
+        action="store_true",
+        help="also write a static page for each doc and the sitemap",
+    )
+    parser.add_argument(
+        "--page-workers",
+        type=int,
+        default=pagehelper.DEFAULT_WORKERS,
+        help="number of processes rendering the doc pages (default %(default)s)",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="read and write the docs a chunk at a time, only the library index "
+        "and query config are written",
+    )
+    parser.add_argument(
+        "--chunk-rows",
+        type=int,
+        default=DEFAULT_CHUNK_ROWS,
+        help="rows in each chunk with --stream (default %(default)s)",
+    )
+    parser.add_argument(
+        "--ndjson",
+        action="store_true",
+        help="with --stream write library-index.ndjson, one doc per line",
+    )
+    libhelper.add_report_arguments(parser)
+    libhelper.add_log_level_argument(parser)
 
     # parse the command line arguments
     args = parser.parse_args()
+    if args.ndjson and not args.stream:
+        parser.error("--ndjson needs --stream")
+    if args.stream and (
+        args.sharded or args.full_text or args.check_urls or args.pages
+    ):
+        parser.error(
+            "--stream can't be used with --sharded, --full-text, --check-urls "
+            "or --pages"
+        )
+
+    # Specify level of entries to log
+    log = libhelper.get_logger(args.log_level)
+
     is_dry_run = args.dry_run
     if is_dry_run:
         log.info("This is a dry-run, no changes will be made")
 
-    log.info("Loading csv file from {}.".format(files.libindex_csv))
-
-    # Read in data from the library-index.csv file and ensure that
-    # there are no leading or trailing spaces on the contents
-    lib_data = pd.read_csv(
-        files.libindex_csv, dtype="str", skipinitialspace=True
-    ).fillna("NO VALUE")
-    log.info("Initial # rows loaded: {}".format(lib_data.index.size))
-
-    lib_data = remove_nonactive_rows(log, lib_data)
-    lib_data = remove_invalid_access_rows(log, lib_data)
-    lib_data = remove_openaccess_nofilename_rows(log, lib_data)
-    lib_data = remove_publisheraccess_nourl_rows(log, lib_data)
-    lib_data = split_multi_option_values(lib_data)
-    # must call remove_nonactive_rows last in case it removes a
-    # column needed for other processing
-    lib_data = remove_private_details(log, lib_data)
-
-    lib_data = create_library_index(log, is_dry_run, lib_data)
-    create_query_config(log, lib_data, get_searchable_fields(log), get_filter_list(log))
+    report = libhelper.new_report(files.profile_dir if args.profile else None)
+    if args.stream:
+        create_library_files_streaming(
+            log, is_dry_run, args.chunk_rows, args.ndjson, report
+        )
+        website_files = [
+            files.libindex_ndjson if args.ndjson else files.libindex_json,
+            files.query_config,
+        ]
+    else:
+        with libhelper.stage_timer(log, "read_library_data", report) as stage:
+            lib_data = read_library_data(log)
+            stage["rows_out"] = lib_data.index.size
+        log.info("Initial # rows loaded", count=lib_data.index.size)
+
+        create_library_files(
+            log,
+            is_dry_run,
+            lib_data,
+            sharded=args.sharded,
+            full=args.full,
+            report=report,
+            full_text=args.full_text,
+            text_workers=args.text_workers,
+            check_urls=args.check_urls,
+            url_ttl=args.url_ttl,
+            pages=args.pages,
+            page_workers=args.page_workers,
+        )
+        website_files = get_website_files(args.sharded)
+    with libhelper.stage_timer(log, "compress_website_files", report):
+        is_within_budget = compress_website_files(
+            log, is_dry_run, website_files, args.size_budget
+        )
+    libhelper.finish_report(log, is_dry_run, report, files.build_report)
 
     log.info("library index and query config file creation is complete")
+    if not is_within_budget:
+        exit(1)
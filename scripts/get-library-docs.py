@@ -5,7 +5,26 @@
     files listed in the SOURCE_PATH.
 
     If the ACCESS_RIGHTS type is Open then
-    the file is copied into DESTINATION_PATH.
+    the file is copied into DESTINATION_PATH. The files are copied
+    by a pool of worker threads (--workers), a failed copy is logged
+    and reported at the end and doesn't stop the other copies.
+
+    A manifest of the size, modified time and content hash of each
+    copied file is kept (see confighelper.py for the file name) so a
+    file is only copied again when its source has changed, and the
+    source is only hashed when its size or modified time has changed.
+    With --prune, files in DESTINATION_PATH that the index no longer
+    lists are removed. The files of open access rows whose source is
+    missing are kept, and nothing is pruned if SOURCE_PATH is missing
+    or has no files (e.g. a share that isn't mounted).
+
+    Files with the same contents (the same sha256) are only stored
+    once: the first one is copied and the others are hard links to it.
+    Rows whose file names are the same once normalised (e.g. a space
+    and an underscore) can't both be in the library, the first one is
+    kept. Both are logged with the row IDs and saved in
+    outputs/duplicate-docs.json, and create-library-index.py rejects
+    the rows that weren't kept so they don't link to the other file.
 
     The paths and names of files are all defined in constants at
     the top of the script, as are the column names for the csv file.
@@ -14,159 +33,681 @@
     (used for logging).
 """
 import os
-import shutil
 import csv
-import logging
-import structlog
+import json
 import argparse
 from confighelper import files, docs, label, status_types, access_types
+import cachehelper
 import libhelper
 import unicodedata
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor
 
 UNICODE_FORM = "NFKD"
 
+# number of files to check and copy at the same time, the source
+# folder is usually a network share so most of the time is spent
+# waiting on it rather than using the CPU
+DEFAULT_WORKERS = 8
+
+
+def load_dir_index(cache_path, src_path, pattern):
+    # The directory index maps the path of each folder under src_path
+    # (relative to src_path) to its modified time and the names of the
+    # files and folders in it. It is only used for the same src_path
+    # and pattern it was made with.
+    try:
+        dir_index = json.loads(cache_path.read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError):
+        return {}
+    if (
+        dir_index.get("src_path") != str(src_path)
+        or dir_index.get("pattern") != pattern
+    ):
+        return {}
+    return dir_index["dirs"]
+
+
+def save_dir_index(cache_path, src_path, pattern, dirs):
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    tmp_path.write_text(
+        json.dumps({"src_path": str(src_path), "pattern": pattern, "dirs": dirs}),
+        encoding="utf-8",
+    )
+    os.replace(tmp_path, cache_path)
+
+
+def scan_src_dirs(src_path, cached_dirs, rescan=False):
+    # Walk the folders under src_path, a folder is only listed again if
+    # its modified time has changed (a folder's modified time changes
+    # when a file is added, removed or renamed in it). Returns the new
+    # directory index and the number of folders reused and rescanned.
+    dirs = {}
+    num_reused = 0
+    num_rescanned = 0
+    dirs_to_scan = [""]
+    while dirs_to_scan:
+        rel_dir = dirs_to_scan.pop()
+        dir_path = src_path.joinpath(rel_dir)
+        try:
+            mtime_ns = dir_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            continue  # removed while we were looking at it
 
-def get_filename_path_dict(log, src_path, pattern):
+        entry = cached_dirs.get(rel_dir)
+        if not rescan and entry is not None and entry["mtime_ns"] == mtime_ns:
+            num_reused += 1
+        else:
+            entry = {"mtime_ns": mtime_ns, "files": [], "dirs": []}
+            with os.scandir(dir_path) as dir_entries:
+                for dir_entry in dir_entries:
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        entry["dirs"].append(dir_entry.name)
+                    else:
+                        entry["files"].append(dir_entry.name)
+            entry["files"].sort()
+            entry["dirs"].sort()
+            num_rescanned += 1
+
+        dirs[rel_dir] = entry
+        dirs_to_scan.extend(
+            os.path.join(rel_dir, subdir) for subdir in reversed(entry["dirs"])
+        )
+
+    return dirs, num_reused, num_rescanned
+
+
+def get_filename_path_dict(
+    log, src_path, pattern, cache_path=None, rescan=False, is_dry_run=False
+):
     # Allows for the src_path to have subdirectories and
     # recursively makes a list of the docs and their paths
     #
+    # If cache_path is given the folder listings are kept in that file
+    # and only the folders that have changed since the last run are
+    # listed again, unless rescan is set. This only works for patterns
+    # like "**/<name pattern>", anything else is passed to glob.
+    #
+    if cache_path is None or not pattern.startswith("**/"):
+        file_paths = src_path.glob(pattern)
+    else:
+        name_pattern = pattern[len("**/") :]
+        cached_dirs = load_dir_index(cache_path, src_path, pattern)
+        dirs, num_reused, num_rescanned = scan_src_dirs(src_path, cached_dirs, rescan)
+        log.info(
+            "Source folders listed",
+            num_reused_dirs=num_reused,
+            num_rescanned_dirs=num_rescanned,
+        )
+        if not is_dry_run:
+            save_dir_index(cache_path, src_path, pattern, dirs)
+        file_paths = (
+            src_path.joinpath(rel_dir, filename)
+            for rel_dir, entry in dirs.items()
+            for filename in fnmatch.filter(entry["files"], name_pattern)
+        )
+
     file_list = {}
-    for file_path in src_path.glob(pattern):
+    for file_path in file_paths:
         if file_path.name != ".DS_Store":
             file_list[unicodedata.normalize(UNICODE_FORM, file_path.name)] = file_path
-            log.debug(
-                "get_filename_path_dict: file_path.name({}), file_path({})".format(
-                    file_path.name, file_path
-                )
-            )
+            log.debug("get_filename_path_dict", file_path=file_path)
 
-    log.debug("get_filename_path_dict: filename list: {}".format(file_list.keys()))
+    log.debug("get_filename_path_dict: filename list", filenames=file_list.keys())
     return file_list
 
 
-if __name__ == "__main__":
-    structlog.configure(
-        wrapper_class=structlog.make_filtering_bound_logger(logging.INFO),
+def load_manifest(manifest_path):
+    # The manifest maps each file name in the library to the details
+    # of the source file it was copied from
+    try:
+        return json.loads(manifest_path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(manifest_path, manifest):
+    # Write to a temporary file first so an interrupted run can't
+    # leave a half written manifest behind
+    tmp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+    tmp_path.write_text(
+        json.dumps(manifest, indent=1, sort_keys=True), encoding="utf-8"
     )
-    log = structlog.get_logger()
+    os.replace(tmp_path, manifest_path)
 
-    # create parser
-    parser = argparse.ArgumentParser()
 
-    # add arguments to the parser
-    parser.add_argument(
-        "--dry-run",
-        action="store_true",
-        help="don't make any changes but give me some stats on what would happen",
+def get_manifest_entry(src_filepath, src_stat, src_hash):
+    return {
+        "src_path": str(src_filepath),
+        "size": src_stat.st_size,
+        "mtime_ns": src_stat.st_mtime_ns,
+        "sha256": src_hash,
+    }
+
+
+def check_dest_file(src_filepath, dest_filename, dest_file_list, manifest):
+    # Work out whether the library copy of a file is up to date.
+    # Returns a tuple of the state of the file ("unchanged", "changed"
+    # or "new") and the manifest entry for the source file.
+    src_stat = src_filepath.stat()
+    entry = manifest.get(dest_filename)
+    in_dest = dest_filename in dest_file_list
+
+    if (
+        in_dest
+        and entry is not None
+        and entry["src_path"] == str(src_filepath)
+        and entry["size"] == src_stat.st_size
+        and entry["mtime_ns"] == src_stat.st_mtime_ns
+    ):
+        return "unchanged", entry  # no need to read the file
+
+    src_hash = libhelper.get_file_hash(src_filepath)
+    new_entry = get_manifest_entry(src_filepath, src_stat, src_hash)
+    if not in_dest:
+        return "new", new_entry
+
+    if entry is not None:
+        is_same = entry["sha256"] == src_hash
+    else:
+        # not in the manifest yet (e.g. the first run with a manifest)
+        # so compare against the file that is already in the library
+        dest_path = docs.dest_path.joinpath(dest_filename)
+        is_same = (
+            dest_path.stat().st_size == src_stat.st_size
+            and libhelper.get_file_hash(dest_path) == src_hash
+        )
+    return ("unchanged" if is_same else "changed"), new_entry
+
+
+def can_prune(log, src_file_list):
+    # A missing source folder or one with no files in it (e.g. a share
+    # that isn't mounted) is much more likely to be a problem than every
+    # doc having gone, so nothing is pruned then
+    if not docs.src_path.is_dir():
+        log.error("Source folder is missing, not pruning", path=str(docs.src_path))
+        return False
+    if not src_file_list:
+        log.error("No files in the source folder, not pruning", path=str(docs.src_path))
+        return False
+    return True
+
+
+def prune_dest_files(log, is_dry_run, dest_file_list, library_filenames):
+    # Remove the files in the library that aren't listed in the index,
+    # library_filenames are the files of all of the open access rows
+    # whether or not their source was found
+    num_pruned_files = 0
+    for filename in sorted(dest_file_list - library_filenames):
+        if filename.startswith("."):
+            continue  # leave hidden files alone
+        dest_path = docs.dest_path.joinpath(filename)
+        if not dest_path.is_file():
+            continue
+        if not is_dry_run:
+            dest_path.unlink()
+        log.info("Removed file not listed in the index", file=str(dest_path))
+        num_pruned_files += 1
+    return num_pruned_files
+
+
+def read_library_rows(libindex_csv, cache_path=None):
+    # Read the rows from the library-index.csv file, or just the columns
+    # that are needed from the cache if it is up to date
+    if cache_path is not None and cachehelper.is_cache_current(
+        cache_path, libindex_csv
+    ):
+        columns = [label.id, label.access, label.filename, label.status]
+        columns = list(dict.fromkeys(columns))
+        yield from cachehelper.read_lib_data(cache_path, columns).to_dict("records")
+        return
+
+    with open(libindex_csv, encoding="utf-8") as fd:
+        yield from csv.DictReader(fd)
+
+
+def check_doc_file(src_filepath, dest_filename, dest_file_list, manifest):
+    # Work out whether the library copy of one file is up to date
+    # (hashing the source if it has changed), this is run in a worker
+    # thread so errors are returned rather than raised or logged.
+    # Returns the state of the file, its manifest entry and the error.
+    try:
+        file_state, entry = check_dest_file(
+            src_filepath, dest_filename, dest_file_list, manifest
+        )
+    except OSError as ex:
+        return "failed", None, ex
+    return file_state, entry, None
+
+
+def copy_doc_file(src_filepath, dest_path):
+    # Copy one file into the library, run in a worker thread so the
+    # error is returned rather than raised
+    try:
+        if dest_path.exists() and dest_path.stat().st_nlink > 1:
+            # don't write through the hard link into its duplicates
+            dest_path.unlink()
+        libhelper.copy_file(src_filepath, dest_path)
+    except OSError as ex:
+        return ex
+    return None
+
+
+def link_duplicate_file(is_dry_run, first_path, dest_path):
+    # Make a file with the same contents as first_path a hard link to
+    # it so the contents are only stored once. Returns True if it was
+    # linked (False if it already was) and the error.
+    try:
+        if (
+            first_path.exists()
+            and dest_path.exists()
+            and os.path.samefile(first_path, dest_path)
+        ):
+            return False, None
+        if not is_dry_run:
+            libhelper.link_file(first_path, dest_path)
+    except OSError as ex:
+        return False, ex
+    return True, None
+
+
+def get_duplicates_report(copy_jobs, manifest, file_ids, name_collisions):
+    # The library files that have the same contents as another file,
+    # grouped by their sha256, and the rows whose file name is the same
+    # as another row's once normalised, with the IDs of the rows
+    content_files = {}
+    for _, _, filename in copy_jobs:
+        if filename in manifest:
+            content_files.setdefault(manifest[filename]["sha256"], []).append(
+                filename
+            )
+    duplicates = [
+        {
+            "sha256": sha256,
+            "size": manifest[filenames[0]]["size"],
+            "files": [
+                {"filename": filename, "ids": file_ids[filename]}
+                for filename in filenames
+            ],
+        }
+        for sha256, filenames in content_files.items()
+        if len(filenames) > 1
+    ]
+    return {"duplicates": duplicates, "name_collisions": name_collisions}
+
+
+def is_library_doc(row):
+    # True for the active open access docs, their files are in the library
+    return (row[label.access].lower() == access_types.open.lower()) and (
+        status_types.active == ""
+        or (row[label.status].lower() == status_types.active.lower())
     )
 
-    # parse the command line arguments
-    args = parser.parse_args()
-    is_dry_run = args.dry_run
-    if is_dry_run:
-        log.info("This is a dry-run, no changes will be made")
 
-    # log some useful information
-    log.info("Copying files from {}".format(docs.src_path))
-    log.info("Copying files to {}".format(docs.dest_path))
+def sync_doc_files(log, is_dry_run, rows, src_file_list):
+    # Bring the library copies of the files of rows up to date without
+    # looking at the rest of the library, for when only a few files in
+    # the source folder have changed (see build-library.py --watch).
+    # Files with the same contents aren't linked, the next full run
+    # does that. Returns the numbers of new and changed files.
+    dest_file_list = set(os.listdir(docs.dest_path))
+    manifest = load_manifest(files.docs_manifest)
+    file_states = {"new": 0, "changed": 0}
+    for row in rows:
+        row = {key: value.rstrip() for key, value in row.items()}
+        src_filepath = src_file_list.get(
+            unicodedata.normalize(UNICODE_FORM, row[label.filename])
+        )
+        if not is_library_doc(row) or src_filepath is None:
+            continue
+        normalised_filename = libhelper.get_normalised_filename(row[label.filename])
+        dest_path = docs.dest_path.joinpath(normalised_filename)
+        file_state, entry, error = check_doc_file(
+            src_filepath, normalised_filename, dest_file_list, manifest
+        )
+        if error is None and file_state != "unchanged" and not is_dry_run:
+            error = copy_doc_file(src_filepath, dest_path)
+        if error is not None:
+            log.error(
+                "Copy failed",
+                id=row[label.id],
+                file=str(src_filepath),
+                error=str(error),
+            )
+            continue
 
-    src_file_list = get_filename_path_dict(log, docs.src_path, docs.file_pattern)
-    log.debug("Finished building filename and path dictionary")
+        manifest[normalised_filename] = entry
+        if file_state != "unchanged":
+            log.info(
+                "Copied", id=row[label.id], src=str(src_filepath), dest=str(dest_path)
+            )
+            file_states[file_state] += 1
+            dest_file_list.add(normalised_filename)
+
+    if not is_dry_run:
+        save_manifest(files.docs_manifest, manifest)
+    return file_states
+
+
+def copy_library_docs(
+    log, is_dry_run, rows, src_file_list, prune=False, workers=DEFAULT_WORKERS
+):
+    # Copy the new and changed open access documents listed in rows
+    # into the library and return the counters for the summary at the end.
+    # A failed copy is logged and the rest of the files are still copied.
 
     # setup some counters for stats at the end
     num_empty_filenames = 0
     num_missing_files = 0
     num_files_in_dest = 0
     num_copied_files = 0
+    num_updated_files = 0
+    num_pruned_files = 0
+    num_duplicate_files = 0
+    num_rows = 0
+    failed_files = []
+    copy_jobs = []
+    name_collisions = []
+
+    dest_file_list = set(os.listdir(docs.dest_path))
+    dest_file_list.discard(".DS_Store")  # just in case the folder is on a Mac
+    old_manifest = load_manifest(files.docs_manifest)
+    manifest = {}
+    # the row ID and source path of each file in the library, and the
+    # IDs of all of the rows that list it
+    library_sources = {}
+    file_ids = {}
+    # the files of all of the open access rows, the ones whose source
+    # is missing for now are still kept when pruning
+    library_filenames = set()
+    # log.debug("dest_file_list", dest_file_list=dest_file_list)
+    log.info("#files in source", path=str(docs.src_path), count=len(src_file_list))
+    log.info("#files in dest", path=str(docs.dest_path), count=len(dest_file_list))
 
-    dest_file_list = os.listdir(docs.dest_path)
-    if ".DS_Store" in dest_file_list:
-      dest_file_list.remove(".DS_Store")  # just in case the folder is on a Mac
-    # log.debug("dest_file_list ({})".format(dest_file_list))
-    log.info("#files in {} is {}".format(docs.src_path, len(src_file_list)))
-    log.info("#files in {} is {}".format(docs.dest_path, len(dest_file_list)))
-
-    with open(files.libindex_csv, encoding="utf-8") as fd:
-        for row in csv.DictReader(fd):
-            # strip the trailing whitespace from each row value
-            for key, value in row.items():
-                row[key] = value.rstrip()
-
-            log.debug(
-                "row[{}]({})  access_types.open({}) status_type.active({})  row[{}]({})".format(
-                    label.access,
-                    row[label.access].lower(),
-                    access_types.open,
-                    status_types.active,
-                    label.status,
-                    row[label.status].lower(),
+    for row in rows:
+        num_rows += 1
+        # strip the trailing whitespace from each row value
+        row = {key: value.rstrip() for key, value in row.items()}
+
+        log.debug(
+            "row",
+            id=row[label.id],
+            access=row[label.access],
+            status=row[label.status],
+        )
+        if is_library_doc(row):
+            # get source file name
+            src_filename = row[label.filename]
+
+            if src_filename == "":
+                log.warning(
+                    "Filename field is empty",
+                    id=row[label.id],
+                    access=access_types.open,
+                    column=label.filename,
+                )
+                num_empty_filenames += 1
+                continue  # no filename to work with so log it and move on
+
+            library_filenames.add(libhelper.get_normalised_filename(src_filename))
+            try:
+                src_key = unicodedata.normalize(UNICODE_FORM, src_filename)
+                log.debug("recorded_pdf_filename", filename=src_filename, key=src_key)
+                src_filepath = src_file_list[src_key]
+            except:
+                log.warning(
+                    "File listed in spreadsheet but not found",
+                    id=row[label.id],
+                    filename=src_filename,
+                    path=str(docs.src_path),
                 )
+                num_missing_files += 1
+                continue  # no file to copy, log it and move on
+
+            # replace troublesome characters to create destination file name
+            normalised_filename = libhelper.get_normalised_filename(
+                row[label.filename]
             )
-            if (row[label.access].lower() == access_types.open.lower()) and (
-                status_types.active == ""
-                or (row[label.status].lower() == status_types.active.lower())
-            ):
-                # get source file name
-                src_filename = row[label.filename]
-
-                if src_filename == "":
+            if normalised_filename in library_sources:
+                first_id, first_filepath = library_sources[normalised_filename]
+                if src_filepath != first_filepath:
+                    # a different file that ends up with the same name,
+                    # only the first one can be in the library
                     log.warning(
-                        "ID {} | {} is {} | {} field is empty".format(
-                            row[label.id],
-                            label.access,
-                            access_types.open,
-                            label.filename,
-                        )
+                        "File name is the same as another row's once normalised",
+                        id=row[label.id],
+                        other_id=first_id,
+                        file=str(src_filepath),
+                        other_file=str(first_filepath),
+                        dest=normalised_filename,
                     )
-                    num_empty_filenames += 1
-                    continue  # no filename to work with so log it and move on
-
-                try:
-                    log.debug("recorded_pdf_filename: {}".format(src_filename))
-                    log.debug("source_file_list {}".format(src_file_list))
-                    src_filepath = src_file_list[
-                        unicodedata.normalize(UNICODE_FORM, src_filename)
-                    ]
-                except:
-                    log.warning(
-                        "ID {} | File {} listed in spreadsheet but not found in {}".format(
-                            row[label.id], src_filename, docs.src_path
-                        )
+                    name_collisions.append(
+                        {
+                            "id": row[label.id],
+                            "src_path": str(src_filepath),
+                            "filename": normalised_filename,
+                            "other_id": first_id,
+                            "other_src_path": str(first_filepath),
+                        }
                     )
-                    num_missing_files += 1
-                    continue  # no file to copy, log it and move on
+                    continue
+                # another row has the same file, it's already being copied
+                log.info("File already exists at destination", id=row[label.id])
+                file_ids[normalised_filename].append(row[label.id])
+                num_files_in_dest += 1
+                continue
+            library_sources[normalised_filename] = (row[label.id], src_filepath)
+            file_ids[normalised_filename] = [row[label.id]]
+            copy_jobs.append((row[label.id], src_filepath, normalised_filename))
+
+    # Hash the new and changed files and copy them in the worker
+    # threads. Files with the same contents are only copied once, the
+    # others are hard links to the first one. The results are logged in
+    # the same order as copy_jobs so the log reads the same whatever the
+    # number of workers.
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        checks = list(
+            executor.map(
+                lambda job: check_doc_file(
+                    job[1], job[2], dest_file_list, old_manifest
+                ),
+                copy_jobs,
+            )
+        )
 
-                # replace troublesome characters to create destination file name
-                normalised_filename = libhelper.get_normalised_filename(
-                    row[label.filename]
+        # the first file in the library with each content hash
+        first_files = {}
+        to_copy = []
+        for (_, src_filepath, normalised_filename), (file_state, entry, error) in zip(
+            copy_jobs, checks
+        ):
+            if error is not None:
+                continue
+            first_filename = first_files.setdefault(
+                entry["sha256"], normalised_filename
+            )
+            if first_filename == normalised_filename and file_state != "unchanged":
+                to_copy.append((src_filepath, normalised_filename))
+
+        copy_errors = {}
+        if not is_dry_run:
+            copy_errors = dict(
+                zip(
+                    [normalised_filename for _, normalised_filename in to_copy],
+                    executor.map(
+                        lambda job: copy_doc_file(
+                            job[0], docs.dest_path.joinpath(job[1])
+                        ),
+                        to_copy,
+                    ),
                 )
+            )
 
-                # if the file doesn't already exist in the destination folder
-                #  then copy it in. Exit the script if there is an error.
-                if normalised_filename not in dest_file_list:
-                    try:
-                        dest_path = docs.dest_path.joinpath(normalised_filename)
-                        if not is_dry_run:
-                            shutil.copyfile(src_filepath, dest_path)
-                        log.info("Copied {} to {}.".format(src_filepath, dest_path))
-                        num_copied_files += 1
-                    except Exception as ex:
-                        log.exception(
-                            "ID {} | copy of {} failed.".format(
-                                row[label.id], src_filepath
-                            )
-                        )
-                        exit(1)
-                else:
-                    log.info(
-                        "ID {} | file already exists at destination".format(
-                            row[label.id]
-                        )
-                    )
-                    num_files_in_dest += 1
+    for (doc_id, src_filepath, normalised_filename), (
+        file_state,
+        entry,
+        error,
+    ) in zip(copy_jobs, checks):
+        dest_path = docs.dest_path.joinpath(normalised_filename)
+        first_filename = None
+        if error is None:
+            first_filename = first_files[entry["sha256"]]
+            error = copy_errors.get(normalised_filename)
+        is_linked = False
+        if first_filename not in (None, normalised_filename):
+            num_duplicate_files += 1
+            if copy_errors.get(first_filename) is not None:
+                # the first file didn't copy, so copy this one
+                error = copy_doc_file(src_filepath, dest_path)
+            else:
+                is_linked, error = link_duplicate_file(
+                    is_dry_run, docs.dest_path.joinpath(first_filename), dest_path
+                )
+        if error is not None:
+            log.error(
+                "Copy failed", id=doc_id, file=str(src_filepath), error=str(error)
+            )
+            failed_files.append((doc_id, src_filepath, error))
+            continue
+
+        manifest[normalised_filename] = entry
+        if file_state == "new":
+            num_copied_files += 1
+        elif file_state == "changed":
+            num_updated_files += 1
+        else:
+            num_files_in_dest += 1
+
+        if is_linked:
+            log.info(
+                "Same contents as another file, linked",
+                id=doc_id,
+                src=str(src_filepath),
+                dest=str(dest_path),
+                same_as=first_filename,
+            )
+        elif file_state == "new":
+            log.info("Copied", src=str(src_filepath), dest=str(dest_path))
+        elif file_state == "changed":
+            log.info(
+                "Source has changed, copied",
+                id=doc_id,
+                src=str(src_filepath),
+                dest=str(dest_path),
+            )
+        else:
+            log.info("File already exists at destination", id=doc_id)
+
+    if prune and can_prune(log, src_file_list):
+        num_pruned_files = prune_dest_files(
+            log, is_dry_run, dest_file_list, library_filenames
+        )
 
-    log.info(
-        "Files copied {} | Files with empty filename {} | File already in dest {} | Missing files {}".format(
-            num_copied_files, num_empty_filenames, num_files_in_dest, num_missing_files
+    duplicates_report = get_duplicates_report(
+        copy_jobs, manifest, file_ids, name_collisions
+    )
+    if not is_dry_run:
+        save_manifest(files.docs_manifest, manifest)
+        # written the same way as the manifest
+        save_manifest(files.duplicates_report, duplicates_report)
+
+    for doc_id, src_filepath, error in failed_files:
+        log.error(
+            "File was not copied", id=doc_id, file=str(src_filepath), error=str(error)
         )
+
+    doc_stats = {
+        "num_rows": num_rows,
+        "num_copied_files": num_copied_files,
+        "num_updated_files": num_updated_files,
+        "num_empty_filenames": num_empty_filenames,
+        "num_files_in_dest": num_files_in_dest,
+        "num_missing_files": num_missing_files,
+        "num_pruned_files": num_pruned_files,
+        "num_failed_files": len(failed_files),
+        "num_duplicate_files": num_duplicate_files,
+        "num_name_collisions": len(name_collisions),
+    }
+    log.info("Library docs summary", **doc_stats)
+
+    return doc_stats
+
+
+def get_num_library_files(doc_stats):
+    # the number of documents now in the library
+    return (
+        doc_stats["num_copied_files"]
+        + doc_stats["num_updated_files"]
+        + doc_stats["num_files_in_dest"]
+    )
+
+
+if __name__ == "__main__":
+    # create parser
+    parser = argparse.ArgumentParser()
+
+    # add arguments to the parser
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="don't make any changes but give me some stats on what would happen",
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="remove files from the library that are no longer listed in the index",
+    )
+
+    parser.add_argument(
+        "--rescan",
+        action="store_true",
+        help="list every folder in the source path instead of only the changed ones",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="number of files to copy at the same time (default %(default)s)",
+    )
+
+    libhelper.add_report_arguments(parser)
+    libhelper.add_log_level_argument(parser)
+
+    # parse the command line arguments
+    args = parser.parse_args()
+    log = libhelper.get_logger(args.log_level)
+    report = libhelper.new_report(files.profile_dir if args.profile else None)
+    is_dry_run = args.dry_run
+    if is_dry_run:
+        log.info("This is a dry-run, no changes will be made")
+
+    # log some useful information
+    log.info("Copying files from", path=str(docs.src_path))
+    log.info("Copying files to", path=str(docs.dest_path))
+
+    with libhelper.stage_timer(log, "get_filename_path_dict", report) as stage:
+        src_file_list = get_filename_path_dict(
+            log,
+            docs.src_path,
+            docs.file_pattern,
+            cache_path=files.src_dir_index,
+            rescan=args.rescan,
+            is_dry_run=is_dry_run,
+        )
+        stage["rows_out"] = len(src_file_list)
+    log.debug("Finished building filename and path dictionary")
+
+    with libhelper.stage_timer(log, "copy_library_docs", report) as stage:
+        doc_stats = copy_library_docs(
+            log,
+            is_dry_run,
+            read_library_rows(files.libindex_csv, files.libindex_cache),
+            src_file_list,
+            prune=args.prune,
+            workers=args.workers,
+        )
+        stage["rows_in"] = doc_stats["num_rows"]
+        stage["rows_out"] = get_num_library_files(doc_stats)
+    libhelper.finish_report(log, is_dry_run, report, files.build_report)
+    if doc_stats["num_failed_files"]:
+        exit(1)
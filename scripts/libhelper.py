@@ -2,7 +2,362 @@
 
     Functions needed in more than one script
 """
+import cProfile
+import errno
+import filecmp
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import structlog
+
+try:
+    import brotli
+except ImportError:  # optional, only the .gz files are written without it
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, files are copied without a reflink
+    fcntl = None
+
+try:
+    import resource
+except ImportError:  # not on Windows, the peak memory isn't reported
+    resource = None
+
+# version of build-report.json
+REPORT_VERSION = 2
+
+# read files in 1MiB chunks when hashing them
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# levels that can be given to --log-level
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+
+# ioctl request for a copy-on-write clone of a file (linux/fs.h)
+FICLONE = 0x40049409
+
+# errors that mean a fast copy isn't supported for these files
+FAST_COPY_ERRORS = {
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+    errno.EPERM,
+}
+
+# the profilers of the stages being profiled, innermost last
+active_profiles = []
+
+
+def write_text_if_changed(path, text):
+    # Only write the file if its contents would change, so an unchanged
+    # file keeps its modified time (and isn't compressed again).
+    # Returns True if the file was written.
+    data = text.encode("utf-8")
+    if path.exists() and path.stat().st_size == len(data):
+        if path.read_bytes() == data:
+            return False
+    path.write_bytes(data)
+    return True
+
+
+@contextmanager
+def open_if_changed(path):
+    # Open a hidden temporary file next to path to write text to a bit
+    # at a time. It replaces path when the with block is done, unless
+    # the contents are the same (see write_text_if_changed), and is
+    # removed if the block fails, so path is never half written. Yields
+    # the file and a dict whose "changed" is set once the block is done.
+    tmp_path = path.with_name("." + path.name + ".tmp")
+    result = {"changed": False}
+    try:
+        with open(tmp_path, "w", encoding="utf-8", newline="") as fd:
+            yield fd, result
+        filecmp.clear_cache()
+        if not (path.exists() and filecmp.cmp(tmp_path, path, shallow=False)):
+            os.replace(tmp_path, path)
+            result["changed"] = True
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def is_newer(path, than_path):
+    return path.exists() and path.stat().st_mtime_ns >= than_path.stat().st_mtime_ns
+
+
+def compress_file(path):
+    # Write .gz and .br copies of the file next to it at maximum
+    # compression for the web server to send instead. The gzip header
+    # has no name or time in it so the same file always gives the same
+    # bytes. Returns the size of the file and of each compressed copy.
+    gz_path = path.with_name(path.name + ".gz")
+    br_path = path.with_name(path.name + ".br")
+    sizes = {"bytes": path.stat().st_size}
+    if is_newer(gz_path, path) and (brotli is None or is_newer(br_path, path)):
+        # the copies are up to date
+        sizes["gzip"] = gz_path.stat().st_size
+        if brotli is not None:
+            sizes["brotli"] = br_path.stat().st_size
+        return sizes
+
+    data = path.read_bytes()
+
+    compressed = gzip.compress(data, compresslevel=9, mtime=0)
+    gz_path.write_bytes(compressed)
+    sizes["gzip"] = len(compressed)
+
+    if brotli is not None:
+        compressed = brotli.compress(data, quality=11)
+        br_path.write_bytes(compressed)
+        sizes["brotli"] = len(compressed)
+
+    return sizes
 
 
 def get_normalised_filename(filename):
     return filename.replace(" ", "_").replace("/", "_")
+
+
+def copy_file(src_path, dest_path):
+    # Copy the file contents using the fastest way the filesystem has:
+    # a reflink (the data blocks are shared until changed), then
+    # copy_file_range (copied in the kernel or by the file server),
+    # then shutil.copyfile which uses sendfile where it can. A
+    # copy_file_range that stops short (some filesystems and network
+    # shares do) is started again with shutil.copyfile.
+    with open(src_path, "rb") as src_fd, open(dest_path, "wb") as dest_fd:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(dest_fd.fileno(), FICLONE, src_fd.fileno())
+                return
+            except OSError as ex:
+                if ex.errno not in FAST_COPY_ERRORS:
+                    raise
+
+        if hasattr(os, "copy_file_range"):
+            try:
+                size = os.fstat(src_fd.fileno()).st_size
+                num_copied = 0
+                while num_copied < size:
+                    num_bytes = os.copy_file_range(
+                        src_fd.fileno(), dest_fd.fileno(), size - num_copied
+                    )
+                    if not num_bytes:
+                        break
+                    num_copied += num_bytes
+                if num_copied == size:
+                    return
+                dest_fd.truncate(0)
+            except OSError as ex:
+                if ex.errno not in FAST_COPY_ERRORS:
+                    raise
+
+    shutil.copyfile(src_path, dest_path)
+
+
+def link_file(src_path, dest_path):
+    # Make dest_path a hard link to src_path (replacing the file that is
+    # there), or a copy where the filesystem can't link them
+    tmp_path = dest_path.with_name("." + dest_path.name + ".tmp")
+    tmp_path.unlink(missing_ok=True)
+    try:
+        os.link(src_path, tmp_path)
+    except OSError as ex:
+        if ex.errno not in FAST_COPY_ERRORS | {errno.EMLINK}:
+            raise
+        copy_file(src_path, tmp_path)
+    os.replace(tmp_path, dest_path)
+
+
+def get_file_hash(file_path):
+    # sha256 of the file contents, read in chunks so large files
+    # don't have to fit in memory
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as fd:
+        while chunk := fd.read(HASH_CHUNK_SIZE):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def add_report_arguments(parser):
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="save a cProfile file for each stage in outputs/profile/",
+    )
+
+
+def finish_report(log, is_dry_run, report, path):
+    # Log the stats for the stages and save them unless it's a dry-run
+    log_report(log, report)
+    if not is_dry_run:
+        save_report(report, path)
+        log.info("Wrote build report", file=str(path))
+
+
+def add_log_level_argument(parser):
+    parser.add_argument(
+        "--log-level",
+        default="INFO",
+        type=str.upper,
+        choices=LOG_LEVELS,
+        help="only log messages at this level and above (default %(default)s)",
+    )
+
+
+def get_logger(log_level="INFO"):
+    # Log calls below log_level do nothing, the key-value arguments
+    # passed to them are never formatted, so use
+    #   log.debug("event", key=value)
+    # rather than formatting the message before the call.
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(
+            getattr(logging, log_level)
+        ),
+    )
+    return structlog.get_logger()
+
+
+def new_report(profile_dir=None):
+    # The stats for the stages of a run, see stage_timer. If profile_dir
+    # is given each stage is profiled and saved there as <stage>.prof
+    return {"stages": [], "profile_dir": profile_dir}
+
+
+def get_rss_mib(usage):
+    # The peak RSS from a resource usage in MiB, ru_maxrss is in bytes
+    # on macOS and KiB on Linux
+    if sys.platform == "darwin":
+        return usage.ru_maxrss / (1024 * 1024)
+    return usage.ru_maxrss / 1024
+
+
+def get_peak_rss():
+    # the peak RSS of this process so far in MiB, None if it can't be
+    # found out on this platform
+    if resource is None:
+        return None
+    return get_rss_mib(resource.getrusage(resource.RUSAGE_SELF))
+
+
+@contextmanager
+def stage_timer(log, stage_name, report, rows_in=None):
+    # Time the code in the with block and add the stats for the stage
+    # to report: the elapsed and CPU time, how much it raised the peak
+    # RSS of the process and the number of rows in and out (the block
+    # sets stage["rows_out"]). When profiling, the time spent in a stage
+    # inside this one is only in the inner stage's profile.
+    stage = {"stage": stage_name, "rows_in": rows_in, "rows_out": None}
+    profile = None
+    if report["profile_dir"] is not None:
+        if active_profiles:
+            active_profiles[-1].disable()
+        profile = cProfile.Profile()
+        active_profiles.append(profile)
+        profile.enable()
+
+    start_rss = get_peak_rss()
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    try:
+        yield stage
+    finally:
+        elapsed = time.perf_counter() - start
+        cpu_time = time.process_time() - start_cpu
+        if profile is not None:
+            profile.disable()
+            active_profiles.pop()
+            profile_dir = Path(report["profile_dir"])
+            profile_dir.mkdir(parents=True, exist_ok=True)
+            profile.dump_stats(profile_dir.joinpath(stage_name + ".prof"))
+            if active_profiles:
+                active_profiles[-1].enable()
+
+    peak_rss = get_peak_rss()
+    stage.update(
+        seconds=round(elapsed, 3),
+        cpu_seconds=round(cpu_time, 3),
+        peak_rss_mib=None,
+        peak_rss_delta_mib=None,
+    )
+    if peak_rss is not None:
+        stage.update(
+            peak_rss_mib=round(peak_rss, 1),
+            peak_rss_delta_mib=round(peak_rss - start_rss, 1),
+        )
+    report["stages"].append(stage)
+    log.debug("Stage complete", **stage)
+
+
+def log_report(log, report):
+    # Log the stats for the stages as a table
+    columns = [
+        "stage",
+        "seconds",
+        "cpu_seconds",
+        "peak_rss_mib",
+        "peak_rss_delta_mib",
+        "rows_in",
+        "rows_out",
+    ]
+    rows = [columns] + [
+        ["" if stage[column] is None else str(stage[column]) for column in columns]
+        for stage in report["stages"]
+    ]
+    widths = [max(len(row[index]) for row in rows) for index in range(len(columns))]
+    table = [
+        "  ".join(
+            value.ljust(width) if index == 0 else value.rjust(width)
+            for index, (value, width) in enumerate(zip(row, widths))
+        )
+        for row in rows
+    ]
+    log.info("Stage summary", table="\n" + "\n".join(table))
+
+
+def load_report_stages(path):
+    # The stages saved in the build report, none if there isn't one
+    try:
+        build_report = json.loads(path.read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError):
+        return []
+    if build_report.get("version") != REPORT_VERSION:
+        return []
+    return build_report["stages"]
+
+
+def save_report(report, path):
+    # Save the stats for the stages as JSON with the command that ran
+    # each one. The scripts are often run one at a time, so the stages
+    # already in the report from the other scripts are kept and the
+    # ones with the same name as a stage of this run are replaced, with
+    # this run's stages put where the first of them was.
+    created = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    stages = [
+        dict(stage, command=sys.argv, created=created) for stage in report["stages"]
+    ]
+    names = {stage["stage"] for stage in stages}
+    old_stages = load_report_stages(path)
+    kept = [stage for stage in old_stages if stage["stage"] not in names]
+    # the old stages before the first replaced one are all kept
+    position = next(
+        (index for index, stage in enumerate(old_stages) if stage["stage"] in names),
+        len(old_stages),
+    )
+    build_report = {
+        "version": REPORT_VERSION,
+        "created": created,
+        "stages": kept[:position] + stages + kept[position:],
+    }
+    path.write_text(json.dumps(build_report, indent=1), encoding="utf-8")
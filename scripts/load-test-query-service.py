@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+""" load-test-query-service.py
+
+    Sends search requests to a running query-service.py from
+    --concurrency clients at once and reports the requests per second
+    and the 50th, 90th and 99th percentile latency.
+
+    The requests are made up from the service's own docs and
+    aggregations: words from the titles, filter values and sortings,
+    alone or together, on the first few pages. --distinct different
+    requests are made and --requests are picked from them at random, so
+    some of them are answered from the response cache (the cache hits
+    and misses during the run are reported too).
+
+    The script requires the structlog library to be installed
+    (used for logging).
+"""
+import argparse
+import http.client
+import json
+import platform
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import libhelper
+import searchhelper
+
+# docs to take the words and filter values from
+SAMPLE_DOCS = 1000
+
+
+def call_service(connection, method, path, request=None):
+    # Returns the status and the JSON response
+    body = None if request is None else json.dumps(request).encode("utf-8")
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    connection.request(method, path, body=body, headers=headers)
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def make_requests(rng, sample, stats, num_requests):
+    # Made up requests from the docs and aggregations of a sample
+    # search response and the service stats
+    words = sorted(
+        {
+            word
+            for item in sample["data"]["items"]
+            for word in searchhelper.tokenise(item.get("Title", ""))
+            if len(word) > 3
+        }
+    )
+    filter_values = [
+        (field_id, bucket["key"])
+        for field_id, aggregation in sample["data"]["aggregations"].items()
+        for bucket in aggregation["buckets"]
+    ]
+    requests = []
+    for _ in range(num_requests):
+        request = {"page": rng.choice([1, 1, 1, 2, 3]), "per_page": 20}
+        kind = rng.choice(["query", "filter", "both", "all"])
+        if kind in ("query", "both") and words:
+            request["query"] = " ".join(rng.sample(words, rng.choice([1, 1, 2])))
+        if kind in ("filter", "both") and filter_values:
+            field_id, value = rng.choice(filter_values)
+            request["filters"] = {field_id: [value]}
+        if stats["sortings"] and rng.random() < 0.5:
+            request["sort"] = rng.choice(stats["sortings"])
+        requests.append(request)
+    return requests
+
+
+def send_requests(host, port, requests):
+    # Send the requests one after another on one connection, returns
+    # the latency of each in seconds and the number that failed
+    connection = http.client.HTTPConnection(host, port)
+    latencies = []
+    errors = 0
+    for request in requests:
+        start = time.perf_counter()
+        try:
+            status, _ = call_service(connection, "POST", "/search", request)
+        except (OSError, http.client.HTTPException, ValueError):
+            status = None
+            connection.close()
+        latencies.append(time.perf_counter() - start)
+        if status != 200:
+            errors += 1
+    connection.close()
+    return latencies, errors
+
+
+def get_latency_stats(latencies):
+    # The 50th, 90th and 99th percentile and the longest latency in ms,
+    # "n/a" if there are too few requests to work them out
+    if len(latencies) < 2:
+        return {key: "n/a" for key in ("p50_ms", "p90_ms", "p99_ms", "max_ms")}
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "p50_ms": round(percentiles[49] * 1000, 2),
+        "p90_ms": round(percentiles[89] * 1000, 2),
+        "p99_ms": round(percentiles[98] * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2),
+    }
+
+
+def run_load_test(log, url, num_requests, num_distinct, concurrency, seed):
+    url = urlsplit(url)
+    host, port = url.hostname, url.port or 80
+    rng = random.Random(seed)
+
+    connection = http.client.HTTPConnection(host, port)
+    _, stats = call_service(connection, "GET", "/stats")
+    _, sample = call_service(
+        connection, "POST", "/search", {"per_page": SAMPLE_DOCS}
+    )
+    connection.close()
+    distinct = make_requests(rng, sample, stats, num_distinct)
+    requests = [rng.choice(distinct) for _ in range(num_requests)]
+    log.info(
+        "Sending requests",
+        requests=num_requests,
+        distinct=num_distinct,
+        concurrency=concurrency,
+        docs=stats["docs"],
+    )
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(
+            executor.map(
+                lambda client: send_requests(host, port, requests[client::concurrency]),
+                range(concurrency),
+            )
+        )
+    seconds = time.perf_counter() - start
+
+    connection = http.client.HTTPConnection(host, port)
+    _, end_stats = call_service(connection, "GET", "/stats")
+    connection.close()
+
+    latencies = [
+        latency for client_latencies, _ in results for latency in client_latencies
+    ]
+    result = {
+        "requests": num_requests,
+        "distinct": num_distinct,
+        "concurrency": concurrency,
+        "docs": stats["docs"],
+        "errors": sum(errors for _, errors in results),
+        "seconds": round(seconds, 3),
+        "requests_per_second": round(num_requests / seconds, 1),
+        **get_latency_stats(latencies),
+        "cache_hits": end_stats["cache"]["hits"] - stats["cache"]["hits"],
+        "cache_misses": end_stats["cache"]["misses"] - stats["cache"]["misses"],
+    }
+    log.info("Load test", **result)
+    return result
+
+
+if __name__ == "__main__":
+    # create parser
+    parser = argparse.ArgumentParser()
+
+    # add arguments to the parser
+    parser.add_argument(
+        "--url",
+        default="http://127.0.0.1:8765",
+        help="address of the query service (default %(default)s)",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=5000,
+        help="number of requests to send (default %(default)s)",
+    )
+    parser.add_argument(
+        "--distinct",
+        type=int,
+        default=500,
+        help="number of different requests (default %(default)s)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="number of clients sending requests at once (default %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=1,
+        help="seed for the made up requests (default %(default)s)",
+    )
+    parser.add_argument(
+        "--results",
+        help="file to save the results in",
+    )
+    libhelper.add_log_level_argument(parser)
+
+    # parse the command line arguments
+    args = parser.parse_args()
+    log = libhelper.get_logger(args.log_level)
+
+    result = run_load_test(
+        log, args.url, args.requests, args.distinct, args.concurrency, args.seed
+    )
+    if args.results:
+        result.update(
+            python=platform.python_version(),
+            created=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        )
+        Path(args.results).write_text(json.dumps(result, indent=1), encoding="utf-8")
+        log.info("Saved load test results", file=args.results)
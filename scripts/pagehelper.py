@@ -0,0 +1,392 @@
+""" pagehelper.py
+
+    Writes a static HTML page for each doc in the library, and a
+    sitemap of them, for create-library-index.py --pages. Search
+    engines and slow clients can then see a doc without loading the
+    whole library index.
+
+    Each page has the fields of the doc that the website shows (the
+    columns that doc-display-config.csv doesn't hide), a link to the
+    doc and a link back to the library. The pages are written to the
+    pagesPath folder in library-config.ini as <ID>.html (anything but
+    letters, digits, "-", "_" and "." in the ID is replaced with "_")
+    and are served from the docPages URL.
+
+    The hash of each doc's row (the one kept in doc-fingerprints.json)
+    and of its page are kept in outputs/doc-pages.json:
+
+      {
+        "version": 2,
+        "settings": hash of the page settings and template version,
+        "pages": {
+          ID: {
+            "hash": hash of the doc's row,
+            "file": the page's file name,
+            "sha256": sha256 of the page file,
+            "changed": time the page last changed (seconds since the epoch)
+          }
+        }
+      }
+
+    so only the pages of docs that are new or have changed, or whose
+    page is missing or has been changed since, are rendered, spread
+    over a process pool in batches of PAGE_BATCH_SIZE (every page is
+    rendered again if the settings have changed). The pages of docs
+    that have left the library are removed.
+
+    The sitemap is written next to the pages folder: sitemap.xml is a
+    sitemap index of sitemap-1.xml, sitemap-2.xml, ... with at most
+    SITEMAP_SHARD_URLS pages in each (the limit of the sitemap
+    protocol). It needs the address of the website, site in the [URLs]
+    section of library-config.ini, and isn't written without it.
+"""
+import hashlib
+import html
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import escape
+
+import libhelper
+import searchhelper
+from confighelper import docs, files, label, urls
+
+PAGES_VERSION = 2
+
+# bump to render every page again after changing render_doc_page
+PAGE_TEMPLATE_VERSION = 1
+
+DEFAULT_WORKERS = 4
+
+# pages rendered by a worker at a time
+PAGE_BATCH_SIZE = 500
+
+# the most URLs a sitemap file can have
+SITEMAP_SHARD_URLS = 50000
+
+SITEMAP_NAMESPACE = "http://www.sitemaps.org/schemas/sitemap/0.9"
+
+# the fields used for the page title and description
+TITLE_FIELD = "Title"
+DESCRIPTION_FIELD = "Abstract_Description"
+
+# characters of the description meta tag
+DESCRIPTION_LENGTH = 300
+
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{title}</title>
+<meta name="description" content="{description}">
+{canonical}</head>
+<body>
+<main>
+<h1>{title}</h1>
+<dl>
+{fields}</dl>
+<p><a href="{link}">{link_text}</a></p>
+<p><a href="/">Search the library</a></p>
+</main>
+</body>
+</html>
+"""
+
+
+def get_page_settings():
+    # The settings that the pages are rendered with, the workers get
+    # them as a dictionary rather than loading the config
+    return {
+        "template_version": PAGE_TEMPLATE_VERSION,
+        "site": urls.site,
+        "doc_pages": urls.doc_pages,
+        "id_field": label.id,
+        "link_field": label.displayURL,
+        "access_field": label.access,
+        "hidden_fields": [label.displayIcon],
+    }
+
+
+def get_page_filename(doc_id):
+    return re.sub(r"[^A-Za-z0-9._-]", "_", doc_id) + ".html"
+
+
+def get_settings_hash(settings):
+    data = json.dumps(settings, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def get_field_html(value):
+    # The text of a field value, the multi-option fields are lists
+    if isinstance(value, list):
+        value = ", ".join(item for item in value if item != searchhelper.NO_VALUE)
+    return html.escape(str(value))
+
+
+def render_doc_page(record, settings):
+    # The HTML page of a doc (a record from library-index.json)
+    title = record.get(TITLE_FIELD) or record[settings["id_field"]]
+    description = " ".join(str(record.get(DESCRIPTION_FIELD, title)).split())
+    canonical = ""
+    if settings["site"]:
+        url = settings["site"] + settings["doc_pages"]
+        url += get_page_filename(record[settings["id_field"]])
+        canonical = '<link rel="canonical" href="{}">\n'.format(html.escape(url))
+
+    skip_fields = {TITLE_FIELD, settings["link_field"], *settings["hidden_fields"]}
+    fields = "".join(
+        "<dt>{}</dt><dd>{}</dd>\n".format(html.escape(field), get_field_html(value))
+        for field, value in record.items()
+        if field not in skip_fields and value != searchhelper.NO_VALUE
+    )
+    # the access type says what the link does, e.g. "Free to Download"
+    link = record.get(settings["link_field"], "/")
+    link_text = record.get(settings["access_field"], "View the document")
+    return PAGE_TEMPLATE.format(
+        title=html.escape(title),
+        description=html.escape(description[:DESCRIPTION_LENGTH]),
+        canonical=canonical,
+        fields=fields,
+        link=html.escape(link),
+        link_text=html.escape(link_text),
+    )
+
+
+def write_doc_pages(pages_path, pages, settings):
+    # Runs in a worker process. Renders each of pages, a list of (file
+    # name, record), and writes it to pages_path. Returns the sha256 of
+    # each page written by file name, and the file name and error of
+    # each page that couldn't be written.
+    page_hashes = {}
+    errors = []
+    for filename, record in pages:
+        page_path = pages_path.joinpath(filename)
+        tmp_path = pages_path.joinpath("." + filename + ".tmp")
+        page_data = render_doc_page(record, settings).encode("utf-8")
+        try:
+            tmp_path.write_bytes(page_data)
+            os.replace(tmp_path, page_path)
+        except OSError as ex:
+            errors.append((filename, "{}: {}".format(type(ex).__name__, ex)))
+            continue
+        page_hashes[filename] = hashlib.sha256(page_data).hexdigest()
+    return page_hashes, errors
+
+
+def load_pages_manifest(settings_hash):
+    # The pages from the manifest, none if the settings have changed
+    if not files.doc_pages.exists():
+        return {}
+    manifest = json.loads(files.doc_pages.read_text(encoding="utf-8"))
+    if (
+        manifest.get("version") != PAGES_VERSION
+        or manifest.get("settings") != settings_hash
+    ):
+        return {}
+    return manifest["pages"]
+
+
+def is_page_intact(pages_path, entry):
+    # True if the page in the manifest entry is there and hasn't been
+    # changed since it was written
+    page_path = pages_path.joinpath(entry["file"])
+    return page_path.is_file() and libhelper.get_file_hash(page_path) == entry.get(
+        "sha256"
+    )
+
+
+def are_pages_intact():
+    # True if the pages were made with the current settings and every
+    # page in the manifest is there and unchanged
+    if not files.doc_pages.exists():
+        return False
+    manifest = json.loads(files.doc_pages.read_text(encoding="utf-8"))
+    if manifest.get("version") != PAGES_VERSION or manifest.get(
+        "settings"
+    ) != get_settings_hash(get_page_settings()):
+        return False
+    return all(
+        is_page_intact(docs.pages_path, entry) for entry in manifest["pages"].values()
+    )
+
+
+def render_pages(log, pages_path, to_write, settings, workers):
+    # Render and write the pages in batches over a process pool (or in
+    # this process with one worker). Returns the sha256 of each page
+    # written by file name and the file names of the pages that
+    # couldn't be written.
+    batches = [
+        to_write[start : start + PAGE_BATCH_SIZE]
+        for start in range(0, len(to_write), PAGE_BATCH_SIZE)
+    ]
+    if workers <= 1 or len(batches) == 1:
+        results = [write_doc_pages(pages_path, batch, settings) for batch in batches]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            jobs = [
+                executor.submit(write_doc_pages, pages_path, batch, settings)
+                for batch in batches
+            ]
+            results = [job.result() for job in jobs]
+
+    page_hashes = {}
+    failed = set()
+    for batch_hashes, errors in results:
+        page_hashes.update(batch_hashes)
+        for filename, error in errors:
+            log.warning("Couldn't write doc page", file=filename, error=error)
+            failed.add(filename)
+    return page_hashes, failed
+
+
+def get_sitemap_shards(page_urls):
+    # The sitemap files for the (url, changed time) of each page, a list
+    # of (file name, XML)
+    shards = []
+    for start in range(0, len(page_urls), SITEMAP_SHARD_URLS):
+        entries = "".join(
+            "<url><loc>{}</loc><lastmod>{}</lastmod></url>\n".format(
+                escape(url), time.strftime("%Y-%m-%d", time.gmtime(changed))
+            )
+            for url, changed in page_urls[start : start + SITEMAP_SHARD_URLS]
+        )
+        shards.append(
+            (
+                "sitemap-{}.xml".format(len(shards) + 1),
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<urlset xmlns="{}">\n{}</urlset>\n'.format(SITEMAP_NAMESPACE, entries),
+            )
+        )
+    return shards
+
+
+def write_sitemap(log, sitemap_path, page_urls):
+    # Write the sitemap index and its shards to the folder sitemap_path,
+    # and remove the shards that are no longer needed
+    shards = get_sitemap_shards(page_urls)
+    index = "".join(
+        "<sitemap><loc>{}</loc></sitemap>\n".format(escape(urls.site + "/" + name))
+        for name, _ in shards
+    )
+    shards.append(
+        (
+            "sitemap.xml",
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<sitemapindex xmlns="{}">\n{}</sitemapindex>\n'.format(
+                SITEMAP_NAMESPACE, index
+            ),
+        )
+    )
+    num_changed = sum(
+        libhelper.write_text_if_changed(sitemap_path.joinpath(name), text)
+        for name, text in shards
+    )
+    names = {name for name, _ in shards}
+    for old_shard in sitemap_path.glob("sitemap-*.xml"):
+        if old_shard.name not in names:
+            old_shard.unlink()
+    log.info(
+        "Wrote sitemap",
+        file=str(sitemap_path.joinpath("sitemap.xml")),
+        shards=len(shards) - 1,
+        changed=num_changed,
+    )
+
+
+def create_doc_pages(log, is_dry_run, records, doc_hashes, workers=DEFAULT_WORKERS):
+    # Write the page of each doc that is new or has changed since the
+    # last run, remove the pages of docs that have gone and write the
+    # sitemap. records are the docs as in library-index.json and
+    # doc_hashes the hash of each doc's row by ID. Returns the number of
+    # pages written, unchanged and removed.
+    pages_path = docs.pages_path
+    settings = get_page_settings()
+    settings_hash = get_settings_hash(settings)
+    manifest = load_pages_manifest(settings_hash)
+
+    pages = {}
+    filenames = set()
+    to_write = []
+    for record in records:
+        doc_id = record[label.id]
+        filename = get_page_filename(doc_id)
+        if filename in filenames:
+            log.warning(
+                "Doc has the same page file as another doc, skipped",
+                id=doc_id,
+                file=filename,
+            )
+            continue
+        filenames.add(filename)
+        doc_hash = doc_hashes[doc_id]
+        entry = manifest.get(doc_id)
+        if (
+            entry is None
+            or entry["hash"] != doc_hash
+            or not is_page_intact(pages_path, entry)
+        ):
+            entry = {"hash": doc_hash, "file": filename, "changed": time.time()}
+            to_write.append((filename, record))
+        pages[doc_id] = entry
+    removed = [
+        entry["file"]
+        for doc_id, entry in manifest.items()
+        if doc_id not in pages and entry["file"] not in filenames
+    ]
+    log.info(
+        "Doc pages to write",
+        pages=len(pages),
+        unchanged=len(pages) - len(to_write),
+        to_write=len(to_write),
+        to_remove=len(removed),
+    )
+    stats = {
+        "written": len(to_write),
+        "unchanged": len(pages) - len(to_write),
+        "removed": len(removed),
+    }
+    if is_dry_run:
+        return stats
+
+    pages_path.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    page_hashes, failed = render_pages(log, pages_path, to_write, settings, workers)
+    if to_write:
+        log.info(
+            "Wrote doc pages",
+            path=str(pages_path),
+            count=len(to_write) - len(failed),
+            failed=len(failed),
+            seconds=round(time.perf_counter() - start, 2),
+        )
+    for filename in removed:
+        pages_path.joinpath(filename).unlink(missing_ok=True)
+
+    # the pages that failed are written again next time
+    pages = {
+        doc_id: entry for doc_id, entry in pages.items() if entry["file"] not in failed
+    }
+    for entry in pages.values():
+        if entry["file"] in page_hashes:
+            entry["sha256"] = page_hashes[entry["file"]]
+    files.doc_pages.write_text(
+        json.dumps(
+            {"version": PAGES_VERSION, "settings": settings_hash, "pages": pages}
+        ),
+        encoding="utf-8",
+    )
+
+    if urls.site:
+        page_urls = [
+            (urls.site + urls.doc_pages + entry["file"], entry["changed"])
+            for entry in pages.values()
+        ]
+        write_sitemap(log, pages_path.parent, page_urls)
+    else:
+        log.warning("No site address in the config, the sitemap isn't written")
+
+    stats["written"] -= len(failed)
+    return stats
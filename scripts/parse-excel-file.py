@@ -1,49 +1,421 @@
 """  parse-excel-file.py
 
   Open the excel file and sheet specified.
-  Save the config information (1st 3 rows) as separate csv files.
+  Save the config information (1st 3 rows, plus the optional sort row)
+  as separate csv files.
+
+  By default the sheet is read once, row by row, with a read-only
+  openpyxl reader. The config rows and the data rows are picked out in
+  the same pass and the csv files are written as the rows arrive, so
+  memory use doesn't grow with the size of the sheet.
+
+  The rows and config rows are also written to a columnar cache (see
+  cachehelper.py) along with the sha256 of the workbook. If the
+  workbook hasn't changed since the cache was written it isn't read
+  again (--full reads it anyway), and the later stages read the cache
+  rather than the csv files. The csv files are still written for
+  opening in Excel.
+
+  --two-pass uses the original pandas reader (the workbook is parsed
+  twice, no cache is written) and --compare-timing runs both readers
+  and reports the time and peak memory used by each.
 
 """
+import argparse
+import csv
+import re
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
 import pandas as pd
+from openpyxl import load_workbook
 
+import cachehelper
+import libhelper
 from confighelper import files, label
 
 # inputs
 SHEET_NAME = "Repository"
 
-# Save only the Active records in the document library index
-# Note: index=False prevents pandas from writing a row index to the CSV.
-df = pd.read_excel(files.excel_file, sheet_name=SHEET_NAME, header=3, dtype="str")
-df.to_csv(files.libindex_csv, index=False, encoding="utf-8")
-
-# Extract the config data rows and save them as separate CSV files
-col_labels = df.columns  # use column labels from previous load of this file
-df = pd.read_excel(
-    files.excel_file,
-    sheet_name=SHEET_NAME,
-    header=None,
-)
-df.columns = col_labels
+# The config rows come first in the sheet, in this order, followed
+# by the row of column labels and then the documents.
+CONFIG_FLAGS = ["Filter_yes", "Search_yes", "FullDisplay_yes"]
+HEADER_ROW = len(CONFIG_FLAGS)
 
-filter_data = (
-    (df.iloc[[0]] == "Filter_yes")
-    .to_csv(files.filter_config, index=False)
-)
-search_data = (
-    (df.iloc[[1]] == 'Search_yes')
-    .to_csv(files.search_config, index=False)
-)
-full_display_data = (
-    (df.iloc[[2]] == "FullDisplay_yes")
-    .to_csv(files.doc_display_config, index=False)
+# The config rows can be followed by a row of sort definitions, it is
+# picked out by every cell in it being empty, "Sort_no" or a list of
+# tokens matching SORT_TOKEN_PATTERN (see get_sortings in
+# create-library-index.py for the format). Sheets without one use the
+# default sortings.
+SORT_CONFIG = "Sort"
+SORT_NONE = "Sort_no"
+SORT_TOKEN_PATTERN = re.compile(
+    r"Sort_(?P<name>\w+):(?P<position>\d+):(?P<order>asc|desc)"
 )
 
-print(
-    "{}\n converted to\n {},\n {},\n {}\n and {}".format(
-        files.excel_file,
-        files.libindex_csv,
-        files.filter_config,
-        files.search_config,
-        files.doc_display_config,
+# Cell values that pandas reads as missing values (see pandas
+# STR_NA_VALUES), these are written as empty fields to match it.
+NA_VALUES = {
+    "",
+    "#N/A",
+    "#N/A N/A",
+    "#NA",
+    "-1.#IND",
+    "-1.#QNAN",
+    "-NaN",
+    "-nan",
+    "1.#IND",
+    "1.#QNAN",
+    "<NA>",
+    "N/A",
+    "NA",
+    "NULL",
+    "NaN",
+    "None",
+    "n/a",
+    "nan",
+    "null",
+}
+
+
+def get_output_files(out_dir=None):
+    # Returns the csv file for the library index and the csv file for
+    # each of the config flags. If out_dir is given the files are put
+    # there instead (used when comparing the readers).
+    output_files = {
+        "libindex_csv": files.libindex_csv,
+        "Filter_yes": files.filter_config,
+        "Search_yes": files.search_config,
+        "FullDisplay_yes": files.doc_display_config,
+        SORT_CONFIG: files.sort_config,
+        "libindex_cache": files.libindex_cache,
+    }
+    if out_dir is not None:
+        output_files = {
+            key: Path(out_dir).joinpath(path.name)
+            for key, path in output_files.items()
+        }
+    return output_files
+
+
+def cell_to_str(value):
+    # Convert a cell value to the string that pandas would write for
+    # it with dtype="str", i.e. whole numbers don't get a ".0"
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    value = str(value)
+    return "" if value in NA_VALUES else value
+
+
+def get_column_labels(header):
+    # Use the same labels as pandas for empty and duplicate headings
+    col_labels = []
+    seen = {}
+    for index, value in enumerate(header):
+        col_label = cell_to_str(value) or "Unnamed: {}".format(index)
+        if col_label in seen:
+            seen[col_label] += 1
+            col_label = "{}.{}".format(col_label, seen[col_label])
+        else:
+            seen[col_label] = 0
+        col_labels.append(col_label)
+    return col_labels
+
+
+def is_sort_cell(value):
+    # True if the cell is a comma separated list of sort tokens
+    tokens = [token.strip() for token in value.split(",")]
+    return all(
+        not token or token == SORT_NONE or SORT_TOKEN_PATTERN.fullmatch(token)
+        for token in tokens
+    )
+
+
+def is_sort_row(row):
+    # A row of column labels can have labels starting with "Sort_" too,
+    # so it is only a sort row if all of its cells are sort definitions
+    values = [value for value in map(cell_to_str, row) if value]
+    return bool(values) and all(is_sort_cell(value) for value in values)
+
+
+@contextmanager
+def open_sheet(excel_file):
+    # Open the sheet for a single read and give back the column labels,
+    # the config flags for each column, the sort definition in each
+    # column and an iterator over the data rows. The rows are only read
+    # as the iterator is used.
+    workbook = load_workbook(excel_file, read_only=True, data_only=True)
+    try:
+        sheet = workbook[SHEET_NAME]
+        sheet.reset_dimensions()  # don't trust the size saved in the file
+        rows = sheet.iter_rows(values_only=True)
+
+        config_rows = [next(rows, ()) for _ in CONFIG_FLAGS]
+        header = list(next(rows, ()))
+        sort_row = ()
+        if is_sort_row(header):
+            sort_row = header
+            header = list(next(rows, ()))
+        while header and header[-1] is None:
+            header.pop()  # trim empty cells after the last column label
+        col_labels = get_column_labels(header)
+        num_cols = len(col_labels)
+
+        config_flags = {}
+        for flag, config_row in zip(CONFIG_FLAGS, config_rows):
+            config_row = (list(config_row) + [None] * num_cols)[:num_cols]
+            config_flags[flag] = [value == flag for value in config_row]
+        sort_row = (list(sort_row) + [None] * num_cols)[:num_cols]
+        sort_config = [cell_to_str(value) for value in sort_row]
+
+        yield col_labels, config_flags, sort_config, iter_data_rows(rows, num_cols)
+    finally:
+        workbook.close()
+
+
+def iter_data_rows(rows, num_cols):
+    # Convert each row to a list of num_cols strings
+    num_blank_rows = 0
+    blank_row = [""] * num_cols
+    for row in rows:
+        values = [cell_to_str(value) for value in row[:num_cols]]
+        if not any(values):
+            # pandas keeps blank rows unless they are at the
+            # end of the sheet, so hold them back until we know
+            num_blank_rows += 1
+            continue
+        for _ in range(num_blank_rows):
+            yield blank_row
+        num_blank_rows = 0
+        values.extend([""] * (num_cols - len(values)))
+        yield values
+
+
+def write_config_csv(path, col_labels, flags):
+    # One header row of column labels and one row of True/False values
+    with open(path, "w", newline="", encoding="utf-8") as fd:
+        writer = csv.writer(fd, lineterminator="\n")
+        writer.writerow(col_labels)
+        writer.writerow(flags)
+
+
+def write_csv_rows(csv_path, col_labels, rows):
+    # Write each row to the csv file as it is passed on. The file is
+    # closed as soon as the rows run out, before the cache written from
+    # them is finished, so the cache is newer than the csv file (see
+    # cachehelper.is_cache_current).
+    with open(csv_path, "w", newline="", encoding="utf-8") as fd:
+        writer = csv.writer(fd, lineterminator="\n")
+        writer.writerow(col_labels)
+        for row in rows:
+            writer.writerow(row)
+            yield row
+
+
+def stream_excel_file(excel_file, output_files):
+    # Read the sheet once and write the config csv files, the library
+    # index csv file and the cache (if pyarrow is installed) as the rows
+    # are read.
+    sha256 = libhelper.get_file_hash(excel_file)
+    with open_sheet(excel_file) as (col_labels, config_flags, sort_config, rows):
+        for flag, flags in config_flags.items():
+            write_config_csv(output_files[flag], col_labels, flags)
+        write_config_csv(output_files[SORT_CONFIG], col_labels, sort_config)
+
+        rows = write_csv_rows(output_files["libindex_csv"], col_labels, rows)
+        if cachehelper.pa is None:
+            return sum(1 for _ in rows)
+        return cachehelper.write_sheet_cache(
+            output_files["libindex_cache"],
+            col_labels,
+            {**config_flags, SORT_CONFIG: sort_config},
+            rows,
+            sha256,
+        )
+
+
+def is_sheet_unchanged(excel_file, output_files):
+    # True if the output files were made from the workbook as it is now
+    # and are all still there
+    metadata = cachehelper.read_cache_metadata(output_files["libindex_cache"])
+    return (
+        metadata is not None
+        and all(path.exists() for path in output_files.values())
+        and cachehelper.is_cache_current(
+            output_files["libindex_cache"], output_files["libindex_csv"]
+        )
+        and metadata["workbook_sha256"] == libhelper.get_file_hash(excel_file)
+    )
+
+
+def read_excel_data(excel_file):
+    # Read the sheet once into memory for the build script. Returns
+    # the library data (empty cells are empty strings) and a one row
+    # DataFrame of True/False values for each config flag, plus one of
+    # the sort definitions, the same as reading the csv files back in
+    # with pandas.
+    with open_sheet(excel_file) as (col_labels, config_flags, sort_config, rows):
+        lib_data = pd.DataFrame(list(rows), columns=col_labels, dtype="str")
+
+    config_data = {
+        flag: pd.DataFrame([flags], columns=col_labels)
+        for flag, flags in config_flags.items()
+    }
+    config_data[SORT_CONFIG] = pd.DataFrame([sort_config], columns=col_labels)
+    return lib_data, config_data
+
+
+def read_excel_data_cached(log, is_dry_run, excel_file, cache_path, full=False):
+    # read_excel_data, but from the cache if the workbook hasn't changed
+    # since it was written (unless full is True). The cache is written
+    # after reading the workbook, unless it's a dry-run.
+    sha256 = libhelper.get_file_hash(excel_file)
+    metadata = cachehelper.read_cache_metadata(cache_path)
+    if not full and metadata is not None and metadata["workbook_sha256"] == sha256:
+        log.info(
+            "The spreadsheet hasn't changed, reading the cache", file=str(cache_path)
+        )
+        return cachehelper.read_sheet_cache(cache_path)
+
+    lib_data, config_data = read_excel_data(excel_file)
+    if cachehelper.pa is not None and not is_dry_run:
+        cachehelper.write_lib_data_cache(cache_path, lib_data, config_data, sha256)
+        log.info("Wrote the spreadsheet cache", file=str(cache_path))
+    return lib_data, config_data
+
+
+def write_excel_data(lib_data, config_data, output_files):
+    # Write the data from read_excel_data out as the usual csv files
+    lib_data.to_csv(output_files["libindex_csv"], index=False, encoding="utf-8")
+    for flag, data in config_data.items():
+        data.to_csv(output_files[flag], index=False)
+
+
+def read_excel_file_two_pass(excel_file, output_files):
+    # The original reader, the workbook is parsed by pandas twice.
+
+    # Read the whole sheet without a header first to find out if there
+    # is a sort row before the column labels
+    config_df = pd.read_excel(
+        excel_file,
+        sheet_name=SHEET_NAME,
+        header=None,
+    )
+    has_sort_row = is_sort_row(config_df.iloc[HEADER_ROW].to_list())
+    header_row = HEADER_ROW + 1 if has_sort_row else HEADER_ROW
+
+    # Save only the Active records in the document library index
+    # Note: index=False prevents pandas from writing a row index to the CSV.
+    df = pd.read_excel(
+        excel_file, sheet_name=SHEET_NAME, header=header_row, dtype="str"
+    )
+    df.to_csv(output_files["libindex_csv"], index=False, encoding="utf-8")
+    num_rows = df.index.size
+    # the cache would be out of date
+    output_files["libindex_cache"].unlink(missing_ok=True)
+
+    # Extract the config data rows and save them as separate CSV files
+    col_labels = df.columns  # use column labels from previous load of this file
+    config_df = config_df.iloc[:, : len(col_labels)]
+    config_df.columns = col_labels
+
+    for row_num, flag in enumerate(CONFIG_FLAGS):
+        (config_df.iloc[[row_num]] == flag).to_csv(output_files[flag], index=False)
+
+    sort_config = [""] * len(col_labels)
+    if has_sort_row:
+        sort_config = [
+            cell_to_str(value) for value in config_df.iloc[HEADER_ROW].to_list()
+        ]
+    write_config_csv(output_files[SORT_CONFIG], col_labels, sort_config)
+
+    return num_rows
+
+
+def compare_timing(log, excel_file):
+    # Run each reader into a scratch folder and report how long it took
+    # and the peak memory it allocated (tracemalloc slows both readers
+    # down by a similar amount, so compare the numbers with each other).
+    readers = [
+        ("streaming", stream_excel_file),
+        ("two-pass", read_excel_file_two_pass),
+    ]
+    for name, reader in readers:
+        with tempfile.TemporaryDirectory() as out_dir:
+            tracemalloc.start()
+            start = time.perf_counter()
+            num_rows = reader(excel_file, get_output_files(out_dir))
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        log.info(
+            "Reader timing",
+            reader=name,
+            rows=num_rows,
+            seconds=round(elapsed, 3),
+            peak_mib=round(peak / 2**20, 1),
+        )
+
+
+if __name__ == "__main__":
+    # create parser
+    parser = argparse.ArgumentParser()
+
+    # add arguments to the parser
+    parser.add_argument(
+        "--two-pass",
+        action="store_true",
+        help="read the workbook with pandas (twice) instead of streaming it",
+    )
+    parser.add_argument(
+        "--compare-timing",
+        action="store_true",
+        help="time the streaming and two-pass readers, no files are changed",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="read the spreadsheet even if it hasn't changed since the last run",
+    )
+
+    libhelper.add_log_level_argument(parser)
+
+    # parse the command line arguments
+    args = parser.parse_args()
+    log = libhelper.get_logger(args.log_level)
+
+    if args.compare_timing:
+        compare_timing(log, files.excel_file)
+        exit(0)
+
+    if (
+        not args.full
+        and not args.two_pass
+        and is_sheet_unchanged(files.excel_file, get_output_files())
+    ):
+        log.info("The spreadsheet hasn't changed since the last run")
+        exit(0)
+
+    log.info("Reading spreadsheet", file=str(files.excel_file))
+    if args.two_pass:
+        num_rows = read_excel_file_two_pass(files.excel_file, get_output_files())
+    else:
+        num_rows = stream_excel_file(files.excel_file, get_output_files())
+
+    log.info(
+        "Converted spreadsheet",
+        rows=num_rows,
+        files=[
+            str(files.libindex_csv),
+            str(files.filter_config),
+            str(files.search_config),
+            str(files.doc_display_config),
+            str(files.sort_config),
+            str(files.libindex_cache),
+        ],
     )
-)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+""" query-service.py
+
+    A small HTTP service that answers search requests over the library
+    index, so partner sites and other tools can query the library
+    without loading all of library-index.json. The docs and indexes
+    are kept in memory and the responses are cached (see
+    queryhelper.py for the form of the requests and responses).
+
+      POST /search    the request as a JSON object
+      GET  /search    the request as parameters: query, sort, page,
+                      per_page, conjunction and filter.<field_id> (once
+                      for each selected value)
+      GET  /stats     the number of docs, when they were loaded, the
+                      aggregations and sortings and the response cache
+                      hits and misses
+
+    The files are checked every --reload-interval seconds and the
+    library is loaded again when create-library-index.py has changed
+    them and finished, the requests are answered from the old one until
+    the new one is ready.
+
+    Run it after create-library-index.py, e.g.
+
+      python query-service.py --port 8765
+
+    and see load-test-query-service.py for timing it.
+
+    The script requires the structlog library to be installed
+    (used for logging).
+"""
+import argparse
+import http.server
+import json
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+import libhelper
+import queryhelper
+
+DEFAULT_PORT = 8765
+DEFAULT_RELOAD_SECONDS = 5.0
+
+# the largest request body accepted
+MAX_BODY_BYTES = 64 * 1024
+
+
+def get_params_request(query_string):
+    # The request from the parameters of a GET request
+    params = parse_qs(query_string)
+    request = {
+        key: values[-1]
+        for key, values in params.items()
+        if key in ("query", "sort", "page", "per_page", "conjunction")
+    }
+    request["filters"] = {
+        key.removeprefix("filter."): values
+        for key, values in params.items()
+        if key.startswith("filter.")
+    }
+    return request
+
+
+class QueryHandler(http.server.BaseHTTPRequestHandler):
+    # Answers the requests with the library in server.state
+    protocol_version = "HTTP/1.1"
+    # the headers and the body are sent separately, without this each
+    # response on a kept-alive connection waits for the client's ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/search":
+            self.send_search(get_params_request(url.query))
+        elif url.path == "/stats":
+            library = self.server.state["library"]
+            self.send_json(200, queryhelper.get_library_stats(library))
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if urlsplit(self.path).path != "/search":
+            self.send_json(404, {"error": "not found"})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY_BYTES:
+            self.send_json(413, {"error": "request too large"})
+            return
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.send_json(400, {"error": "the request isn't JSON"})
+            return
+        if not isinstance(request, dict):
+            self.send_json(400, {"error": "the request must be an object"})
+            return
+        self.send_search(request)
+
+    def do_OPTIONS(self):
+        # CORS preflight for POST requests from other sites
+        self.send_response(204)
+        self.send_cors_headers()
+        self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_search(self, request):
+        try:
+            body = queryhelper.search_library(self.server.state["library"], request)
+        except queryhelper.QueryError as ex:
+            self.send_json(400, {"error": str(ex)})
+            return
+        self.send_body(200, body)
+
+    def send_json(self, status, data):
+        self.send_body(status, json.dumps(data).encode("utf-8"))
+
+    def send_body(self, status, body):
+        self.send_response(status)
+        self.send_cors_headers()
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_cors_headers(self):
+        self.send_header("Access-Control-Allow-Origin", "*")
+
+    def log_message(self, format, *args):
+        self.server.log.debug(
+            "Request", client=self.client_address[0], line=format % args
+        )
+
+
+def reload_library(log, state, interval, cache_size, stop):
+    # Runs in a thread until stop is set, loads the library again when
+    # its files change
+    while not stop.wait(interval):
+        state["library"] = queryhelper.reload_if_changed(
+            log, state["library"], cache_size
+        )
+
+
+def run_service(log, host, port, cache_size, reload_interval):
+    state = {"library": queryhelper.load_library(log, cache_size)}
+    server = http.server.ThreadingHTTPServer((host, port), QueryHandler)
+    server.daemon_threads = True
+    server.state = state
+    server.log = log
+
+    stop = threading.Event()
+    threading.Thread(
+        target=reload_library,
+        args=(log, state, reload_interval, cache_size, stop),
+        daemon=True,
+    ).start()
+
+    log.info("Query service running", url=f"http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("Stopping query service")
+    finally:
+        stop.set()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    # create parser
+    parser = argparse.ArgumentParser()
+
+    # add arguments to the parser
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="address to listen on (default %(default)s)",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=DEFAULT_PORT,
+        help="port to listen on (default %(default)s)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=queryhelper.DEFAULT_CACHE_SIZE,
+        help="number of responses to cache (default %(default)s)",
+    )
+    parser.add_argument(
+        "--reload-interval",
+        type=float,
+        default=DEFAULT_RELOAD_SECONDS,
+        help="seconds between checks for a new library index (default %(default)s)",
+    )
+    libhelper.add_log_level_argument(parser)
+
+    # parse the command line arguments
+    args = parser.parse_args()
+    log = libhelper.get_logger(args.log_level)
+
+    run_service(log, args.host, args.port, args.cache_size, args.reload_interval)
@@ -0,0 +1,321 @@
+""" queryhelper.py
+
+    Answers search requests over the library index for
+    query-service.py, the way the website does with itemsjs but from
+    indexes kept in memory. The library is loaded from the files that
+    create-library-index.py writes:
+
+      - library-index.json, the docs
+      - query-config.json, the searchable fields, the aggregations
+        (filters) and the sortings
+      - search-index.json, facet-index.json and sort-index.json (see
+        searchhelper.py). These are built from the docs instead if any
+        of them is missing or has a different number of docs, or if
+        doc-fingerprints.json is missing (create-library-index.py
+        --stream removes it as it doesn't write them).
+
+    The library is loaded again when any of these files has changed,
+    but only once create-library-index.py has finished writing them:
+    doc-fingerprints.json is written last, so until it is the newest
+    of the files the old library is kept.
+
+    The postings of the facet values are decoded into sets once, when
+    the library is loaded. The responses to the last cache_size
+    different requests are kept, as JSON, until the library is loaded
+    again.
+
+    A request is a dictionary like the options of itemsjs search():
+
+      {
+        "query": search text (see searchhelper.search),
+        "filters": {field_id: [selected values]},
+        "sort": name of one of the sortings in the query config,
+        "page": page number, from 1,
+        "per_page": docs on each page,
+        "conjunction": False for docs with any of the selected values
+                       of a field rather than all of them
+      }
+
+    and the response is in the same form as from itemsjs:
+
+      {
+        "pagination": {"page": page, "per_page": per_page, "total": docs},
+        "data": {
+          "items": [the docs on the page],
+          "aggregations": {
+            field_id: {
+              "name": field_id,
+              "title": the filter field,
+              "buckets": [
+                {"key": value, "doc_count": docs, "selected": True/False}
+              ]
+            }
+          }
+        }
+      }
+
+    The buckets of each aggregation are the values of the docs that
+    match, most docs first, up to the size in the query config.
+"""
+import functools
+import json
+import time
+
+import pandas as pd
+
+import searchhelper
+from confighelper import files
+
+DEFAULT_CACHE_SIZE = 1024
+DEFAULT_PER_PAGE = 20
+MAX_PER_PAGE = 1000
+
+
+class QueryError(Exception):
+    # A request that can't be answered, e.g. an unknown sort
+    pass
+
+
+def load_json(path):
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def get_library_mtimes():
+    # The modified times of the files the library is loaded from, to
+    # tell when it needs loading again, doc-fingerprints.json last
+    mtimes = []
+    for path in (
+        files.libindex_json,
+        files.query_config,
+        files.search_index,
+        files.facet_index,
+        files.sort_index,
+        files.fingerprints,
+    ):
+        try:
+            mtimes.append(path.stat().st_mtime_ns)
+        except FileNotFoundError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+
+def is_build_finished(mtimes):
+    # False while create-library-index.py is part way through writing
+    # the files, it writes doc-fingerprints.json after the others
+    # (--stream removes it, so then there is no telling)
+    *index_mtimes, fingerprints_mtime = mtimes
+    if fingerprints_mtime is None:
+        return True
+    return all(mtime is None or mtime <= fingerprints_mtime for mtime in index_mtimes)
+
+
+def load_index(path, version, num_docs):
+    # The prebuilt index at path, or None if it is missing or wasn't
+    # made from the same docs
+    try:
+        index = load_json(path)
+    except (FileNotFoundError, ValueError):
+        return None
+    if index.get("version") != version or index.get("num_docs") != num_docs:
+        return None
+    return index
+
+
+def build_indexes(records, query_config):
+    # Build the search, facet and sort indexes from the docs in
+    # library-index.json, the multi-option fields are lists
+    lib_data = pd.DataFrame.from_records(records)
+    filter_fields = [
+        aggregation["title"] for aggregation in query_config["aggregations"].values()
+    ]
+    multi_options = {
+        field: lib_data[field].explode()
+        for field in filter_fields
+        if field in lib_data.columns
+        and lib_data[field].map(lambda value: isinstance(value, list)).any()
+    }
+    return (
+        searchhelper.build_search_index(lib_data, query_config["searchableFields"]),
+        searchhelper.build_facet_index(lib_data, multi_options, filter_fields),
+        searchhelper.build_sort_index(lib_data, query_config["sortings"]),
+    )
+
+
+def load_library(log, cache_size=DEFAULT_CACHE_SIZE):
+    # Load the docs, the query config and the indexes. Returns the
+    # library, a dictionary that is passed to the other functions.
+    mtimes = get_library_mtimes()
+    records = load_json(files.libindex_json)
+    query_config = load_json(files.query_config)
+
+    num_docs = len(records)
+    indexes = [
+        load_index(files.search_index, searchhelper.SEARCH_INDEX_VERSION, num_docs),
+        load_index(files.facet_index, searchhelper.FACET_INDEX_VERSION, num_docs),
+        load_index(files.sort_index, searchhelper.SORT_INDEX_VERSION, num_docs),
+    ]
+    if None in indexes or not files.fingerprints.exists():
+        log.info("Building the indexes from the docs", docs=num_docs)
+        indexes = build_indexes(records, query_config)
+    search_index, facet_index, sort_index = indexes
+
+    library = {
+        "records": records,
+        "query_config": query_config,
+        "search_index": search_index,
+        "facet_docs": {
+            field_id: {
+                value: frozenset(searchhelper.decode_postings(postings))
+                for value, postings in zip(facet["values"], facet["postings"])
+            }
+            for field_id, facet in facet_index["facets"].items()
+        },
+        "sort_orders": sort_index["sortings"],
+        "mtimes": mtimes,
+        "loaded": time.time(),
+    }
+    library["get_response"] = functools.lru_cache(maxsize=cache_size)(
+        functools.partial(get_response, library)
+    )
+    log.info(
+        "Loaded library",
+        docs=num_docs,
+        aggregations=list(library["facet_docs"]),
+        sortings=list(library["sort_orders"]),
+    )
+    return library
+
+
+def get_request_key(library, request):
+    # Check the request and return it as a tuple of (query, filters,
+    # sort, page, per_page, conjunction), the key for the response
+    # cache. The filters are a sorted tuple of (field_id, values).
+    query = request.get("query") or ""
+    filters = request.get("filters") or {}
+    sort = request.get("sort") or None
+    if not isinstance(query, str) or not isinstance(filters, dict):
+        raise QueryError("query must be text and filters an object")
+    for field_id, values in filters.items():
+        if field_id not in library["facet_docs"]:
+            raise QueryError(f"unknown filter {field_id}")
+        if not isinstance(values, list) or not all(
+            isinstance(value, str) for value in values
+        ):
+            raise QueryError(f"filter {field_id} must be a list of values")
+    if sort is not None and sort not in library["sort_orders"]:
+        raise QueryError(f"unknown sort {sort}")
+    try:
+        page = int(request.get("page") or 1)
+        per_page = int(request.get("per_page") or DEFAULT_PER_PAGE)
+    except (TypeError, ValueError):
+        raise QueryError("page and per_page must be numbers")
+    if page < 1 or not 1 <= per_page <= MAX_PER_PAGE:
+        raise QueryError(f"page must be 1 or more and per_page 1 to {MAX_PER_PAGE}")
+    conjunction = request.get("conjunction", True) not in (False, "false", "0")
+
+    filters = tuple(
+        sorted(
+            (field_id, tuple(sorted(set(values))))
+            for field_id, values in filters.items()
+            if values
+        )
+    )
+    return query, filters, sort, page, per_page, conjunction
+
+
+def get_matches(library, query, filters, conjunction):
+    # The ordinals of the docs that match the search and the filters
+    matches = set(searchhelper.search(library["search_index"], query))
+    for field_id, values in filters:
+        facet_docs = library["facet_docs"][field_id]
+        value_docs = [facet_docs.get(value, frozenset()) for value in values]
+        if conjunction:
+            matches.intersection_update(*value_docs)
+        else:
+            matches &= frozenset().union(*value_docs)
+    return matches
+
+
+def get_aggregations(library, matches, filters):
+    # The buckets of each aggregation for the docs that match
+    selected = dict(filters)
+    aggregations = {}
+    for field_id, aggregation in library["query_config"]["aggregations"].items():
+        facet_docs = library["facet_docs"].get(field_id, {})
+        counts = {}
+        for value, docs in facet_docs.items():
+            count = len(matches & docs)
+            if count or value in selected.get(field_id, ()):
+                counts[value] = count
+        buckets = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        aggregations[field_id] = {
+            "name": field_id,
+            "title": aggregation["title"],
+            "buckets": [
+                {
+                    "key": value,
+                    "doc_count": count,
+                    "selected": value in selected.get(field_id, ()),
+                }
+                for value, count in buckets[: aggregation["size"]]
+            ],
+        }
+    return aggregations
+
+
+def get_response(library, query, filters, sort, page, per_page, conjunction):
+    # The response to a request (see get_request_key) as JSON bytes,
+    # library["get_response"] is this with the library filled in and
+    # the responses cached
+    matches = get_matches(library, query, filters, conjunction)
+    if sort is None:
+        ordinals = sorted(matches)
+    else:
+        ordinals = [
+            ordinal for ordinal in library["sort_orders"][sort] if ordinal in matches
+        ]
+    start = (page - 1) * per_page
+    response = {
+        "pagination": {"page": page, "per_page": per_page, "total": len(ordinals)},
+        "data": {
+            "items": [
+                library["records"][ordinal]
+                for ordinal in ordinals[start : start + per_page]
+            ],
+            "aggregations": get_aggregations(library, matches, filters),
+        },
+    }
+    return json.dumps(response, ensure_ascii=False, separators=(",", ":")).encode(
+        "utf-8"
+    )
+
+
+def search_library(library, request):
+    # The response to a request as JSON bytes, raises QueryError if the
+    # request is wrong
+    return library["get_response"](*get_request_key(library, request))
+
+
+def get_library_stats(library):
+    cache_info = library["get_response"].cache_info()
+    return {
+        "docs": len(library["records"]),
+        "loaded": library["loaded"],
+        "aggregations": list(library["query_config"]["aggregations"]),
+        "sortings": list(library["sort_orders"]),
+        "cache": cache_info._asdict(),
+    }
+
+
+def reload_if_changed(log, library, cache_size=DEFAULT_CACHE_SIZE):
+    # The library loaded again if its files have changed since it was
+    # loaded and the build has finished, otherwise (or if they can't be
+    # read) the same library
+    mtimes = get_library_mtimes()
+    if mtimes == library["mtimes"] or not is_build_finished(mtimes):
+        return library
+    try:
+        return load_library(log, cache_size)
+    except (OSError, ValueError, KeyError) as ex:
+        log.warning("Couldn't load the library again", error=str(ex))
+        return library
@@ -0,0 +1,432 @@
+""" searchhelper.py
+
+    Builds and queries the prebuilt full-text search index and facet
+    index that create-library-index.py writes next to library-index.json.
+
+    The index maps each term to the ordinals of the docs it appears in
+    (the position of the doc in library-index.json). The terms can also
+    come from the text of the docs' PDFs (see texthelper.py), listed as
+    the "body" field. It is saved as
+
+      {
+        "version": 1,
+        "fields": [the searchable fields that were indexed],
+        "num_docs": number of docs,
+        "terms": [sorted list of terms],
+        "postings": [for each term, the sorted doc ordinals delta encoded,
+                     i.e. the first ordinal then the gap to each next one]
+      }
+
+    The facet index has the docs for every value of each filter field,
+    so filters can be applied by intersecting lists of doc ordinals:
+
+      {
+        "version": 1,
+        "num_docs": number of docs,
+        "facets": {
+          field_id: {
+            "title": the filter field,
+            "values": [sorted list of the field's values],
+            "counts": [number of docs with each value],
+            "postings": [delta encoded doc ordinals for each value]
+          }
+        }
+      }
+
+    The sort index has the doc ordinals in order for each of the
+    sortings in the query config, so a sorted page of results is the
+    matching docs picked out of the presorted list:
+
+      {
+        "version": 1,
+        "num_docs": number of docs,
+        "sortings": {sort name: [doc ordinals in sorted order]}
+      }
+
+    When only some docs have changed create-library-index.py patches
+    the search and facet indexes with them (see patch_postings) rather
+    than indexing every doc again.
+
+    Text is sorted with the collation rules of COLLATION_LOCALE if the
+    PyICU library is installed. Without it the text is only compared
+    ignoring case and accents, which isn't locale-aware but is close
+    for English titles.
+"""
+import bisect
+import functools
+import itertools
+import re
+import unicodedata
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+try:
+    import icu
+except ImportError:  # optional, text is sorted ignoring case and accents without it
+    icu = None
+
+SEARCH_INDEX_VERSION = 1
+FACET_INDEX_VERSION = 1
+SORT_INDEX_VERSION = 1
+
+# placeholder that create-library-index.py uses for empty cells
+NO_VALUE = "NO VALUE"
+
+# terms shorter than this aren't indexed
+MIN_TERM_LENGTH = 2
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# the field name for the terms from the text of the PDFs
+BODY_FIELD = "body"
+
+# the locale whose rules the text sortings follow (with PyICU)
+COLLATION_LOCALE = "en_AU"
+
+
+def normalise_text(text):
+    # lower case and without accents, so "Água" and "agua" match
+    if text.isascii():
+        return text.lower()  # nothing to take off
+    text = unicodedata.normalize("NFKD", text)
+    return "".join(char for char in text if not unicodedata.combining(char)).lower()
+
+
+def tokenise(text):
+    return [
+        term
+        for term in TOKEN_PATTERN.findall(normalise_text(text))
+        if len(term) >= MIN_TERM_LENGTH
+    ]
+
+
+@functools.lru_cache(maxsize=None)
+def get_collator():
+    return icu.Collator.createInstance(icu.Locale(COLLATION_LOCALE))
+
+
+def get_collation_key(text):
+    # The ICU sort key for the locale if PyICU is installed. Otherwise
+    # compare text ignoring case and accents first, so "Água" sorts
+    # with "agua" rather than after "Zebra", then by the text itself so
+    # the order of values that only differ in case or accents is fixed.
+    # "\0" sorts before every other character, so "ab" still comes
+    # before "abc".
+    if icu is not None:
+        return get_collator().getSortKey(text)
+    return normalise_text(text) + "\0" + text
+
+
+def get_field_text(value):
+    # The text to search for a field value, the multi-option fields
+    # hold a list of strings
+    if isinstance(value, list):
+        return " ".join(item for item in value if item != NO_VALUE)
+    if not isinstance(value, str) or value == NO_VALUE:
+        return ""
+    return value
+
+
+def build_search_index(lib_data, search_fields, bodies=None):
+    # Build the index for the docs in lib_data, in the order they are
+    # written to library-index.json. Fields that aren't in lib_data
+    # (e.g. dropped as private details) are skipped. bodies is a list of
+    # the terms from the text of each doc's PDF, as a space separated
+    # string ("" for docs without one).
+    fields = [field for field in search_fields if field in lib_data.columns]
+    postings = defaultdict(set)
+    for field in fields:
+        for ordinal, value in enumerate(lib_data[field]):
+            for term in tokenise(get_field_text(value)):
+                postings[term].add(ordinal)
+    if bodies is not None:
+        fields.append(BODY_FIELD)
+        for ordinal, body in enumerate(bodies):
+            for term in body.split():
+                postings[term].add(ordinal)
+
+    terms = sorted(postings)
+    return {
+        "version": SEARCH_INDEX_VERSION,
+        "fields": fields,
+        "num_docs": lib_data.index.size,
+        "terms": terms,
+        "postings": [encode_postings(postings[term]) for term in terms],
+    }
+
+
+def encode_postings(ordinals):
+    ordinals = sorted(ordinals)
+    return [ordinals[0]] + [b - a for a, b in zip(ordinals, ordinals[1:])]
+
+
+def decode_postings(deltas):
+    return list(itertools.accumulate(deltas))
+
+
+def patch_postings(keys, postings, ordinal_map, new_keys, new_postings, new_ordinals):
+    # Move the docs of the postings for each of keys (terms or facet
+    # values) to their new ordinals and add the docs of new_postings.
+    # ordinal_map has the new ordinal of each old doc (-1 if it has
+    # gone) and new_ordinals the ordinal of each doc new_postings were
+    # built for. Keys left without docs are dropped. Returns the sorted
+    # keys and the ordinals of each one.
+    merged = {}
+    for key, deltas in zip(keys, postings):
+        ordinals = ordinal_map[np.cumsum(deltas)]
+        merged[key] = ordinals[ordinals >= 0]
+    for key, deltas in zip(new_keys, new_postings):
+        ordinals = new_ordinals[np.cumsum(deltas)]
+        if key in merged:
+            ordinals = np.concatenate([merged[key], ordinals])
+        merged[key] = ordinals
+    keys = sorted(key for key, ordinals in merged.items() if ordinals.size)
+    return keys, [np.sort(merged[key]).tolist() for key in keys]
+
+
+def patch_search_index(search_index, new_index, ordinal_map, new_ordinals):
+    # The search index with the docs moved and the docs of new_index
+    # (built for the docs that are new or have changed) added, see
+    # patch_postings. The fields are the same for both.
+    terms, ordinals = patch_postings(
+        search_index["terms"],
+        search_index["postings"],
+        ordinal_map,
+        new_index["terms"],
+        new_index["postings"],
+        new_ordinals,
+    )
+    return {
+        "version": SEARCH_INDEX_VERSION,
+        "fields": search_index["fields"],
+        "num_docs": int((ordinal_map >= 0).sum()) + new_ordinals.size,
+        "terms": terms,
+        "postings": [encode_postings(doc_ordinals) for doc_ordinals in ordinals],
+    }
+
+
+def get_prefix_matches(search_index, prefix):
+    # The doc ordinals for all of the terms starting with prefix
+    terms = search_index["terms"]
+    ordinals = set()
+    position = bisect.bisect_left(terms, prefix)
+    while position < len(terms) and terms[position].startswith(prefix):
+        ordinals.update(decode_postings(search_index["postings"][position]))
+        position += 1
+    return ordinals
+
+
+def search(search_index, query):
+    # Returns the sorted ordinals of the docs that have a term starting
+    # with each of the words in the query. An empty query matches
+    # every doc.
+    words = tokenise(query)
+    if not words:
+        return list(range(search_index["num_docs"]))
+
+    ordinals = None
+    for word in words:
+        matches = get_prefix_matches(search_index, word)
+        ordinals = matches if ordinals is None else ordinals & matches
+        if not ordinals:
+            break
+    return sorted(ordinals)
+
+
+def get_field_id(field):
+    # replace spaces etc with underscores
+    return re.sub(r"[^A-Za-z0-9]", "_", field)
+
+
+def build_facet_index(lib_data, multi_options, filter_fields):
+    # Build the facet index for the docs in lib_data, in the order they
+    # are written to library-index.json. The tokens of the multi-option
+    # fields come from the long-form tables in multi_options (see
+    # split_multi_option_values) and each one is a separate value.
+    row_ordinals = pd.Series(np.arange(lib_data.index.size), index=lib_data.index)
+    facets = {}
+    for field in filter_fields:
+        if field not in lib_data.columns:
+            continue  # skip on to the next filter field
+
+        if field in multi_options:
+            values = multi_options[field]
+            field_values = pd.DataFrame(
+                {
+                    "value": values.to_numpy(dtype=object),
+                    "ordinal": row_ordinals.loc[values.index].to_numpy(),
+                }
+            )
+        else:
+            field_values = pd.DataFrame(
+                {
+                    "value": lib_data[field].to_numpy(dtype=object),
+                    "ordinal": row_ordinals.to_numpy(),
+                }
+            )
+        field_values = field_values.drop_duplicates().sort_values(["value", "ordinal"])
+
+        facet = {"title": field, "values": [], "counts": [], "postings": []}
+        for value, ordinals in field_values.groupby("value", sort=True)["ordinal"]:
+            facet["values"].append(value)
+            facet["counts"].append(int(ordinals.size))
+            facet["postings"].append(encode_postings(ordinals.tolist()))
+        facets[get_field_id(field)] = facet
+
+    return {
+        "version": FACET_INDEX_VERSION,
+        "num_docs": lib_data.index.size,
+        "facets": facets,
+    }
+
+
+def patch_facet_index(facet_index, new_index, ordinal_map, new_ordinals):
+    # The facet index with the docs moved and the docs of new_index
+    # (built for the docs that are new or have changed) added, the same
+    # way as patch_search_index
+    facets = {}
+    for field_id, facet in facet_index["facets"].items():
+        new_facet = new_index["facets"][field_id]
+        values, ordinals = patch_postings(
+            facet["values"],
+            facet["postings"],
+            ordinal_map,
+            new_facet["values"],
+            new_facet["postings"],
+            new_ordinals,
+        )
+        facets[field_id] = {
+            "title": facet["title"],
+            "values": values,
+            "counts": [len(doc_ordinals) for doc_ordinals in ordinals],
+            "postings": [encode_postings(doc_ordinals) for doc_ordinals in ordinals],
+        }
+
+    return {
+        "version": FACET_INDEX_VERSION,
+        "num_docs": int((ordinal_map >= 0).sum()) + new_ordinals.size,
+        "facets": facets,
+    }
+
+
+def get_facet_docs(facet_index, field_id, value):
+    facet = facet_index["facets"][field_id]
+    position = bisect.bisect_left(facet["values"], value)
+    if position == len(facet["values"]) or facet["values"][position] != value:
+        return set()
+    return set(decode_postings(facet["postings"][position]))
+
+
+def filter_docs(facet_index, filters, ordinals=None, conjunction=True):
+    # Returns the sorted ordinals of the docs (out of ordinals, or all
+    # of the docs) that match filters, a dictionary of field_id to a
+    # list of selected values. A doc has to have every selected value
+    # of a field, or any of them if conjunction is False, and has to
+    # match the selections for every field.
+    if ordinals is None:
+        ordinals = range(facet_index["num_docs"])
+    matches = set(ordinals)
+    for field_id, values in filters.items():
+        if not values:
+            continue
+        value_docs = [get_facet_docs(facet_index, field_id, value) for value in values]
+        if conjunction:
+            matches.intersection_update(*value_docs)
+        else:
+            matches &= set().union(*value_docs)
+    return sorted(matches)
+
+
+def get_facet_counts(facet_index, ordinals):
+    # The number of docs out of ordinals with each value of each field
+    ordinals = set(ordinals)
+    facet_counts = {}
+    for field_id, facet in facet_index["facets"].items():
+        facet_counts[field_id] = {}
+        for value, postings in zip(facet["values"], facet["postings"]):
+            count = len(ordinals.intersection(decode_postings(postings)))
+            if count:
+                facet_counts[field_id][value] = count
+    return facet_counts
+
+
+def get_sort_keys(values):
+    # The sort keys for a field, numbers (e.g. Year) if every value with
+    # text is a number, otherwise collation keys. Docs without a value
+    # get NaN so they always sort last.
+    text = values.map(get_field_text)
+    has_text = text.str.strip() != ""
+    numbers = pd.to_numeric(text.where(has_text), errors="coerce")
+    if numbers.notna().sum() == has_text.sum():
+        return numbers
+    keys = pd.Series(np.nan, index=text.index, dtype=object)
+    keys[has_text] = text[has_text].map(get_collation_key)
+    return keys
+
+
+def get_sort_order(lib_data, fields, orders):
+    # The doc ordinals sorted on each of fields in turn. The sort is
+    # stable so docs that are the same on every field stay in the order
+    # they are in library-index.json.
+    keys = pd.DataFrame(
+        {
+            position: get_sort_keys(lib_data[field]).to_numpy()
+            for position, field in enumerate(fields)
+        },
+        index=np.arange(lib_data.index.size),
+    )
+    keys = keys.sort_values(
+        by=list(keys.columns),
+        ascending=[order == "asc" for order in orders],
+        kind="mergesort",
+        na_position="last",
+    )
+    return keys.index.tolist()
+
+
+def build_sort_index(lib_data, sortings):
+    # Build the sort index for the docs in lib_data, in the order they
+    # are written to library-index.json. sortings is the sortings block
+    # of the query config, a field and order or a list of each per sort.
+    # Fields that aren't in lib_data are skipped.
+    sort_orders = {}
+    for name, sorting in sortings.items():
+        fields, orders = sorting["field"], sorting["order"]
+        if isinstance(fields, str):
+            fields, orders = [fields], [orders]
+        keep = [field in lib_data.columns for field in fields]
+        fields = [field for field, is_kept in zip(fields, keep) if is_kept]
+        orders = [order for order, is_kept in zip(orders, keep) if is_kept]
+        if fields:
+            sort_orders[name] = get_sort_order(lib_data, fields, orders)
+
+    return {
+        "version": SORT_INDEX_VERSION,
+        "num_docs": lib_data.index.size,
+        "sortings": sort_orders,
+    }
+
+
+def sort_docs(sort_index, name, ordinals):
+    # Returns ordinals in the order of the named sort, by picking them
+    # out of the presorted list rather than comparing the docs
+    ordinals = set(ordinals)
+    return [ordinal for ordinal in sort_index["sortings"][name] if ordinal in ordinals]
+
+
+def scan_search(records, search_fields, query):
+    # Search the docs in library-index.json the way the website does
+    # now, without an index: every word of the query has to be in the
+    # (lower case) text of the searchable fields. Used to check the
+    # results from search().
+    words = query.lower().split()
+    matches = []
+    for ordinal, record in enumerate(records):
+        text = " ".join(
+            get_field_text(record.get(field)) for field in search_fields
+        ).lower()
+        if all(word in text for word in words):
+            matches.append(ordinal)
+    return matches
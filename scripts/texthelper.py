@@ -0,0 +1,153 @@
+""" texthelper.py
+
+    Extracts the text of the open access PDFs in the library so it can
+    be added to the prebuilt search index.
+
+    The text of each PDF is cut down to a body of at most MAX_BODY_TERMS
+    distinct search terms (see searchhelper.tokenise), in the order they
+    first appear, and cached in outputs/doc-text/ under the sha256 of
+    the file, so a PDF is only parsed again when its contents change.
+    The PDFs are parsed in parallel in a process pool.
+
+    Needs the pypdf library, which reads the PDFs locally (nothing is
+    sent anywhere). Without it no text is extracted and the search
+    index only covers the spreadsheet fields.
+"""
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import libhelper
+import searchhelper
+from confighelper import docs, files
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # optional, full-text search is off without it
+    PdfReader = None
+
+# number of distinct terms kept from each PDF
+MAX_BODY_TERMS = 2000
+
+DEFAULT_WORKERS = 4
+
+
+def get_body_terms(pages, max_terms=MAX_BODY_TERMS):
+    # The distinct terms in the text of pages (an iterable of strings)
+    # in the order they first appear, stopping at max_terms so the rest
+    # of a long document isn't read
+    terms = {}
+    for text in pages:
+        for term in searchhelper.tokenise(text):
+            terms.setdefault(term, None)
+            if len(terms) >= max_terms:
+                return list(terms)
+    return list(terms)
+
+
+def extract_pdf_body(pdf_path, cache_path):
+    # Runs in a worker process. Saves the body of the PDF to cache_path
+    # and returns the number of terms and the error if it couldn't be
+    # read. An empty body is saved for a PDF that can't be read so it
+    # isn't tried again until it changes.
+    terms = []
+    error = None
+    try:
+        reader = PdfReader(pdf_path)
+        terms = get_body_terms(page.extract_text() or "" for page in reader.pages)
+    except Exception as e:
+        error = "{}: {}".format(type(e).__name__, e)
+    # write to a temporary file first so a half written body is never
+    # taken as cached
+    tmp_path = cache_path.with_suffix(".tmp")
+    tmp_path.write_text(" ".join(terms), encoding="utf-8")
+    os.replace(tmp_path, cache_path)
+    return len(terms), error
+
+
+def get_doc_hashes(filenames):
+    # The sha256 of each of the files in the library, from the manifest
+    # written by get-library-docs.py if it has the file
+    manifest = {}
+    if files.docs_manifest.exists():
+        manifest = json.loads(files.docs_manifest.read_text(encoding="utf-8"))
+
+    doc_hashes = {}
+    for filename in filenames:
+        entry = manifest.get(filename)
+        doc_path = docs.dest_path.joinpath(filename)
+        if entry is not None and "sha256" in entry:
+            doc_hashes[filename] = entry["sha256"]
+        elif doc_path.exists():
+            doc_hashes[filename] = libhelper.get_file_hash(doc_path)
+    return doc_hashes
+
+
+def get_pdf_hashes(filenames):
+    return get_doc_hashes(
+        sorted({filename for filename in filenames if filename.endswith(".pdf")})
+    )
+
+
+def remove_unused_text(doc_hashes):
+    # Remove the cached text of the PDFs that are no longer in the
+    # library, doc_hashes has the sha256 of every PDF in it
+    cache_dir = files.doc_text_cache
+    if not cache_dir.exists():
+        return
+    current = {sha256 + ".txt" for sha256 in doc_hashes.values()}
+    for cache_file in cache_dir.glob("*.txt"):
+        if cache_file.name not in current:
+            cache_file.unlink()
+
+
+def extract_doc_bodies(log, is_dry_run, filenames, workers=DEFAULT_WORKERS, prune=True):
+    # Returns the body of search terms for each of the files in the
+    # library (by normalised filename), parsing the PDFs that aren't in
+    # the cache. In a dry-run only the cached bodies are used. With
+    # prune the cached text of the PDFs that aren't in filenames is
+    # removed, so filenames has to be every file in the library.
+    if PdfReader is None:
+        log.warning("pypdf isn't installed, the text of the PDFs isn't searchable")
+        return {}
+
+    cache_dir = files.doc_text_cache
+    doc_hashes = get_pdf_hashes(filenames)
+    to_extract = {
+        sha256: docs.dest_path.joinpath(filename)
+        for filename, sha256 in doc_hashes.items()
+        if not cache_dir.joinpath(sha256 + ".txt").exists()
+    }
+    log.info(
+        "PDFs to extract text from",
+        pdfs=len(doc_hashes),
+        cached=len(doc_hashes) - len(to_extract),
+        to_extract=len(to_extract),
+    )
+
+    if to_extract and not is_dry_run:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            jobs = {
+                sha256: executor.submit(
+                    extract_pdf_body, pdf_path, cache_dir.joinpath(sha256 + ".txt")
+                )
+                for sha256, pdf_path in to_extract.items()
+            }
+            for sha256, job in jobs.items():
+                pdf_path = str(to_extract[sha256])
+                num_terms, error = job.result()
+                if error is not None:
+                    log.warning("Couldn't extract text", file=pdf_path, error=error)
+                else:
+                    log.debug("Extracted text", file=pdf_path, terms=num_terms)
+
+    if prune and not is_dry_run:
+        remove_unused_text(doc_hashes)
+
+    bodies = {}
+    for filename, sha256 in doc_hashes.items():
+        cache_file = cache_dir.joinpath(sha256 + ".txt")
+        if cache_file.exists():
+            bodies[filename] = cache_file.read_text(encoding="utf-8")
+    return bodies
@@ -0,0 +1,200 @@
+""" urlhelper.py
+
+    Checks that the publisher URLs of the docs in the library still
+    work, for create-library-index.py --check-urls.
+
+    The URLs are checked at the same time with asyncio: connections are
+    kept open and reused for each host, with at most PER_HOST_LIMIT
+    requests to a host at once and DEFAULT_CONCURRENCY in all. Each URL
+    gets a HEAD request, and a GET request if that fails (some sites
+    don't answer HEAD properly), redirects are followed. A request only
+    starts (and its timeout with it) once there is a free connection,
+    so URLs waiting their turn aren't reported as unreachable.
+
+    The results are cached in outputs/url-cache.json with the time they
+    were checked, so a URL is only checked again once its result is
+    older than the TTL (or RETRY_TTL_HOURS for results that may not
+    last, an HTTP error other than 404 and 410 or no response at all):
+
+      {
+        "version": 1,
+        "urls": {
+          url: {
+            "status": HTTP status of the last response (null if none),
+            "method": "HEAD" or "GET",
+            "error": why there was no response (null if there was),
+            "checked": time checked (seconds since the epoch)
+          }
+        }
+      }
+
+    Needs the aiohttp library, without it no URLs are checked.
+    check-url-checker.py checks it against a local stand-in server.
+"""
+import asyncio
+import json
+import os
+import time
+from urllib.parse import urlsplit
+
+try:
+    import aiohttp
+except ImportError:  # optional, the URLs aren't checked without it
+    aiohttp = None
+
+URL_CACHE_VERSION = 1
+
+# check the URLs again after a week
+DEFAULT_TTL_HOURS = 24 * 7
+
+# check the URLs that didn't answer properly again after an hour, a
+# network blip shouldn't hide them for a week
+RETRY_TTL_HOURS = 1
+
+DEFAULT_CONCURRENCY = 32
+PER_HOST_LIMIT = 4
+
+# seconds to wait for each request
+REQUEST_TIMEOUT = 20
+
+# a URL with one of these statuses is gone for good, others (e.g. 403
+# or 503) can be a site turning away robots or being down for a while
+DEAD_STATUSES = {404, 410}
+
+USER_AGENT = "library-url-check/1.0"
+
+
+def load_url_cache(cache_path):
+    try:
+        url_cache = json.loads(cache_path.read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError):
+        return {}
+    if url_cache.get("version") != URL_CACHE_VERSION:
+        return {}
+    return url_cache["urls"]
+
+
+def save_url_cache(cache_path, results):
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    tmp_path.write_text(
+        json.dumps({"version": URL_CACHE_VERSION, "urls": results}, indent=1),
+        encoding="utf-8",
+    )
+    os.replace(tmp_path, cache_path)
+
+
+def is_url_ok(result):
+    return result["status"] is not None and result["status"] < 400
+
+
+def is_url_dead(result):
+    return result["status"] in DEAD_STATUSES
+
+
+def get_url_state(result):
+    # "ok", "dead", "error" (an HTTP error that may not last) or
+    # "unreachable" (no response at all)
+    if is_url_ok(result):
+        return "ok"
+    if is_url_dead(result):
+        return "dead"
+    return "error" if result["status"] is not None else "unreachable"
+
+
+def is_result_expired(result, now, ttl_hours):
+    if get_url_state(result) in ("error", "unreachable"):
+        ttl_hours = min(ttl_hours, RETRY_TTL_HOURS)
+    return result["checked"] < now - ttl_hours * 3600
+
+
+async def request_url(session, method, url):
+    # Returns the status and error of one request, the body isn't read
+    try:
+        async with session.request(method, url, allow_redirects=True) as response:
+            return response.status, None
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as ex:
+        error = type(ex).__name__
+        if str(ex):
+            error += ": " + str(ex)
+        return None, error
+
+
+async def check_url(session, host_limits, limit, url):
+    # The timeout of a request counts from when it starts, so it only
+    # starts once it has one of the host's and one of all of the
+    # connections
+    async with host_limits[urlsplit(url).netloc], limit:
+        status, error = await request_url(session, "HEAD", url)
+        method = "HEAD"
+        if status is None or status >= 400:
+            status, error = await request_url(session, "GET", url)
+            method = "GET"
+    return {"status": status, "method": method, "error": error, "checked": time.time()}
+
+
+async def check_urls(urls, concurrency=DEFAULT_CONCURRENCY, timeout=REQUEST_TIMEOUT):
+    # Check all of the urls at once, returns the result for each url
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=PER_HOST_LIMIT)
+    # the connector limits the connections, these limit the requests
+    # that have started to the connections there are, so the HEAD and
+    # GET of a URL aren't held up behind every other URL
+    host_limits = {
+        host: asyncio.Semaphore(PER_HOST_LIMIT)
+        for host in {urlsplit(url).netloc for url in urls}
+    }
+    limit = asyncio.Semaphore(concurrency)
+    async with aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=timeout),
+        headers={"User-Agent": USER_AGENT},
+    ) as session:
+        results = await asyncio.gather(
+            *(check_url(session, host_limits, limit, url) for url in urls)
+        )
+    return dict(zip(urls, results))
+
+
+def check_publisher_urls(
+    log,
+    is_dry_run,
+    urls,
+    cache_path,
+    ttl_hours=DEFAULT_TTL_HOURS,
+    concurrency=DEFAULT_CONCURRENCY,
+):
+    # Returns the result for each of the urls, checking the ones that
+    # aren't in the cache or whose result has expired. The cache isn't
+    # saved in a dry-run.
+    if aiohttp is None:
+        log.warning("aiohttp isn't installed, the publisher URLs aren't checked")
+        return {}
+
+    url_cache = load_url_cache(cache_path)
+    now = time.time()
+    urls = sorted(set(urls))
+    to_check = [
+        url
+        for url in urls
+        if url not in url_cache or is_result_expired(url_cache[url], now, ttl_hours)
+    ]
+    log.info(
+        "Publisher URLs to check",
+        urls=len(urls),
+        cached=len(urls) - len(to_check),
+        to_check=len(to_check),
+    )
+
+    if to_check:
+        start = time.perf_counter()
+        url_cache.update(asyncio.run(check_urls(to_check, concurrency)))
+        log.info(
+            "Checked publisher URLs",
+            count=len(to_check),
+            seconds=round(time.perf_counter() - start, 2),
+        )
+
+    # only keep the URLs that are still in the library
+    results = {url: url_cache[url] for url in urls}
+    if not is_dry_run:
+        save_url_cache(cache_path, results)
+    return results
@@ -0,0 +1,141 @@
+""" watchhelper.py
+
+    Watches the spreadsheet and the source folder of the documents for
+    build-library.py --watch, and hands over the paths that changed in
+    batches.
+
+    The changes come from the watchdog library, which uses inotify on
+    Linux (and the native file events elsewhere). Without it, or with
+    --poll, the files are looked at every poll interval instead: the
+    folders are listed again only when their modified time changes (see
+    get-library-docs.py) but every file is checked for a new size or
+    modified time, so polling a large network share is slow.
+
+    Bursts of changes (e.g. a spreadsheet being saved, or a folder of
+    PDFs being copied in) are gathered into one batch that is handed
+    over once nothing has changed for DEBOUNCE_SECONDS.
+"""
+import importlib
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # optional, the files are polled without it
+    Observer = None
+
+# the script has dashes in its name so can't be imported with a normal
+# import statement
+library_docs = importlib.import_module("get-library-docs")
+
+# wait for this long without a change before handing over a batch
+DEBOUNCE_SECONDS = 0.2
+
+DEFAULT_POLL_SECONDS = 2.0
+
+# files that editors and file managers leave behind, not worth a rebuild
+IGNORED_PREFIXES = ("~$", ".~lock", ".DS_Store")
+
+
+def is_ignored(path):
+    return path.name.startswith(IGNORED_PREFIXES) or path.suffix == ".tmp"
+
+
+if Observer is not None:
+
+    class ChangeHandler(FileSystemEventHandler):
+        # Puts the paths of the files that change on the changes queue
+
+        def __init__(self, changes):
+            self.changes = changes
+
+        def on_any_event(self, event):
+            if event.is_directory or event.event_type in ("opened", "closed_no_write"):
+                return
+            self.changes.put(Path(os.fsdecode(event.src_path)))
+            if getattr(event, "dest_path", ""):
+                self.changes.put(Path(os.fsdecode(event.dest_path)))
+
+
+def start_observer(changes, watch_file, src_path):
+    # Watch the folder of watch_file and everything under src_path with
+    # watchdog, returns the observer (call stop() on it when done)
+    observer = Observer()
+    handler = ChangeHandler(changes)
+    observer.schedule(handler, str(watch_file.parent), recursive=False)
+    observer.schedule(handler, str(src_path), recursive=True)
+    observer.daemon = True
+    observer.start()
+    return observer
+
+
+def get_file_states(watch_file, src_path, dirs):
+    # The size and modified time of watch_file and each file under
+    # src_path, dirs is the directory index from the last time (it is
+    # updated in place)
+    dirs_now, _, _ = library_docs.scan_src_dirs(src_path, dirs)
+    dirs.clear()
+    dirs.update(dirs_now)
+
+    paths = [watch_file] + [
+        src_path.joinpath(rel_dir, filename)
+        for rel_dir, entry in dirs.items()
+        for filename in entry["files"]
+    ]
+    file_states = {}
+    for path in paths:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        file_states[path] = (stat.st_size, stat.st_mtime_ns)
+    return file_states
+
+
+def poll_changes(changes, watch_file, src_path, interval, stop):
+    # Runs in a thread until stop is set, puts the paths of the files
+    # that were added, removed or changed since the last look on the
+    # changes queue
+    dirs = {}
+    file_states = get_file_states(watch_file, src_path, dirs)
+    while not stop.wait(interval):
+        new_states = get_file_states(watch_file, src_path, dirs)
+        for path in file_states.keys() | new_states.keys():
+            if file_states.get(path) != new_states.get(path):
+                changes.put(path)
+        file_states = new_states
+
+
+def start_poller(changes, watch_file, src_path, interval):
+    # Poll for changes in a thread, returns the event that stops it
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=poll_changes,
+        args=(changes, watch_file, src_path, interval, stop),
+        daemon=True,
+    )
+    thread.start()
+    return stop
+
+
+def get_changes(changes, debounce=DEBOUNCE_SECONDS, timeout=None):
+    # Wait for a change, then keep gathering them until nothing has
+    # changed for debounce seconds. Returns the set of changed paths
+    # that aren't ignored (it can be empty), or None if nothing changed
+    # for timeout seconds.
+    try:
+        paths = {changes.get(timeout=timeout)}
+    except queue.Empty:
+        return None
+    quiet_until = time.monotonic() + debounce
+    while (wait := quiet_until - time.monotonic()) > 0:
+        try:
+            paths.add(changes.get(timeout=wait))
+            quiet_until = time.monotonic() + debounce
+        except queue.Empty:
+            break
+    return {path for path in paths if not is_ignored(path)}